@@ -0,0 +1,86 @@
+"""列表查询JSON序列化方式的基准测试,在项目根目录执行:
+       python -m benchmark.json_serialization [--repeat 20] [--log-rows 10000]
+   比较业务工作流列表(all_workflows)和日志分页(user_log_server_side_data)两种查询的两种序列化方式:
+   1.原有方式:DictCursor获取记录,dict(x.items())复制每条记录,jsonify编码;
+   2.数据库序列化:query_json在数据库中使用json_agg序列化,字节直接写入响应(encoded_jsonify);
+   使用应用配置(toolbox.flask_config)中的数据库,输出每种方式的最短、中位耗时和响应大小
+"""
+import argparse
+import statistics
+import time
+
+from flask import jsonify
+
+from runserver import app
+from toolbox.json_response import encoded_jsonify
+from toolbox.postgresql_helper import PgHelper
+
+# 与system_manage.workflow_manage.all_workflows相同的查询
+WORKFLOW_SQL = '''with recursive cte as
+                  (
+                  select A.guid, A.name, A.description,A.create_user as "createUser",to_char(A.create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",A.is_leaf as "isLeaf",
+                    A.name::text as "treeName",A.parent_guid as "parentGuid",A.flow_guid as "flowGuid",A.form_guid as "formGuid",B.name as "flowName",C.name as "formName"
+                  from gy_workflow A left join gy_flow B on A.flow_guid=B.guid
+                                  left join gy_form C on A.form_guid=C.guid where A.parent_guid = '03bb1ba4-0aeb-46d7-a99c-f03bcc6ea0d5'
+                  union all
+                  select origin.guid, origin.name, origin.description,origin.create_user as "createUser",to_char(origin.create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",
+                    origin.is_leaf as "isLeaf",cte."treeName" || '~' || origin.name as "treeName",origin.parent_guid as "parentGuid",
+                    origin.flow_guid as "flowGuid",origin.form_guid as "formGuid",B.name as "flowName",C.name as "formName"
+                  from cte,gy_workflow origin left join gy_flow B on origin.flow_guid=B.guid
+                                            left join gy_form C on origin.form_guid=C.guid  where origin.parent_guid = cte.guid
+                  )
+                  select guid, name, description,"createUser","createTime","isLeaf","treeName","parentGuid","flowGuid","flowName","formGuid","formName"
+                  from cte'''
+
+# 与system_manage.log_manage.user_log_server_side_data相同的分页查询(无检索条件、无排序)
+LOG_SQL = '''select row_number() over() AS id, user_name as "userName",event_description as "eventDescription",
+             to_char(event_time,'YYYY-MM-DD hh24:mi:ss') as "eventTime" from gy_log limit %s OFFSET 0'''
+
+
+def python_serialization(sql_string, param_tuple, key):
+    """原有方式,返回响应的字节
+    """
+    records = PgHelper().query_datatable(sql_string, param_tuple)
+    return jsonify({key: [dict(x.items()) for x in records]}).get_data()
+
+
+def database_serialization(sql_string, param_tuple, key):
+    """数据库序列化方式,返回响应的字节
+    """
+    records_json = PgHelper().query_json(sql_string, param_tuple)
+    return encoded_jsonify(**{key: records_json}).get_data()
+
+
+def measure(function, repeat, *args):
+    """执行repeat次,返回(最短耗时, 中位耗时, 响应大小),单位为毫秒和字节
+    """
+    durations = []
+    size = 0
+    for _ in range(repeat):
+        with app.app_context():
+            start_time = time.perf_counter()
+            size = len(function(*args))
+            durations.append((time.perf_counter() - start_time) * 1000)
+    return min(durations), statistics.median(durations), size
+
+
+def main():
+    """执行基准测试并输出结果
+    """
+    parser = argparse.ArgumentParser(description='列表查询JSON序列化方式的基准测试')
+    parser.add_argument('--repeat', type=int, default=20, help='每种方式的执行次数')
+    parser.add_argument('--log-rows', type=int, default=10000, help='日志分页查询的每页记录数')
+    args = parser.parse_args()
+
+    cases = (('all_workflows', WORKFLOW_SQL, None, 'workflowData'), ('user_log_server_side_data', LOG_SQL, (args.log_rows,), 'rowData'))
+    print(f'{"endpoint":<28}{"serialization":<16}{"min(ms)":>10}{"median(ms)":>12}{"bytes":>12}')
+    for endpoint, sql_string, param_tuple, key in cases:
+        for name, function in (('python', python_serialization), ('database', database_serialization)):
+            # 预热一次,排除建立连接、预备语句的开销
+            measure(function, 1, sql_string, param_tuple, key)
+            min_time, median_time, size = measure(function, args.repeat, sql_string, param_tuple, key)
+            print(f'{endpoint:<28}{name:<16}{min_time:>10.2f}{median_time:>12.2f}{size:>12}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""用户操作日志检索的基准测试,在项目根目录执行:
+       python -m benchmark.log_search [--rows 5000000] [--repeat 5] [--keep]
+   在测试表gy_log_search_benchmark中生成指定数量的日志记录(用户、事件描述、param_json的分布与实际日志相近),
+   比较三种检索方式的记录总数查询和第一页(按事件时间倒序100条)查询的耗时:
+   1.原有方式:拼接检索文本的position(...) > 0,每次检索扫描整个表;
+   2.参数化的LIKE '%文本%'(toolbox.log_search.search_condition),没有三元组索引;
+   3.参数化的LIKE '%文本%',建立pg_trgm三元组索引之后;
+   数据库需要安装pg_trgm扩展;使用应用配置(toolbox.flask_config)中的数据库,默认测试结束后删除测试表
+"""
+import argparse
+import hashlib
+import statistics
+import time
+
+from runserver import app
+from toolbox import log_search
+from toolbox.connection_pool import get_pool
+from toolbox.postgresql_helper import PgHelper
+
+TABLE_NAME = 'gy_log_search_benchmark'
+
+CREATE_SQL = f'''drop table if exists {TABLE_NAME};
+                 create unlogged table {TABLE_NAME}(id bigserial, user_guid text, user_name text, event_description text,
+                                                    param_json text, event_time timestamp)'''
+
+# 2万个用户,9种事件描述,5万个不同的name参数
+INSERT_SQL = f'''insert into {TABLE_NAME}(user_guid, user_name, event_description, param_json, event_time)
+                 select md5(i::text), 'user' || lpad((i %% 20000)::text, 5, '0'),
+                        (array['添加角色','编辑角色','删除角色','添加用户','编辑用户','删除用户','保存流程图','保存表单','保存地理处理模型'])[1 + i %% 9]
+                        || ' ' || (i %% 1000),
+                        json_build_object('name', 'name-' || md5((i %% 50000)::text), 'guid', md5(i::text))::text,
+                        now() - i * interval '1 second'
+                 from generate_series(1, %s) i'''
+
+# 检索文本:少量匹配的用户名、大量匹配的事件描述、param_json中的name、没有匹配、少于3个字符(不能使用三元组索引)
+SEARCH_TEXTS = ('user01234', '编辑用户', hashlib.md5(b'12345').hexdigest()[:8], 'no-such-text', 'us')
+
+
+def position_sql(search_text):
+    """原有方式的检索条件,拼接检索文本
+    """
+    return f" where position('{search_text}' in user_name) >0 or position('{search_text}' in event_description) >0"
+
+
+def like_sql(search_text):
+    """参数化的检索条件
+    """
+    search_cause, param_list = log_search.search_condition(search_text)
+    return ' where ' + search_cause, tuple(param_list)
+
+
+def measure(repeat, sql_string, param_tuple):
+    """执行repeat次,返回(最短耗时, 中位耗时, 查询结果),单位为毫秒
+    """
+    durations = []
+    result = None
+    for _ in range(repeat):
+        with app.app_context():
+            start_time = time.perf_counter()
+            result = PgHelper(statement_timeout=0).query_datatable(sql_string, param_tuple)
+            durations.append((time.perf_counter() - start_time) * 1000)
+    return min(durations), statistics.median(durations), result
+
+
+def run_cases(method, repeat):
+    """执行每个检索文本的记录总数查询和第一页查询,输出耗时
+    """
+    for search_text in SEARCH_TEXTS:
+        if method == 'position':
+            where_cause, param_tuple = position_sql(search_text), None
+        else:
+            where_cause, param_tuple = like_sql(search_text)
+        count_min, count_median, count_result = measure(repeat, f'select count(*) from {TABLE_NAME}' + where_cause, param_tuple)
+        page_min, page_median, _ = measure(repeat, f'select * from {TABLE_NAME}' + where_cause + ' order by event_time desc limit 100', param_tuple)
+        print(f'{method:<12}{search_text:<16}{count_result[0][0]:>10}{count_min:>12.1f}{count_median:>12.1f}{page_min:>12.1f}{page_median:>12.1f}')
+
+
+def main():
+    """生成测试数据,执行基准测试并输出结果
+    """
+    parser = argparse.ArgumentParser(description='用户操作日志检索的基准测试')
+    parser.add_argument('--rows', type=int, default=5000000, help='测试表的记录数')
+    parser.add_argument('--repeat', type=int, default=5, help='每个查询的执行次数')
+    parser.add_argument('--keep', action='store_true', help='测试结束后保留测试表')
+    args = parser.parse_args()
+
+    # 没有应用上下文时PgHelper独占连接,每次执行后提交
+    pg_helper = PgHelper(statement_timeout=0)
+    pg_helper.execute_sql(CREATE_SQL)
+    pg_helper.execute_sql(INSERT_SQL, (args.rows,))
+    pg_helper.execute_sql(log_search.PARAM_FUNCTION_SQL)
+    pg_helper.execute_sql(f'analyze {TABLE_NAME}')
+
+    print(f'{"method":<12}{"searchText":<16}{"count":>10}{"count min":>12}{"count med":>12}{"page min":>12}{"page med":>12}  (ms)')
+    run_cases('position', args.repeat)
+    run_cases('like', args.repeat)
+
+    start_time = time.perf_counter()
+    log_search.create_indexes(get_pool(), log_search.DEFAULT_SEARCH_PARAM_KEYS, TABLE_NAME)
+    pg_helper.execute_sql(f'analyze {TABLE_NAME}')
+    print(f'create trigram indexes: {(time.perf_counter() - start_time) * 1000:.0f} ms')
+    run_cases('like+trgm', args.repeat)
+
+    if not args.keep:
+        pg_helper.execute_sql(f'drop table {TABLE_NAME}')
+
+
+if __name__ == '__main__':
+    main()
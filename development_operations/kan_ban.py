@@ -6,6 +6,8 @@ import datetime
 from flask import (jsonify, request)
 from flask_jwt_extended import (jwt_required, get_jwt_identity)
 
+from toolbox import tree_cache
+from toolbox.conditional_request import conditional
 from toolbox.postgresql_helper import PgHelper
 from toolbox.user_log import logit
 
@@ -14,6 +16,7 @@ from .blue_print import development_operations_api
 
 @development_operations_api.route('/kan_ban/all_kan_ban', methods=('get',))
 @jwt_required()
+@conditional(('gy_geoprocessing_model',))
 def all_kan_ban():
     """所有的算法模型信息
     获取系统的所有算法模型项信息，仅名称和描述
@@ -69,19 +72,10 @@ def all_kan_ban():
     """
     try:
         pg_helper = PgHelper()
-        records = pg_helper.query_datatable('''with recursive cte as
-                                                (
-                                                select guid, name, description,create_user as "createUser",to_char(create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",is_leaf as "isLeaf",name::text as "treeName",parent_guid as "parentGuid"
-                                                from gy_geoprocessing_model where parent_guid = '99fb71e8-a794-47c2-a9c6-dc0a6e36248f'
-                                                union all
-                                                select
-                                                origin.guid, origin.name, origin.description,origin.create_user as "createUser",to_char(origin.create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",origin.is_leaf as "isLeaf",
-                                                cte."treeName" || '~' || origin.name,origin.parent_guid as "parentGuid"
-                                                from cte,gy_geoprocessing_model origin 
-                                                where origin.parent_guid = cte.guid
-                                                )
-                                                select  guid, name, description,"createUser","createTime","isLeaf","treeName","parentGuid"
-                                                from cte;''')
+        records = pg_helper.query_datatable('''select guid, name, description,create_user as "createUser",
+                                                to_char(create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",is_leaf as "isLeaf",
+                                                array_to_string(tree_names, '~') as "treeName",parent_guid as "parentGuid"
+                                                from gy_geoprocessing_model where tree_path is not null order by cardinality(tree_path);''')
 
         return jsonify({"geoprocessingModelData": [dict(x.items()) for x in records]}), 200
 
@@ -163,6 +157,7 @@ def add_kan_ban():
                VALUES(%s, %s, %s, %s, %s, %s, %s);''',
             (request_param.get('guid', None), request_param.get('name', None), request_param.get('description', None), current_user['userName'],
              current_time, request_param.get('parentGuid', None), request_param.get('isLeaf', None)))
+        tree_cache.invalidate('gy_geoprocessing_model')
 
         return jsonify({'createUser': current_user['userName'], 'createTime': current_time.strftime("%Y-%m-%d %H:%M:%S")}), 200
 
@@ -243,6 +238,7 @@ def edit_kan_ban():
             '''update gy_geoprocessing_model set name=%s,description=%s,create_user=%s,create_time=%s,parent_guid=%s where guid=%s''',
             (request_param.get('name', None), request_param.get(
                 'description', None), current_user['userName'], current_time, request_param.get('parentGuid', None), request_param.get('guid', None)))
+        tree_cache.invalidate('gy_geoprocessing_model')
 
         return jsonify({'createUser': current_user['userName'], 'createTime': current_time.strftime("%Y-%m-%d %H:%M:%S")}), 200
 
@@ -282,6 +278,7 @@ def delete_kan_ban():
     try:
         pg_helper = PgHelper()
         pg_helper.execute_sql('''delete from gy_geoprocessing_model where guid=%s''', (request.json.get('guid', None),))
+        tree_cache.invalidate('gy_geoprocessing_model')
 
         return jsonify({}), 200
 
@@ -1,4 +1,4 @@
-"""团队化开发词汇表模块,包括读取所有词汇对照项;添加词汇对照项;编辑词汇对照项;删除词汇对照项;
+"""团队化开发词汇表模块,包括读取所有词汇对照项;按照前缀自动补全词汇项;添加词汇对照项;编辑词汇对照项;删除词汇对照项;删除、移动词汇子树;
 """
 import traceback
 import datetime
@@ -6,6 +6,9 @@ import datetime
 from flask import (jsonify, request)
 from flask_jwt_extended import (jwt_required, get_jwt_identity)
 
+from toolbox import (tree_cache, tree_path, word_index)
+from toolbox.conditional_request import conditional
+from toolbox.json_response import encoded_jsonify
 from toolbox.postgresql_helper import PgHelper
 from toolbox.user_log import logit
 
@@ -14,6 +17,7 @@ from .blue_print import development_operations_api
 
 @development_operations_api.route('/word_chinese_english/all_word_chinese_englishs', methods=('get',))
 @jwt_required()
+@conditional(('gy_word_chinese_english',))
 def all_word_chinese_englishs():
     """所有的词汇项信息
     获取系统的所有词汇项信息，树形结构信息
@@ -68,22 +72,75 @@ def all_word_chinese_englishs():
     """
     try:
         pg_helper = PgHelper()
-        records = pg_helper.query_datatable('''with recursive cte as
-                                                (
-                                                select guid, chinese_name as "chineseName", english_name as "englishName",create_user as "createUser",to_char(create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",is_leaf as "isLeaf",
-                                                chinese_name::text as "treeChineseName",parent_guid as "parentGuid" from gy_word_chinese_english where parent_guid = '4dba9686-8412-4a14-8ddf-a7c48c8e446d'
-                                                union all
-                                                select
-                                                origin.guid, origin.chinese_name as "chineseName", origin.english_name as "englishName",origin.create_user as "createUser",
-                                                to_char(origin.create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",origin.is_leaf as "isLeaf",
-                                                cte."treeChineseName" || '~' || origin.chinese_name,origin.parent_guid as "parentGuid"
-                                                from cte,gy_word_chinese_english origin 
-                                                where origin.parent_guid = cte.guid
-                                                )
-                                                select  guid, "chineseName", "englishName","createUser","createTime","isLeaf","treeChineseName","parentGuid"
-                                                from cte;''')
-
-        return jsonify({"wordChineseEnglishData": [dict(x.items()) for x in records]}), 200
+        records_json = tree_cache.load(
+            'gy_word_chinese_english', ('gy_word_chinese_english',), lambda: pg_helper.query_json('''select guid,
+                                                chinese_name as "chineseName", english_name as "englishName",create_user as "createUser",to_char(create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",is_leaf as "isLeaf",
+                                                array_to_string(tree_names, '~') as "treeChineseName",parent_guid as "parentGuid"
+                                                from gy_word_chinese_english where tree_path is not null order by cardinality(tree_path);'''))
+
+        return encoded_jsonify(wordChineseEnglishData=records_json), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@development_operations_api.route('/word_chinese_english/autocomplete_word_chinese_english', methods=('post',))
+@jwt_required()
+def autocomplete_word_chinese_english():
+    """自动补全词汇项
+    查询中文名称或英文名称以输入的前缀开头(不区分大小写)的词汇项，使用进程内的前缀索引，不查询数据库
+    ---
+    tags:
+      - development_operations_api/word_chinese_english
+    parameters:
+      - in: body
+        name: prefix
+        type: string
+        required: true
+        description: 输入的前缀
+      - in: body
+        name: limit
+        type: integer
+        required: false
+        description: 最多返回的词汇项数，默认为10，最多为100
+    responses:
+      200:
+        description: 服务运行成功返回的对象
+        schema:
+          properties:
+            wordChineseEnglishData:
+              type: array
+              description: 匹配的词汇项数组，按照匹配的名称排序
+              items:
+                type: object
+                properties:
+                  guid:
+                    type: string
+                    description: 词汇项的唯一标识符
+                  chineseName:
+                    type: string
+                    description: 词汇项中文名称
+                  englishName:
+                    type: string
+                    description: 词汇项英文名称
+                  treeChineseName:
+                    type: string
+                    description: 词汇项在树结构中的名称，使用~连接树层次名称
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        records = word_index.search(request.json.get('prefix', None), request.json.get('limit', None))
+
+        return jsonify({'wordChineseEnglishData': records}), 200
 
     except Exception as exception:
         return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
@@ -163,6 +220,8 @@ def add_word_chinese_english():
                VALUES(%s, %s, %s, %s, %s, %s, %s);''',
             (request_param.get('guid', None), request_param.get('chineseName', None), request_param.get('englishName', None),
              current_user['userName'], current_time, request_param.get('parentGuid', None), request_param.get('isLeaf', None)))
+        tree_cache.invalidate('gy_word_chinese_english')
+        word_index.refresh(request_param.get('guid', None))
 
         return jsonify({'createUser': current_user['userName'], 'createTime': current_time.strftime("%Y-%m-%d %H:%M:%S")}), 200
 
@@ -243,6 +302,8 @@ def edit_word_chinese_english():
             '''update gy_word_chinese_english set chinese_name=%s,english_name=%s,create_user=%s,create_time=%s,parent_guid=%s where guid=%s''',
             (request_param.get('chineseName', None), request_param.get(
                 'englishName', None), current_user['userName'], current_time, request_param.get('parentGuid', None), request_param.get('guid', None)))
+        tree_cache.invalidate('gy_word_chinese_english')
+        word_index.refresh(request_param.get('guid', None))
 
         return jsonify({'createUser': current_user['userName'], 'createTime': current_time.strftime("%Y-%m-%d %H:%M:%S")}), 200
 
@@ -282,6 +343,95 @@ def delete_word_chinese_english():
     try:
         pg_helper = PgHelper()
         pg_helper.execute_sql('''delete from gy_word_chinese_english where guid=%s''', (request.json.get('guid', None),))
+        tree_cache.invalidate('gy_word_chinese_english')
+        word_index.refresh(request.json.get('guid', None))
+
+        return jsonify({}), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@development_operations_api.route('/word_chinese_english/delete_word_chinese_english_subtree', methods=('post',))
+@jwt_required()
+@logit()
+def delete_word_chinese_english_subtree():
+    """删除词汇子树
+    删除词汇或词汇类别及其全部下级词汇，在一条语句中删除整个子树
+    ---
+    tags:
+      - development_operations_api/word_chinese_english
+    parameters:
+      - in: body
+        name: guid
+        type: string
+        required: true
+        description: 子树根节点的guid
+    responses:
+      200:
+        description: 空，不返回有效数据
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = PgHelper()
+        tree_path.delete_subtree(pg_helper, 'gy_word_chinese_english', request.json.get('guid', None))
+        tree_cache.invalidate('gy_word_chinese_english')
+        word_index.refresh(request.json.get('guid', None))
+
+        return jsonify({}), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@development_operations_api.route('/word_chinese_english/move_word_chinese_english', methods=('post',))
+@jwt_required()
+@logit()
+def move_word_chinese_english():
+    """移动词汇子树
+    将词汇或词汇类别及其全部下级词汇移动到新的上级类别下，新的上级类别不能是自身或者下级
+    ---
+    tags:
+      - development_operations_api/word_chinese_english
+    parameters:
+      - in: body
+        name: guid
+        type: string
+        required: true
+        description: 子树根节点的guid
+      - in: body
+        name: parentGuid
+        type: string
+        required: false
+        description: 新的上级类别的guid，为空时移动到第一级
+    responses:
+      200:
+        description: 空，不返回有效数据
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = PgHelper()
+        tree_path.move_subtree(pg_helper, 'gy_word_chinese_english', request.json.get('guid', None), request.json.get('parentGuid', None))
+        tree_cache.invalidate('gy_word_chinese_english')
+        word_index.refresh(request.json.get('guid', None))
 
         return jsonify({}), 200
 
@@ -13,12 +13,41 @@ from system_manage.blue_print import system_manage_api
 from system_manage_authorize.blue_print import system_manage_authorize_api
 from technology_research.blue_print import technology_research_api
 
+from toolbox import (async_postgresql_helper, audit_log_writer, cache_listener, connection_pool, log_partition, log_payload, log_rollup, log_search,
+                     row_count, tree_path)
+
 #FLASK APP主程序
 app = Flask(__name__)
 
 #项目的全局配置
 app.config.from_object('toolbox.flask_config.DevelopmentConfig')
 
+#数据库连接池
+connection_pool.init_app(app)
+async_postgresql_helper.init_app(app)
+
+#用户操作日志的汇总表和大字段表,需要在日志开始写入之前创建
+log_rollup.init_app(app)
+log_payload.init_app(app)
+
+#用户操作日志的批量写入
+audit_log_writer.init_app(app)
+
+#用户操作日志表的分区维护
+log_partition.init_app(app)
+
+#用户操作日志检索条件使用的函数,三元组索引通过python -m toolbox.log_search create-indexes创建
+log_search.init_app(app)
+
+#用户操作日志的记录数维护
+row_count.init_app(app)
+
+#树形表的物化路径,树形列表的查询使用路径字段
+tree_path.init_app(app)
+
+#其它进程修改数据时使本进程的树形列表缓存和ETag失效
+cache_listener.init_app(app)
+
 #蓝图注册
 app.register_blueprint(development_operations_api, url_prefix='/development_operations_api')
 app.register_blueprint(system_manage_api, url_prefix='/system_manage_api')
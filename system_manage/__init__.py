@@ -1,5 +1,5 @@
 """系统管理模块,包括权限管理;角色管理;用户管理;日志管理;个人信息、个人中心;
-   流程管理;表单管理;业务流程管理;地理处理模型管理;详情见下表:
+   流程管理;表单管理;业务流程管理;地理处理模型管理;数据库监控;详情见下表:
 ---------------------------------------------------------------------------------------------------------------
      __init__.py        |       付昕乐       |                                  包初始化
 ---------------------------------------------------------------------------------------------------------------
@@ -24,8 +24,10 @@
   personal_center.py    |       付昕乐       |                                  功能概述
 ---------------------------------------------------------------------------------------------------------------
      web_config.py      |       付昕乐       |                                  功能概述
+---------------------------------------------------------------------------------------------------------------
+  database_monitor.py   |       付昕乐       |                                  数据库连接池、预备语句缓存等运行状态监控
 ---------------------------------------------------------------------------------------------------------------
 """
 
 from . import (authority_manage, flow_manage, form_manage, workflow_manage, geoprocessing_model, log_manage, personal_center, role_manage,
-               user_manage, web_config)
+               user_manage, web_config, database_monitor)
@@ -1,10 +1,13 @@
-"""权限管理模块,包括读取所有权限;添加权限;编辑权限;删除权限
+"""权限管理模块,包括读取所有权限;添加权限;编辑权限;删除权限;删除、移动权限子树
 """
 import traceback
 
 from flask import (jsonify, request)
 from flask_jwt_extended import jwt_required
 
+from toolbox import (tree_cache, tree_path)
+from toolbox.async_postgresql_helper import AsyncPgHelper
+from toolbox.conditional_request import conditional
 from toolbox.postgresql_helper import PgHelper
 from toolbox.user_log import logit
 
@@ -13,7 +16,8 @@ from .blue_print import system_manage_api
 
 @system_manage_api.route('/authority_manage/all_authorize', methods=('get',))
 @jwt_required()
-def all_authorize():
+@conditional(('gy_authorize',))
+async def all_authorize():
     """所有的权限信息
     获取系统的所有权限信息，
     用于系统的权限树编辑
@@ -52,8 +56,8 @@ def all_authorize():
               description: 异常更加详细的信息，包括异常的位置
     """
     try:
-        pg_helper = PgHelper()
-        records = pg_helper.query_datatable('''select id,guid,name,parent_guid,type from gy_authorize order by id''')
+        pg_helper = AsyncPgHelper()
+        records = await pg_helper.query_datatable('''select id,guid,name,parent_guid,type from gy_authorize order by id''')
 
         return jsonify({"authorizeData": [dict(x.items()) for x in records]}), 200
 
@@ -95,6 +99,7 @@ def add_authorize():
         request_param = request.json.get('authorize_info', None)
         pg_helper.execute_sql('''INSERT INTO gy_authorize(guid, name, parent_guid,type) VALUES(%s, %s, %s, %s);''', (request_param.get(
             'guid', None), request_param.get('name', None), request_param.get('parent_guid', None), request_param.get('type', None)))
+        tree_cache.invalidate('gy_authorize')
 
         return jsonify({}), 200
 
@@ -140,6 +145,7 @@ def edit_authorize():
         else:
             pg_helper.execute_sql('''update gy_authorize set name=%s,parent_guid=%s where guid=%s''',
                                   (request_param.get('name', None), request_param.get('parent_guid', None), request_param.get('guid', None)))
+        tree_cache.invalidate('gy_authorize')
 
         return jsonify({}), 200
 
@@ -179,6 +185,92 @@ def delete_authorize():
     try:
         pg_helper = PgHelper()
         pg_helper.execute_sql('''delete from gy_authorize where guid=%s''', (request.json.get('guid', None),))
+        tree_cache.invalidate('gy_authorize')
+
+        return jsonify({}), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/authority_manage/delete_authorize_subtree', methods=('post',))
+@jwt_required()
+@logit()
+def delete_authorize_subtree():
+    """删除权限子树
+    删除权限或权限类别及其全部下级权限及角色的权限设置，在一条语句中删除整个子树
+    ---
+    tags:
+      - system_manage_api/authority_manage
+    parameters:
+      - in: body
+        name: guid
+        type: string
+        required: true
+        description: 子树根节点的guid
+    responses:
+      200:
+        description: 空，不返回有效数据
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = PgHelper()
+        tree_path.delete_subtree(pg_helper, 'gy_authorize', request.json.get('guid', None))
+        tree_cache.invalidate('gy_authorize')
+
+        return jsonify({}), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/authority_manage/move_authorize', methods=('post',))
+@jwt_required()
+@logit()
+def move_authorize():
+    """移动权限子树
+    将权限或权限类别及其全部下级权限移动到新的上级类别下，新的上级类别不能是自身或者下级
+    ---
+    tags:
+      - system_manage_api/authority_manage
+    parameters:
+      - in: body
+        name: guid
+        type: string
+        required: true
+        description: 子树根节点的guid
+      - in: body
+        name: parentGuid
+        type: string
+        required: false
+        description: 新的上级类别的guid，为空时移动到第一级
+    responses:
+      200:
+        description: 空，不返回有效数据
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = PgHelper()
+        tree_path.move_subtree(pg_helper, 'gy_authorize', request.json.get('guid', None), request.json.get('parentGuid', None))
+        tree_cache.invalidate('gy_authorize')
 
         return jsonify({}), 200
 
@@ -0,0 +1,574 @@
+"""数据库监控模块,包括数据库连接池(主库、只读库、异步连接池)的统计信息;预备语句缓存的统计信息;
+   语句执行耗时的统计信息、慢查询和语句超时取消的统计信息;清空语句执行耗时的统计信息;用户操作日志批量写入、分区维护和检索索引的统计信息;
+"""
+import traceback
+
+from flask import jsonify
+from flask_jwt_extended import jwt_required
+
+from toolbox import (cache_listener, conditional_request, log_partition, log_payload, log_rollup, log_search, query_metrics, query_timeout, row_count,
+                     statement_cache, tree_cache, tree_path, word_index)
+from toolbox.async_postgresql_helper import (async_replica_pools, get_async_pool)
+from toolbox.audit_log_writer import get_writer
+from toolbox.connection_pool import (get_pool, replica_pools)
+
+from .blue_print import system_manage_api
+
+
+@system_manage_api.route('/database_monitor/pool_statistics', methods=('get',))
+@jwt_required()
+def pool_statistics():
+    """数据库连接池的统计信息
+    获取数据库连接池的连接数、空闲连接数、获取连接的等待时间、饱和次数等统计信息,
+    配置了只读库时同时返回每个只读库连接池的统计信息,以及异步视图使用的异步连接池的统计信息
+    ---
+    tags:
+      - system_manage_api/database_monitor
+    responses:
+      200:
+        description: 连接池的统计信息
+        schema:
+          properties:
+            poolStatistics:
+              type: object
+              description: 连接池的统计信息
+              properties:
+                minSize:
+                  type: integer
+                  description: 最小连接数
+                maxSize:
+                  type: integer
+                  description: 最大连接数
+                size:
+                  type: integer
+                  description: 当前连接数
+                idleCount:
+                  type: integer
+                  description: 空闲连接数
+                inUseCount:
+                  type: integer
+                  description: 使用中的连接数
+                checkoutCount:
+                  type: integer
+                  description: 获取连接的次数
+                waitCount:
+                  type: integer
+                  description: 连接池饱和,获取连接需要等待的次数
+                waitTimeTotal:
+                  type: number
+                  description: 获取连接的累计等待时间,单位为秒
+                waitTimeMax:
+                  type: number
+                  description: 获取连接的最大等待时间,单位为秒
+                timeoutCount:
+                  type: integer
+                  description: 获取连接超时的次数
+                healthCheckFailCount:
+                  type: integer
+                  description: 健康检查失败,重建连接的次数
+                createCount:
+                  type: integer
+                  description: 新建连接的次数
+                discardCount:
+                  type: integer
+                  description: 丢弃损坏连接的次数
+            replicaPoolStatistics:
+              type: array
+              description: 只读库连接池的统计信息,每个只读库一项,字段与主库连接池相同
+              items:
+                type: object
+            asyncPoolStatistics:
+              type: object
+              description: 异步连接池(psycopg_pool)的统计信息,包括pool_size、pool_available、requests_waiting等
+            asyncReplicaPoolStatistics:
+              type: array
+              description: 只读库异步连接池的统计信息,每个只读库一项,字段与主库异步连接池相同
+              items:
+                type: object
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        return jsonify({
+            "poolStatistics": get_pool().statistics(),
+            "replicaPoolStatistics": [x.statistics() for x in replica_pools()],
+            "asyncPoolStatistics": get_async_pool().statistics(),
+            "asyncReplicaPoolStatistics": [x.statistics() for x in async_replica_pools()]
+        }), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/database_monitor/statement_cache_statistics', methods=('get',))
+@jwt_required()
+def statement_cache_statistics():
+    """预备语句缓存的统计信息
+    获取所有连接的预备语句(PREPARE/EXECUTE)缓存命中次数、未命中次数、命中率等统计信息,
+    用于验证节省的SQL解析和执行计划生成开销
+    ---
+    tags:
+      - system_manage_api/database_monitor
+    responses:
+      200:
+        description: 预备语句缓存的统计信息
+        schema:
+          properties:
+            statementCacheStatistics:
+              type: object
+              description: 预备语句缓存的统计信息
+              properties:
+                hitCount:
+                  type: integer
+                  description: 命中缓存,直接EXECUTE的次数
+                missCount:
+                  type: integer
+                  description: 新PREPARE语句的次数
+                hitRate:
+                  type: number
+                  description: 命中率
+                evictCount:
+                  type: integer
+                  description: 超过缓存容量,淘汰最久未使用语句的次数
+                invalidateCount:
+                  type: integer
+                  description: 服务端预备语句丢失,清空连接缓存的次数
+                prepareFailCount:
+                  type: integer
+                  description: PREPARE失败,不再预备该语句的次数
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        return jsonify({"statementCacheStatistics": statement_cache.statistics()}), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/database_monitor/query_metrics', methods=('get',))
+@jwt_required()
+def query_metrics_statistics():
+    """语句执行耗时的统计信息
+    获取PgHelper、AsyncPgHelper执行的语句按照语句指纹汇总的执行次数、耗时和耗时分布,
+    每个语句按照调用的接口分别统计,以及最近的慢查询(参数、执行计划),
+    语句因请求截止时间、客户端断开被取消的统计信息
+    ---
+    tags:
+      - system_manage_api/database_monitor
+    responses:
+      200:
+        description: 语句执行耗时的统计信息
+        schema:
+          properties:
+            queryMetrics:
+              type: object
+              description: 语句执行耗时的统计信息
+              properties:
+                statements:
+                  type: array
+                  description: 按照累计耗时从大到小排序的语句统计信息
+                  items:
+                    type: object
+                    properties:
+                      fingerprintId:
+                        type: string
+                        description: 语句指纹的标识
+                      fingerprint:
+                        type: string
+                        description: 语句指纹,常量替换为?
+                      count:
+                        type: integer
+                        description: 执行次数
+                      totalTime:
+                        type: number
+                        description: 累计耗时,单位为毫秒
+                      meanTime:
+                        type: number
+                        description: 平均耗时,单位为毫秒
+                      maxTime:
+                        type: number
+                        description: 最大耗时,单位为毫秒
+                      histogram:
+                        type: array
+                        description: 耗时直方图,每个分桶为耗时不超过le毫秒(且超过上一分桶)的执行次数
+                        items:
+                          type: object
+                      endpoints:
+                        type: object
+                        description: 各接口调用该语句的执行次数和累计耗时
+                slowQueries:
+                  type: array
+                  description: 最近的慢查询,包括语句指纹、参数、接口、耗时和执行计划
+                  items:
+                    type: object
+                overflowCount:
+                  type: integer
+                  description: 语句指纹数达到上限后未统计的执行次数
+            queryTimeoutStatistics:
+              type: object
+              description: 语句超时和取消的统计信息
+              properties:
+                deadlineExceededCount:
+                  type: integer
+                  description: 请求截止时间已过,不再执行语句的次数
+                deadlineCancelCount:
+                  type: integer
+                  description: 请求截止时间已过,取消正在执行的语句的次数
+                disconnectCancelCount:
+                  type: integer
+                  description: 客户端断开,取消正在执行的语句的次数
+                resetCount:
+                  type: integer
+                  description: 归还连接池时恢复超时配置的次数
+                activeCount:
+                  type: integer
+                  description: 正在执行并被监视的语句数
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        return jsonify({"queryMetrics": query_metrics.statistics(), "queryTimeoutStatistics": query_timeout.statistics()}), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/database_monitor/reset_query_metrics', methods=('post',))
+@jwt_required()
+def reset_query_metrics():
+    """清空语句执行耗时的统计信息
+    清空语句执行耗时的统计信息和慢查询记录,用于重新开始统计
+    ---
+    tags:
+      - system_manage_api/database_monitor
+    responses:
+      200:
+        description: 空，不返回有效数据
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        query_metrics.reset()
+        return jsonify({}), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/database_monitor/audit_log_statistics', methods=('get',))
+@jwt_required()
+def audit_log_statistics():
+    """用户操作日志批量写入、分区维护、检索索引、记录总数、汇总表和大字段存储的统计信息
+    获取用户操作日志队列中等待写入的记录数,以及写入、队列已满时丢弃、写入失败的记录数等统计信息,
+    以及最近一次日志分区维护的结果、检索使用的三元组索引的创建结果、记录总数各种获取策略的使用次数、汇总表的状态和大字段存储的统计信息
+    ---
+    tags:
+      - system_manage_api/database_monitor
+    responses:
+      200:
+        description: 用户操作日志批量写入的统计信息
+        schema:
+          properties:
+            auditLogStatistics:
+              type: object
+              description: 用户操作日志批量写入的统计信息
+              properties:
+                submittedCount:
+                  type: integer
+                  description: 放入队列的记录数
+                writtenCount:
+                  type: integer
+                  description: 写入数据库的记录数
+                droppedCount:
+                  type: integer
+                  description: 队列已满或者应用正在退出,丢弃的记录数
+                failedCount:
+                  type: integer
+                  description: 写入数据库失败的记录数
+                batchCount:
+                  type: integer
+                  description: 写入的批次数
+                rollupFailedCount:
+                  type: integer
+                  description: 汇总表更新失败的批次数(日志仍然写入)
+                queueSize:
+                  type: integer
+                  description: 队列中等待写入的记录数
+                queueMaxSize:
+                  type: integer
+                  description: 队列的最大长度
+            logPartitionStatistics:
+              type: object
+              description: 最近一次日志分区维护的结果
+              properties:
+                time:
+                  type: string
+                  description: 维护时间
+                result:
+                  type: object
+                  description: 新创建(created)、分离(detached)、删除(dropped)和维护失败(failed,只跳过该分区)的分区,gy_log不是分区表或者其它进程正在维护时skipped为true
+                error:
+                  type: string
+                  description: 维护失败时的异常信息
+            logSearchStatistics:
+              type: object
+              description: 检索条件使用的gy_log_param函数的创建结果,三元组索引通过python -m toolbox.log_search create-indexes创建
+              properties:
+                time:
+                  type: string
+                  description: 创建时间
+                duration:
+                  type: number
+                  description: 创建耗时,单位为毫秒
+                installed:
+                  type: boolean
+                  description: 函数是否可用(已存在的函数跳过创建)
+                error:
+                  type: string
+                  description: 创建失败(例如数据库不可用)时的异常信息
+            rowCountStatistics:
+              type: object
+              description: 日志表格记录总数的获取策略的统计信息
+              properties:
+                counterCount:
+                  type: integer
+                  description: 使用计数触发器维护的记录数的次数
+                statisticsEstimateCount:
+                  type: integer
+                  description: 使用统计信息估计值的次数(计数触发器未安装)
+                cacheHitCount:
+                  type: integer
+                  description: 使用缓存的精确记录数的次数
+                planEstimateCount:
+                  type: integer
+                  description: 使用执行计划估计值的次数
+                exactCount:
+                  type: integer
+                  description: 执行count获取精确值的次数
+                cacheSize:
+                  type: integer
+                  description: 缓存的检索条件数
+                counter:
+                  type: object
+                  description: 计数触发器的安装结果,包括时间(time)、是否执行了安装(installed)和失败时的异常信息(error)
+            logRollupStatistics:
+              type: object
+              description: 用户操作日志汇总表的状态
+              properties:
+                ready:
+                  type: boolean
+                  description: 汇总表是否可用,不可用时日志写入不更新汇总表
+                last:
+                  type: object
+                  description: 最近一次重建的时间(time)、汇总表的记录数(rowCount)和失败时的异常信息(error)
+            logPayloadStatistics:
+              type: object
+              description: 用户操作日志大字段存储的统计信息
+              properties:
+                ready:
+                  type: boolean
+                  description: 大字段表是否可用,不可用时请求参数全部写入param_json
+                extractedCount:
+                  type: integer
+                  description: 替换为引用的字段数
+                extractedBytes:
+                  type: integer
+                  description: 替换为引用的字段的原始字节数
+                excludedCount:
+                  type: integer
+                  description: 按照配置不记录的字段数
+                storedCount:
+                  type: integer
+                  description: 新存储的内容数
+                storedBytes:
+                  type: integer
+                  description: 新存储的内容压缩后的字节数
+                duplicateCount:
+                  type: integer
+                  description: 已经存储过、不再存储的内容数
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        return jsonify({
+            "auditLogStatistics": get_writer().statistics(),
+            "logPartitionStatistics": log_partition.statistics(),
+            "logSearchStatistics": log_search.statistics(),
+            "rowCountStatistics": row_count.statistics(),
+            "logRollupStatistics": log_rollup.statistics(),
+            "logPayloadStatistics": log_payload.statistics()
+        }), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/database_monitor/tree_cache_statistics', methods=('get',))
+@jwt_required()
+def tree_cache_statistics():
+    """树形列表缓存的统计信息
+    获取流程、表单、工作流、地理处理模型、词汇表等树形列表缓存的命中次数、未命中次数、失效次数等统计信息,
+    树形表物化路径的安装结果,条件请求(ETag)返回304和完整响应的次数,其它进程的缓存失效通知的接收情况,以及词汇前缀索引的统计信息
+    ---
+    tags:
+      - system_manage_api/database_monitor
+    responses:
+      200:
+        description: 树形列表缓存的统计信息
+        schema:
+          properties:
+            treeCacheStatistics:
+              type: object
+              description: 树形列表缓存的统计信息
+              properties:
+                hitCount:
+                  type: integer
+                  description: 命中缓存,不查询数据库的次数
+                missCount:
+                  type: integer
+                  description: 没有缓存或者缓存已失效,查询数据库的次数
+                invalidateCount:
+                  type: integer
+                  description: 添加、编辑、删除使表的版本号增加的次数
+                evictedCount:
+                  type: integer
+                  description: 超过缓存项数,淘汰最久未使用缓存项的次数
+                entryCount:
+                  type: integer
+                  description: 缓存项数
+                entryBytes:
+                  type: integer
+                  description: 缓存的字节数
+            treePathStatistics:
+              type: object
+              description: 树形表物化路径的安装结果
+              properties:
+                time:
+                  type: string
+                  description: 安装的时间
+                installed:
+                  type: object
+                  description: 各表新安装时有路径的节点数,已经安装的为null(安装失败时应用不能启动)
+            conditionalRequestStatistics:
+              type: object
+              description: 条件请求的统计信息
+              properties:
+                notModifiedCount:
+                  type: integer
+                  description: If-None-Match与当前的ETag一致,返回304的次数
+                fullResponseCount:
+                  type: integer
+                  description: 执行查询,返回完整响应的次数
+                uncheckedCount:
+                  type: integer
+                  description: 依赖的表的修改不会收到通知(触发器安装失败),不使用ETag的次数
+            cacheListenerStatistics:
+              type: object
+              description: 缓存失效通知的统计信息
+              properties:
+                receivedCount:
+                  type: integer
+                  description: 接收其它进程的通知,使缓存失效的次数
+                ownCount:
+                  type: integer
+                  description: 本进程发送、忽略的通知数
+                reconnectCount:
+                  type: integer
+                  description: 监听连接断开、重新连接的次数
+                connected:
+                  type: boolean
+                  description: 监听连接是否可用
+                lastError:
+                  type: object
+                  description: 最近一次断开的时间和异常信息
+                notifiedTables:
+                  type: array
+                  description: 已安装通知触发器(只在数据库中直接修改)的表
+            wordIndexStatistics:
+              type: object
+              description: 词汇前缀索引的统计信息
+              properties:
+                queryCount:
+                  type: integer
+                  description: 自动补全查询的次数
+                rebuildCount:
+                  type: integer
+                  description: 建立索引和其它进程修改词汇表后重建索引的次数
+                applyCount:
+                  type: integer
+                  description: 本进程修改词汇表后增量更新索引的次数
+                failedCount:
+                  type: integer
+                  description: 增量更新时读取数据库失败,使索引失效的次数
+                lastRebuildMilliseconds:
+                  type: integer
+                  description: 最近一次重建索引的耗时,单位为毫秒
+                wordCount:
+                  type: integer
+                  description: 索引的词汇项数
+                keyCount:
+                  type: integer
+                  description: 索引的键数
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        return jsonify({
+            "treeCacheStatistics": tree_cache.statistics(),
+            "treePathStatistics": tree_path.statistics(),
+            "conditionalRequestStatistics": conditional_request.statistics(),
+            "cacheListenerStatistics": cache_listener.statistics(),
+            "wordIndexStatistics": word_index.statistics()
+        }), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
@@ -1,4 +1,4 @@
-"""流程管理模块,包括读取所有流程;添加流程;编辑流程;删除流程;
+"""流程管理模块,包括读取所有流程;分页读取流程树的子节点;添加流程;编辑流程;删除流程;删除、移动流程子树;
    读取流程图;流程图设计保存流程图;
 """
 import traceback
@@ -7,6 +7,10 @@ import datetime
 from flask import (jsonify, request)
 from flask_jwt_extended import (jwt_required, get_jwt_identity)
 
+from toolbox import (tree_cache, tree_path)
+from toolbox.async_postgresql_helper import AsyncPgHelper
+from toolbox.conditional_request import conditional
+from toolbox.json_response import encoded_jsonify
 from toolbox.postgresql_helper import PgHelper
 from toolbox.user_log import logit
 
@@ -15,7 +19,8 @@ from .blue_print import system_manage_api
 
 @system_manage_api.route('/flow_manage/all_flows', methods=('get',))
 @jwt_required()
-def all_flows():
+@conditional(('gy_flow',))
+async def all_flows():
     """所有的流程项信息
     获取系统的所有流程信息，不包括流程图信息，
     仅用于添加、编辑流程名称和描述、删除流程信息
@@ -69,22 +74,107 @@ def all_flows():
               description: 异常更加详细的信息，包括异常的位置
     """
     try:
-        pg_helper = PgHelper()
-        records = pg_helper.query_datatable('''with recursive cte as
-                                                (
-                                                select guid, name, description,create_user as "createUser",to_char(create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",is_leaf as "isLeaf",name::text as "treeName",parent_guid as "parentGuid"
-                                                from gy_flow where parent_guid = 'bc7dc16e-184f-4743-a9c5-e7d1507be350'
-                                                union all
-                                                select
-                                                origin.guid, origin.name, origin.description,origin.create_user as "createUser",to_char(origin.create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",origin.is_leaf as "isLeaf",
-                                                cte."treeName" || '~' || origin.name,origin.parent_guid as "parentGuid"
-                                                from cte,gy_flow origin 
-                                                where origin.parent_guid = cte.guid
-                                                )
-                                                select  guid, name, description,"createUser","createTime","isLeaf","treeName","parentGuid"
-                                                from cte;''')
-
-        return jsonify({"flowData": [dict(x.items()) for x in records]}), 200
+        pg_helper = AsyncPgHelper()
+        records_json = await tree_cache.load_async(
+            'gy_flow', ('gy_flow',), lambda: pg_helper.query_json('''select guid, name, description,create_user as "createUser",
+                                                to_char(create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",is_leaf as "isLeaf",
+                                                array_to_string(tree_names, '~') as "treeName",parent_guid as "parentGuid"
+                                                from gy_flow where tree_path is not null order by cardinality(tree_path);'''))
+
+        return encoded_jsonify(flowData=records_json), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/flow_manage/flow_children', methods=('post',))
+@jwt_required()
+async def flow_children():
+    """流程树的子节点
+    分页获取流程树中一个节点的直接子节点，用于树形控件展开节点时按需加载，
+    每个子节点包括子节点数和是否有子节点
+    ---
+    tags:
+      - system_manage_api/flow_manage
+    parameters:
+      - in: body
+        name: parentGuid
+        type: string
+        required: false
+        description: 上级节点的唯一标识，默认为根节点
+      - in: body
+        name: startRow
+        type: integer
+        required: false
+        description: 分页的起始行，默认为0
+      - in: body
+        name: endRow
+        type: integer
+        required: false
+        description: 分页的结束行，默认为起始行之后的100行，每页最多1000行
+    responses:
+      200:
+        description: 子节点信息，数组类型
+        schema:
+          properties:
+            flowData:
+              type: array
+              description: 子节点数组
+              items:
+                type: object
+                properties:
+                  guid:
+                    type: string
+                    description: 流程的唯一标识符
+                  name:
+                    type: string
+                    description: 流程名称
+                  description:
+                    type: string
+                    description: 描述
+                  createUser:
+                    type: string
+                    description: 流程创建者
+                  createTime:
+                    type: string
+                    description: 流程创建时间
+                  isLeaf:
+                    type: boolean
+                    description: 是否是叶节点，即是流程还是流程类别
+                  treeName:
+                    type: string
+                    description: 流程在树结构中的名称，使用~连接树层次名称
+                  parentGuid:
+                    type: string
+                    description: 父类型的唯一标识
+                  childCount:
+                    type: integer
+                    description: 子节点数
+                  hasChildren:
+                    type: boolean
+                    description: 是否有子节点
+            totalCount:
+              type: integer
+              description: 上级节点的子节点总数
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = AsyncPgHelper()
+        records, total_count = await tree_path.query_children(
+            pg_helper, 'gy_flow', '''A.guid, A.name, A.description,
+                A.create_user as "createUser",to_char(A.create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",A.is_leaf as "isLeaf",
+                array_to_string(A.tree_names, '~') as "treeName",A.parent_guid as "parentGuid"''', request.json)
+
+        return jsonify({"flowData": records, "totalCount": total_count}), 200
 
     except Exception as exception:
         return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
@@ -166,6 +256,7 @@ def add_flow():
                                  VALUES(%s, %s, %s, %s, %s, %s, %s);''',
             (request_param.get('guid', None), request_param.get('name', None), request_param.get('description', None), current_user['userName'],
              current_time, request_param.get('parentGuid', None), request_param.get('isLeaf', None)))
+        tree_cache.invalidate('gy_flow')
 
         return jsonify({'createUser': current_user['userName'], 'createTime': current_time.strftime("%Y-%m-%d %H:%M:%S")}), 200
 
@@ -245,6 +336,7 @@ def edit_flow():
         pg_helper.execute_sql('''update gy_flow set name=%s,description=%s,create_user=%s,create_time=%s,parent_guid=%s where guid=%s''',
                               (request_param.get('name', None), request_param.get('description', None), current_user['userName'], current_time,
                                request_param.get('parentGuid', None), request_param.get('guid', None)))
+        tree_cache.invalidate('gy_flow')
 
         return jsonify({'createUser': current_user['userName'], 'createTime': current_time.strftime("%Y-%m-%d %H:%M:%S")}), 200
 
@@ -286,6 +378,92 @@ def delete_flow():
         # 删除的信息：流程信息、流程节点信息、工作流关联的本流程设置为NULL
         pg_helper.execute_sql('''delete from gy_flow where guid=%s;delete from gy_flow_node where flow_guid=%s;''',
                               (request.json.get('guid', None), request.json.get('guid', None)))
+        tree_cache.invalidate('gy_flow')
+
+        return jsonify({}), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/flow_manage/delete_flow_subtree', methods=('post',))
+@jwt_required()
+@logit()
+def delete_flow_subtree():
+    """删除流程子树
+    删除流程或流程类别及其全部下级流程及流程节点，在一条语句中删除整个子树
+    ---
+    tags:
+      - system_manage_api/flow_manage
+    parameters:
+      - in: body
+        name: guid
+        type: string
+        required: true
+        description: 子树根节点的guid
+    responses:
+      200:
+        description: 空，不返回有效数据
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = PgHelper()
+        tree_path.delete_subtree(pg_helper, 'gy_flow', request.json.get('guid', None))
+        tree_cache.invalidate('gy_flow')
+
+        return jsonify({}), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/flow_manage/move_flow', methods=('post',))
+@jwt_required()
+@logit()
+def move_flow():
+    """移动流程子树
+    将流程或流程类别及其全部下级流程移动到新的上级类别下，新的上级类别不能是自身或者下级
+    ---
+    tags:
+      - system_manage_api/flow_manage
+    parameters:
+      - in: body
+        name: guid
+        type: string
+        required: true
+        description: 子树根节点的guid
+      - in: body
+        name: parentGuid
+        type: string
+        required: false
+        description: 新的上级类别的guid，为空时移动到第一级
+    responses:
+      200:
+        description: 空，不返回有效数据
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = PgHelper()
+        tree_path.move_subtree(pg_helper, 'gy_flow', request.json.get('guid', None), request.json.get('parentGuid', None))
+        tree_cache.invalidate('gy_flow')
 
         return jsonify({}), 200
 
@@ -333,23 +511,19 @@ def new_and_save_flow():
               description: 异常更加详细的信息，包括异常的位置
     """
     try:
-        sql_tuple = ()
+        pg_helper = PgHelper()
 
         # 插入流程信息、流程图信息
         current_user = get_jwt_identity()
         flow_info = request.json.get('flowInfo', None)
-        sql_string = "INSERT INTO gy_flow(guid, name, description,flow_json,create_user,create_time) VALUES(%s, %s, %s, %s, %s, %s);"
-        sql_tuple = sql_tuple + (flow_info.get('guid', None), flow_info.get('name', None), flow_info.get(
-            'description', None), request.json.get('diagramJson', None), current_user['userName'], datetime.datetime.now())
-
-        #插入节点的语句，如果节点存在仅仅更新相应的信息
-        for x in request.json.get('nodes', None):
-            sql_string = sql_string + 'insert into gy_flow_node(guid,node_name,next_node_guid,flow_guid) values(%s,%s,%s,%s);'
-            sql_tuple = sql_tuple + (x['guid'], x['nodeName'], x['nextNodeGuid'], flow_info.get('guid', None))
+        pg_helper.execute_sql("INSERT INTO gy_flow(guid, name, description,flow_json,create_user,create_time) VALUES(%s, %s, %s, %s, %s, %s);",
+                              (flow_info.get('guid', None), flow_info.get('name', None), flow_info.get(
+                                  'description', None), request.json.get('diagramJson', None), current_user['userName'], datetime.datetime.now()))
+        tree_cache.invalidate('gy_flow')
 
-        #数据库操作
-        pg_helper = PgHelper()
-        pg_helper.execute_sql(sql_string, sql_tuple)
+        #批量插入流程图节点
+        pg_helper.bulk_insert('gy_flow_node', ('guid', 'node_name', 'next_node_guid', 'flow_guid'),
+                              [(x['guid'], x['nodeName'], x['nextNodeGuid'], flow_info.get('guid', None)) for x in request.json.get('nodes', None)])
 
         return jsonify({}), 200
 
@@ -440,20 +614,16 @@ def save_flow_diagram():
               description: 异常更加详细的信息，包括异常的位置
     """
     try:
-        sql_tuple = ()
+        pg_helper = PgHelper()
 
         #更新流程图、删除旧的流程图节点
-        sql_string = "update gy_flow set flow_json=%s where guid=%s;delete from gy_flow_node where flow_guid=%s;"
-        sql_tuple = sql_tuple + (request.json.get('diagramJson', None), request.json.get('guid', None), request.json.get('guid', None))
+        pg_helper.execute_sql("update gy_flow set flow_json=%s where guid=%s;delete from gy_flow_node where flow_guid=%s;",
+                              (request.json.get('diagramJson', None), request.json.get('guid', None), request.json.get('guid', None)))
 
-        #插入节点的语句，如果节点存在仅仅更新相应的信息
-        for x in request.json.get('nodes', None):
-            sql_string = sql_string + 'insert into gy_flow_node(guid,node_name,next_node_guid,flow_guid) values(%s,%s,%s,%s);'
-            sql_tuple = sql_tuple + (x['guid'], x['nodeName'], x['nextNodeGuid'], request.json.get('guid', None))
-
-        #数据库操作
-        pg_helper = PgHelper()
-        pg_helper.execute_sql(sql_string, sql_tuple)
+        #批量插入流程图节点
+        pg_helper.bulk_insert(
+            'gy_flow_node', ('guid', 'node_name', 'next_node_guid', 'flow_guid'),
+            [(x['guid'], x['nodeName'], x['nextNodeGuid'], request.json.get('guid', None)) for x in request.json.get('nodes', None)])
 
         return jsonify({}), 200
 
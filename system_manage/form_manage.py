@@ -1,4 +1,4 @@
-"""表单管理模块,包括读取所有表单;添加表单;编辑表单信息;删除表单;
+"""表单管理模块,包括读取所有表单;分页读取表单树的子节点;添加表单;编辑表单信息;删除表单;删除、移动表单子树;
    读取表单字段;添加字段;删除字段;修改字段;
 """
 import traceback
@@ -7,6 +7,10 @@ import datetime
 from flask import (jsonify, request)
 from flask_jwt_extended import (jwt_required, get_jwt_identity)
 
+from toolbox import (tree_cache, tree_path)
+from toolbox.async_postgresql_helper import AsyncPgHelper
+from toolbox.conditional_request import conditional
+from toolbox.json_response import encoded_jsonify
 from toolbox.postgresql_helper import PgHelper
 from toolbox.user_log import logit
 
@@ -15,7 +19,8 @@ from .blue_print import system_manage_api
 
 @system_manage_api.route('/form_manage/all_forms', methods=('get',))
 @jwt_required()
-def all_forms():
+@conditional(('gy_form',))
+async def all_forms():
     """所有的表单项信息
     获取系统的所有表单项信息，仅名称和描述
     不包括表单设计
@@ -69,22 +74,107 @@ def all_forms():
               description: 异常更加详细的信息，包括异常的位置
     """
     try:
-        pg_helper = PgHelper()
-        records = pg_helper.query_datatable('''with recursive cte as
-                                                (
-                                                select guid, name, description,create_user as "createUser",to_char(create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",is_leaf as "isLeaf",name::text as "treeName",parent_guid as "parentGuid"
-                                                from gy_form where parent_guid = 'e6e9ce2a-e960-4349-b5c0-866cb41d3037'
-                                                union all
-                                                select
-                                                origin.guid, origin.name, origin.description,origin.create_user as "createUser",to_char(origin.create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",origin.is_leaf as "isLeaf",
-                                                cte."treeName" || '~' || origin.name,origin.parent_guid as "parentGuid"
-                                                from cte,gy_form origin 
-                                                where origin.parent_guid = cte.guid
-                                                )
-                                                select  guid, name, description,"createUser","createTime","isLeaf","treeName","parentGuid"
-                                                from cte;''')
-
-        return jsonify({"formData": [dict(x.items()) for x in records]}), 200
+        pg_helper = AsyncPgHelper()
+        records_json = await tree_cache.load_async(
+            'gy_form', ('gy_form',), lambda: pg_helper.query_json('''select guid, name, description,create_user as "createUser",
+                                                to_char(create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",is_leaf as "isLeaf",
+                                                array_to_string(tree_names, '~') as "treeName",parent_guid as "parentGuid"
+                                                from gy_form where tree_path is not null order by cardinality(tree_path);'''))
+
+        return encoded_jsonify(formData=records_json), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/form_manage/form_children', methods=('post',))
+@jwt_required()
+async def form_children():
+    """表单树的子节点
+    分页获取表单树中一个节点的直接子节点，用于树形控件展开节点时按需加载，
+    每个子节点包括子节点数和是否有子节点
+    ---
+    tags:
+      - system_manage_api/form_manage
+    parameters:
+      - in: body
+        name: parentGuid
+        type: string
+        required: false
+        description: 上级节点的唯一标识，默认为根节点
+      - in: body
+        name: startRow
+        type: integer
+        required: false
+        description: 分页的起始行，默认为0
+      - in: body
+        name: endRow
+        type: integer
+        required: false
+        description: 分页的结束行，默认为起始行之后的100行，每页最多1000行
+    responses:
+      200:
+        description: 子节点信息，数组类型
+        schema:
+          properties:
+            formData:
+              type: array
+              description: 子节点数组
+              items:
+                type: object
+                properties:
+                  guid:
+                    type: string
+                    description: 表单的唯一标识符
+                  name:
+                    type: string
+                    description: 表单名称
+                  description:
+                    type: string
+                    description: 描述
+                  createUser:
+                    type: string
+                    description: 表单创建者
+                  createTime:
+                    type: string
+                    description: 表单创建时间
+                  isLeaf:
+                    type: boolean
+                    description: 是否是叶节点，即是表单还是表单类别
+                  treeName:
+                    type: string
+                    description: 表单在树结构中的名称，使用~连接树层次名称
+                  parentGuid:
+                    type: string
+                    description: 父类型的唯一标识
+                  childCount:
+                    type: integer
+                    description: 子节点数
+                  hasChildren:
+                    type: boolean
+                    description: 是否有子节点
+            totalCount:
+              type: integer
+              description: 上级节点的子节点总数
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = AsyncPgHelper()
+        records, total_count = await tree_path.query_children(
+            pg_helper, 'gy_form', '''A.guid, A.name, A.description,
+                A.create_user as "createUser",to_char(A.create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",A.is_leaf as "isLeaf",
+                array_to_string(A.tree_names, '~') as "treeName",A.parent_guid as "parentGuid"''', request.json)
+
+        return jsonify({"formData": records, "totalCount": total_count}), 200
 
     except Exception as exception:
         return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
@@ -164,6 +254,7 @@ def add_form():
                                  VALUES(%s, %s, %s, %s, %s, %s, %s);''',
             (request_param.get('guid', None), request_param.get('name', None), request_param.get('description', None), current_user['userName'],
              current_time, request_param.get('parentGuid', None), request_param.get('isLeaf', None)))
+        tree_cache.invalidate('gy_form')
 
         return jsonify({'createUser': current_user['userName'], 'createTime': current_time.strftime("%Y-%m-%d %H:%M:%S")}), 200
 
@@ -243,6 +334,7 @@ def edit_form():
         pg_helper.execute_sql('''update gy_form set name=%s,description=%s,create_user=%s,create_time=%s,parent_guid=%s where guid=%s''',
                               (request_param.get('name', None), request_param.get('description', None), current_user['userName'], current_time,
                                request_param.get('parentGuid', None), request_param.get('guid', None)))
+        tree_cache.invalidate('gy_form')
 
         return jsonify({'createUser': current_user['userName'], 'createTime': current_time.strftime("%Y-%m-%d %H:%M:%S")}), 200
 
@@ -282,6 +374,92 @@ def delete_form():
     try:
         pg_helper = PgHelper()
         pg_helper.execute_sql('''delete from gy_form where guid=%s''', (request.json.get('guid', None),))
+        tree_cache.invalidate('gy_form')
+
+        return jsonify({}), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/form_manage/delete_form_subtree', methods=('post',))
+@jwt_required()
+@logit()
+def delete_form_subtree():
+    """删除表单子树
+    删除表单或表单类别及其全部下级表单及表单字段，在一条语句中删除整个子树
+    ---
+    tags:
+      - system_manage_api/form_manage
+    parameters:
+      - in: body
+        name: guid
+        type: string
+        required: true
+        description: 子树根节点的guid
+    responses:
+      200:
+        description: 空，不返回有效数据
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = PgHelper()
+        tree_path.delete_subtree(pg_helper, 'gy_form', request.json.get('guid', None))
+        tree_cache.invalidate('gy_form')
+
+        return jsonify({}), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/form_manage/move_form', methods=('post',))
+@jwt_required()
+@logit()
+def move_form():
+    """移动表单子树
+    将表单或表单类别及其全部下级表单移动到新的上级类别下，新的上级类别不能是自身或者下级
+    ---
+    tags:
+      - system_manage_api/form_manage
+    parameters:
+      - in: body
+        name: guid
+        type: string
+        required: true
+        description: 子树根节点的guid
+      - in: body
+        name: parentGuid
+        type: string
+        required: false
+        description: 新的上级类别的guid，为空时移动到第一级
+    responses:
+      200:
+        description: 空，不返回有效数据
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = PgHelper()
+        tree_path.move_subtree(pg_helper, 'gy_form', request.json.get('guid', None), request.json.get('parentGuid', None))
+        tree_cache.invalidate('gy_form')
 
         return jsonify({}), 200
 
@@ -291,7 +469,7 @@ def delete_form():
 
 @system_manage_api.route('/form_manage/all_fields', methods=('post',))
 @jwt_required()
-def all_fields():
+async def all_fields():
     """特定表单的字段信息
     获取特定表单的所有字段信息
     ---
@@ -350,8 +528,8 @@ def all_fields():
               description: 异常更加详细的信息，包括异常的位置
     """
     try:
-        pg_helper = PgHelper()
-        records = pg_helper.query_datatable(
+        pg_helper = AsyncPgHelper()
+        records = await pg_helper.query_datatable(
             '''select row_number() over(order by id) AS id,guid,
                                                field_name as name,field_type as type,field_group as group,control_type as controltype,
                                                select_source as selectsource, order_id as orderid,field_label as label, 'false'::boolean as edit
@@ -1,4 +1,4 @@
-"""地理处理模型管理模块,包括读取所有地理处理模型;添加地理处理模型;编辑地理处理模型信息;删除地理处理模型;
+"""地理处理模型管理模块,包括读取所有地理处理模型;分页读取地理处理模型树的子节点;添加地理处理模型;编辑地理处理模型信息;删除地理处理模型;删除、移动地理处理模型子树;
    读取地理处理模型设计图;地理处理模型设计保存;地理处理模型运行;
 """
 import traceback
@@ -8,16 +8,20 @@ import datetime
 from flask import (jsonify, request)
 from flask_jwt_extended import (jwt_required, get_jwt_identity)
 
+from toolbox.async_postgresql_helper import AsyncPgHelper
+from toolbox.conditional_request import conditional
+from toolbox.json_response import encoded_jsonify
 from toolbox.postgresql_helper import PgHelper
 from toolbox.user_log import logit
-from toolbox import geoprocessing_algorithm
+from toolbox import (geoprocessing_algorithm, tree_cache, tree_path)
 
 from .blue_print import system_manage_api
 
 
 @system_manage_api.route('/geoprocessing_model/all_geoprocessing_model', methods=('get',))
 @jwt_required()
-def all_geoprocessing_model():
+@conditional(('gy_geoprocessing_model',))
+async def all_geoprocessing_model():
     """所有的算法模型信息
     获取系统的所有算法模型项信息，仅名称和描述
     不包括模型设计
@@ -71,22 +75,107 @@ def all_geoprocessing_model():
               description: 异常更加详细的信息，包括异常的位置
     """
     try:
-        pg_helper = PgHelper()
-        records = pg_helper.query_datatable('''with recursive cte as
-                                                (
-                                                select guid, name, description,create_user as "createUser",to_char(create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",is_leaf as "isLeaf",name::text as "treeName",parent_guid as "parentGuid"
-                                                from gy_geoprocessing_model where parent_guid = '99fb71e8-a794-47c2-a9c6-dc0a6e36248f'
-                                                union all
-                                                select
-                                                origin.guid, origin.name, origin.description,origin.create_user as "createUser",to_char(origin.create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",origin.is_leaf as "isLeaf",
-                                                cte."treeName" || '~' || origin.name,origin.parent_guid as "parentGuid"
-                                                from cte,gy_geoprocessing_model origin 
-                                                where origin.parent_guid = cte.guid
-                                                )
-                                                select  guid, name, description,"createUser","createTime","isLeaf","treeName","parentGuid"
-                                                from cte;''')
+        pg_helper = AsyncPgHelper()
+        records_json = await tree_cache.load_async(
+            'gy_geoprocessing_model', ('gy_geoprocessing_model',), lambda: pg_helper.query_json('''select guid, name, description,
+                                                create_user as "createUser",to_char(create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",is_leaf as "isLeaf",
+                                                array_to_string(tree_names, '~') as "treeName",parent_guid as "parentGuid"
+                                                from gy_geoprocessing_model where tree_path is not null order by cardinality(tree_path);'''))
 
-        return jsonify({"geoprocessingModelData": [dict(x.items()) for x in records]}), 200
+        return encoded_jsonify(geoprocessingModelData=records_json), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/geoprocessing_model/geoprocessing_model_children', methods=('post',))
+@jwt_required()
+async def geoprocessing_model_children():
+    """地理处理模型树的子节点
+    分页获取地理处理模型树中一个节点的直接子节点，用于树形控件展开节点时按需加载，
+    每个子节点包括子节点数和是否有子节点
+    ---
+    tags:
+      - system_manage_api/geoprocessing_model
+    parameters:
+      - in: body
+        name: parentGuid
+        type: string
+        required: false
+        description: 上级节点的唯一标识，默认为根节点
+      - in: body
+        name: startRow
+        type: integer
+        required: false
+        description: 分页的起始行，默认为0
+      - in: body
+        name: endRow
+        type: integer
+        required: false
+        description: 分页的结束行，默认为起始行之后的100行，每页最多1000行
+    responses:
+      200:
+        description: 子节点信息，数组类型
+        schema:
+          properties:
+            geoprocessingModelData:
+              type: array
+              description: 子节点数组
+              items:
+                type: object
+                properties:
+                  guid:
+                    type: string
+                    description: 算法模型的唯一标识符
+                  name:
+                    type: string
+                    description: 算法模型名称
+                  description:
+                    type: string
+                    description: 描述
+                  createUser:
+                    type: string
+                    description: 算法模型创建者
+                  createTime:
+                    type: string
+                    description: 算法模型创建时间
+                  isLeaf:
+                    type: boolean
+                    description: 是否是叶节点，即是算法模型还是算法模型类别
+                  treeName:
+                    type: string
+                    description: 算法模型在树结构中的名称，使用~连接树层次名称
+                  parentGuid:
+                    type: string
+                    description: 父类型的唯一标识
+                  childCount:
+                    type: integer
+                    description: 子节点数
+                  hasChildren:
+                    type: boolean
+                    description: 是否有子节点
+            totalCount:
+              type: integer
+              description: 上级节点的子节点总数
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = AsyncPgHelper()
+        records, total_count = await tree_path.query_children(
+            pg_helper, 'gy_geoprocessing_model', '''A.guid, A.name, A.description,
+                A.create_user as "createUser",to_char(A.create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",A.is_leaf as "isLeaf",
+                array_to_string(A.tree_names, '~') as "treeName",A.parent_guid as "parentGuid"''', request.json)
+
+        return jsonify({"geoprocessingModelData": records, "totalCount": total_count}), 200
 
     except Exception as exception:
         return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
@@ -166,6 +255,7 @@ def add_geoprocessing_model():
                VALUES(%s, %s, %s, %s, %s, %s, %s);''',
             (request_param.get('guid', None), request_param.get('name', None), request_param.get('description', None), current_user['userName'],
              current_time, request_param.get('parentGuid', None), request_param.get('isLeaf', None)))
+        tree_cache.invalidate('gy_geoprocessing_model')
 
         return jsonify({'createUser': current_user['userName'], 'createTime': current_time.strftime("%Y-%m-%d %H:%M:%S")}), 200
 
@@ -246,6 +336,7 @@ def edit_geoprocessing_model():
             '''update gy_geoprocessing_model set name=%s,description=%s,create_user=%s,create_time=%s,parent_guid=%s where guid=%s''',
             (request_param.get('name', None), request_param.get(
                 'description', None), current_user['userName'], current_time, request_param.get('parentGuid', None), request_param.get('guid', None)))
+        tree_cache.invalidate('gy_geoprocessing_model')
 
         return jsonify({'createUser': current_user['userName'], 'createTime': current_time.strftime("%Y-%m-%d %H:%M:%S")}), 200
 
@@ -285,6 +376,92 @@ def delete_geoprocessing_model():
     try:
         pg_helper = PgHelper()
         pg_helper.execute_sql('''delete from gy_geoprocessing_model where guid=%s''', (request.json.get('guid', None),))
+        tree_cache.invalidate('gy_geoprocessing_model')
+
+        return jsonify({}), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/geoprocessing_model/delete_geoprocessing_model_subtree', methods=('post',))
+@jwt_required()
+@logit()
+def delete_geoprocessing_model_subtree():
+    """删除地理处理模型子树
+    删除地理处理模型或地理处理模型类别及其全部下级地理处理模型及模型节点，在一条语句中删除整个子树
+    ---
+    tags:
+      - system_manage_api/geoprocessing_model
+    parameters:
+      - in: body
+        name: guid
+        type: string
+        required: true
+        description: 子树根节点的guid
+    responses:
+      200:
+        description: 空，不返回有效数据
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = PgHelper()
+        tree_path.delete_subtree(pg_helper, 'gy_geoprocessing_model', request.json.get('guid', None))
+        tree_cache.invalidate('gy_geoprocessing_model')
+
+        return jsonify({}), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/geoprocessing_model/move_geoprocessing_model', methods=('post',))
+@jwt_required()
+@logit()
+def move_geoprocessing_model():
+    """移动地理处理模型子树
+    将地理处理模型或地理处理模型类别及其全部下级地理处理模型移动到新的上级类别下，新的上级类别不能是自身或者下级
+    ---
+    tags:
+      - system_manage_api/geoprocessing_model
+    parameters:
+      - in: body
+        name: guid
+        type: string
+        required: true
+        description: 子树根节点的guid
+      - in: body
+        name: parentGuid
+        type: string
+        required: false
+        description: 新的上级类别的guid，为空时移动到第一级
+    responses:
+      200:
+        description: 空，不返回有效数据
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = PgHelper()
+        tree_path.move_subtree(pg_helper, 'gy_geoprocessing_model', request.json.get('guid', None), request.json.get('parentGuid', None))
+        tree_cache.invalidate('gy_geoprocessing_model')
 
         return jsonify({}), 200
 
@@ -294,7 +471,7 @@ def delete_geoprocessing_model():
 
 @system_manage_api.route('/geoprocessing_model/geoprocessing_model_stencils', methods=('get',))
 @jwt_required()
-def geoprocessing_model_stencils():
+async def geoprocessing_model_stencils():
     """获取自定义算法包的函数模板
     获取自定义的算法包中各个模块名称、函数的参数、返回值等信息
     用于算法模型的流程图调用
@@ -326,7 +503,7 @@ def geoprocessing_model_stencils():
     try:
         module_annotations = {}
         function_annotations = {}
-        pg_helper = PgHelper()
+        pg_helper = AsyncPgHelper()
         #获取注册的空间数据
 
         #循环包下所有的模块，即空间运算的算法
@@ -340,7 +517,7 @@ def geoprocessing_model_stencils():
                         function_annotations[module_name].append(function_object.__annotations__)
 
         #获取已有的地理处理模型
-        records = pg_helper.query_datatable('''select guid,name,'MODEL' as category  from gy_geoprocessing_model''')
+        records = await pg_helper.query_datatable('''select guid,name,'MODEL' as category  from gy_geoprocessing_model''')
 
         return jsonify({"geoprocessingModelData": [dict(x.items()) for x in records]}), 200
 
@@ -430,25 +607,21 @@ def save_geoprocessing_model_diagram():
               description: 异常更加详细的信息，包括异常的位置
     """
     try:
-        sql_tuple = ()
+        pg_helper = PgHelper()
 
         #更新流程图、删除旧的算法图节点
-        sql_string = '''update gy_geoprocessing_model set diagram=%s where guid=%s;
-                      delete from gy_geoprocessing_model_node where geoprocessing_model_guid=%s;'''
-
-        sql_tuple = sql_tuple + (request.json.get('diagram_json', None), request.json.get('guid', None), request.json.get('guid', None))
-
-        #插入节点的语句，如果节点存在仅仅更新相应的信息
-        for x in request.json.get('nodes', None)["parameterArray"]:
-            sql_string = sql_string + '''insert into gy_geoprocessing_model_node(guid,module_name,function_name,parameter_name,from_module_name,
-                                                                       from_function_name,from_name,from_type,function_name_zh_cn,parameter_name_zh_cn,geoprocessing_model_guid)
-                                                                values(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s);'''
-            sql_tuple = sql_tuple + (x['guid'], x['moduleName'], x['functionName'], x['name'], x['fromModuleName'], x['fromFunctionName'],
-                                     x['fromName'], x['fromType'], x['functionNameZhCn'], x['nameZhCn'], request.json.get('guid', None))
-
-        #数据库操作
-        pg_helper = PgHelper()
-        pg_helper.execute_sql(sql_string, sql_tuple)
+        pg_helper.execute_sql(
+            '''update gy_geoprocessing_model set diagram=%s where guid=%s;
+               delete from gy_geoprocessing_model_node where geoprocessing_model_guid=%s;''',
+            (request.json.get('diagram_json', None), request.json.get('guid', None), request.json.get('guid', None)))
+
+        #批量插入算法图节点
+        pg_helper.bulk_insert('gy_geoprocessing_model_node',
+                              ('guid', 'module_name', 'function_name', 'parameter_name', 'from_module_name', 'from_function_name', 'from_name',
+                               'from_type', 'function_name_zh_cn', 'parameter_name_zh_cn', 'geoprocessing_model_guid'),
+                              [(x['guid'], x['moduleName'], x['functionName'], x['name'], x['fromModuleName'], x['fromFunctionName'], x['fromName'],
+                                x['fromType'], x['functionNameZhCn'], x['nameZhCn'], request.json.get('guid', None))
+                               for x in request.json.get('nodes', None)["parameterArray"]])
 
         return jsonify({}), 200
 
@@ -1,18 +1,158 @@
-""" 日志管理模块,包括分页获取日志记录;
+""" 日志管理模块,包括分页获取日志记录(可按照事件时间范围查询,只扫描范围内的日志分区;检索使用三元组索引;
+    记录总数使用计数触发器维护的记录数、缓存的精确值或者估计值),日志记录的流式导出(CSV、NDJSON,可选gzip压缩),
+    查询汇总表的活动统计(按小时、天、周、月和用户、模块、函数汇总的操作次数),以及获取日志中引用的大字段内容;
 """
+import asyncio
+import datetime
+import itertools
 import traceback
 
-from flask import (jsonify, request)
+from flask import (current_app, jsonify, request)
 from flask_jwt_extended import jwt_required
 
+from toolbox import (keyset_pagination, log_payload, log_search, row_count, stream_export)
+from toolbox.async_postgresql_helper import AsyncPgHelper
+from toolbox.json_response import encoded_jsonify
 from toolbox.postgresql_helper import PgHelper
+from toolbox.user_log import logit
 
 from .blue_print import system_manage_api
 
+# 日志表格允许排序的列,ag-grid的列标识(colId)与数据库字段的对应关系
+LOG_SORT_COLUMNS = {
+    'id': 'id',
+    'userName': 'user_name',
+    'user_name': 'user_name',
+    'eventDescription': 'event_description',
+    'event_description': 'event_description',
+    'eventTime': 'event_time',
+    'event_time': 'event_time'
+}
+
+# 没有排序信息时按照事件时间从新到旧排序,使用(event_time, id)索引
+LOG_DEFAULT_SORT = (('event_time', 'desc'),)
+
+# 活动统计的时间粒度和分组,分组的标识与字段(用户按照用户标识分组,返回最近的用户名)
+ROLLUP_INTERVALS = ('hour', 'day', 'week', 'month')
+ROLLUP_GROUPS = {
+    'userName': ('user_guid as "userGuid", max(user_name) as "userName"', 'user_guid'),
+    'moduleName': ('module_name as "moduleName"', 'module_name'),
+    'functionName': ('function_name as "functionName"', 'function_name')
+}
+
+# 导出的字段
+LOG_EXPORT_COLUMNS = ('id', 'userGuid', 'userName', 'eventDescription', 'paramJson', 'eventTime')
+
+
+def event_time_conditions(start_time, end_time, column='event_time'):
+    """事件时间范围的查询条件,时间解析后以常量写入语句,执行计划生成时即可排除范围外的日志分区
+    参数：
+       start_time：起始时间(包括),格式为YYYY-MM-DD或YYYY-MM-DD hh:mm:ss,为空时不限制
+       end_time：结束时间(不包括),格式同start_time,为空时不限制
+       column：时间字段,汇总表为bucket_time
+    返回值：
+       查询条件列表
+    """
+    condition_list = []
+    for time_string, operator in ((start_time, '>='), (end_time, '<')):
+        if not time_string:
+            continue
+        time_format = '%Y-%m-%d %H:%M:%S' if ' ' in time_string.strip() else '%Y-%m-%d'
+        event_time = datetime.datetime.strptime(time_string.strip(), time_format)
+        condition_list.append(f"{column} {operator} '{event_time:%Y-%m-%d %H:%M:%S}'::timestamp")
+    return condition_list
+
+
+def log_where_cause(request_json):
+    """日志查询的检索条件,包括事件时间范围和检索文本
+    参数：
+       request_json：请求参数
+    返回值：
+       (检索条件, 参数列表),没有检索条件时为("", [])
+    """
+    where_list = event_time_conditions(request_json.get('startTime', None), request_json.get('endTime', None))
+    param_list = []
+    search_text = request_json.get('searchText', None)
+    if not (search_text is None or len(search_text) == 0):
+        search_cause, param_list = log_search.search_condition(
+            search_text, current_app.config.get('PG_LOG_SEARCH_PARAM_KEYS', log_search.DEFAULT_SEARCH_PARAM_KEYS))
+        where_list.append(search_cause)
+    return (" where " + " and ".join(where_list) if where_list else ""), param_list
+
+
+def log_page_sql(sorts, where_cause, where_params, key_values, request_params):
+    """日志分页查询语句,返回一条记录:本页记录的JSON数组(rowData)、最后一条记录的排序字段值(lastKey)和本页记录数(pageCount)
+    参数：
+       sorts：排序字段列表
+       where_cause：检索条件
+       where_params：检索条件的参数列表
+       key_values：上一页最后一条记录的排序字段值,为空时使用OFFSET分页
+       request_params：ag-grid分页请求参数,包括起始行startRow和结束行endRow
+    返回值：
+       (SQL语句, 参数元组)
+    """
+    order_cause = keyset_pagination.order_clause(sorts)
+    start_row = request_params['startRow']
+    limit_count = request_params['endRow'] - start_row
+    # row_number在OFFSET之前计算,OFFSET分页时已经是记录的序号;键集分页时从起始行开始编号
+    param_list = [0] + where_params
+    offset_count = start_row
+    if isinstance(key_values, list) and len(key_values) == len(sorts):
+        keyset_cause, keyset_params = keyset_pagination.keyset_condition(sorts, key_values)
+        where_cause = (where_cause + " and " if where_cause else " where ") + keyset_cause
+        param_list = [start_row] + where_params + keyset_params
+        offset_count = 0
+
+    return '''select coalesce(json_agg(json_build_object('id', pg_row, 'userName', "userName", 'eventDescription', "eventDescription",
+                                                     'eventTime', "eventTime") order by pg_row), '[]')::text as "rowData",
+                    (array_agg(pg_key order by pg_row desc))[1] as "lastKey", count(*) as "pageCount"
+             from (select %s + row_number() over(''' + order_cause + ''') AS pg_row, user_name as "userName",
+                          event_description as "eventDescription", to_char(event_time,'YYYY-MM-DD hh24:mi:ss') as "eventTime",
+                          json_build_array(''' + ",".join(x[0] for x in sorts) + ''') as pg_key
+                   from gy_log''' + where_cause + order_cause + " limit " + str(limit_count) + " OFFSET " + str(offset_count) + ") pg_page", tuple(
+        param_list)
+
+
+def rollup_sql(request_json):
+    """活动统计的查询语句,查询汇总表gy_log_rollup
+    参数：
+       request_json：请求参数,包括时间范围、时间粒度、分组和过滤条件
+    返回值：
+       (SQL语句, 参数元组)
+    """
+    interval = request_json.get('interval', None)
+    if interval and interval not in ROLLUP_INTERVALS:
+        raise ValueError(f'unsupported interval: {interval}')
+    group_by = request_json.get('groupBy', None) or []
+    for group_item in group_by:
+        if group_item not in ROLLUP_GROUPS:
+            raise ValueError(f'unsupported group: {group_item}')
+
+    select_list = [f"to_char(date_trunc('{interval}', bucket_time), 'YYYY-MM-DD hh24:mi:ss') as \"bucketTime\""] if interval else []
+    group_list = [f"date_trunc('{interval}', bucket_time)"] if interval else []
+    for group_item in dict.fromkeys(group_by):
+        select_list.append(ROLLUP_GROUPS[group_item][0])
+        group_list.append(ROLLUP_GROUPS[group_item][1])
+    select_list.append('sum(event_count)::bigint as "eventCount"')
+
+    where_list = event_time_conditions(request_json.get('startTime', None), request_json.get('endTime', None), 'bucket_time')
+    param_list = []
+    for key, column in (('userGuid', 'user_guid'), ('moduleName', 'module_name'), ('functionName', 'function_name')):
+        if request_json.get(key, None) is not None:
+            where_list.append(f'{column} = %s')
+            param_list.append(request_json[key])
+
+    sql_string = 'select ' + ','.join(select_list) + ' from gy_log_rollup' + (' where ' + ' and '.join(where_list) if where_list else '')
+    if group_list:
+        sql_string += ' group by ' + ','.join(group_list)
+    # 按时间先后排序,同一时间内按照操作次数从多到少排序
+    sql_string += ' order by ' + ('1,' if interval else '') + '"eventCount" desc'
+    return sql_string, tuple(param_list)
+
 
 @system_manage_api.route('/log_manage/user_log_server_side_data', methods=('post',))
 @jwt_required()
-def user_log_server_side_data():
+async def user_log_server_side_data():
     """用户日志记录，后台分页显示获取
     获取指定分页的用户日志记录
     ---
@@ -23,12 +163,32 @@ def user_log_server_side_data():
         name: totalCount
         type: integer
         required: true
-        description: 用户日志记录总数
+        description: 用户日志记录总数,为空或者countExact为false(估计值)时重新获取
+      - in: body
+        name: countExact
+        type: boolean
+        required: false
+        description: 上一次返回的countExact,记录总数为估计值时每次分页重新获取
       - in: body
         name: searchText
         type: string
         required: true
         description: 全局搜索字符串
+      - in: body
+        name: startTime
+        type: string
+        required: false
+        description: 事件时间的起始时间(包括),格式为YYYY-MM-DD或YYYY-MM-DD hh:mm:ss,只查询该时间范围所在的日志分区
+      - in: body
+        name: endTime
+        type: string
+        required: false
+        description: 事件时间的结束时间(不包括),格式同startTime
+      - in: body
+        name: cursor
+        type: string
+        required: false
+        description: 上一页返回的游标(nextCursor),与起始行、排序和检索条件一致时使用键集分页,查询时间与页码无关;否则使用OFFSET分页
       - in: body
         name: requestParams
         type: object
@@ -88,6 +248,12 @@ def user_log_server_side_data():
             rowCount:
               type: integer
               description: 用户日志记录总数
+            countExact:
+              type: boolean
+              description: 记录总数是否为精确值,false时为统计信息或者执行计划的估计值
+            nextCursor:
+              type: string
+              description: 下一页的游标,请求下一页(startRow为本页的endRow)时传回,没有下一页时为空
             rowData:
               type: array
               description: 分页中当前页的数据
@@ -118,37 +284,244 @@ def user_log_server_side_data():
               description: 异常更加详细的信息，包括异常的位置
     """
     try:
-        pg_helper = PgHelper()
+        pg_helper = AsyncPgHelper()
         total_count = request.json.get('totalCount', None)
-        search_text = request.json.get('searchText', None)
+        count_exact = request.json.get('countExact', True) is not False
         request_params = request.json.get('requestParams', None)
 
-        # 构造查询和排序条件
-        limit_count = request_params['endRow'] - request_params['startRow']
-        offset_count = request_params['startRow']
-        where_cause = ""
-        order_cause = ""
+        # 构造参数化的检索条件和排序条件
+        where_cause, where_params = log_where_cause(request.json)
 
-        if not (search_text is None or len(search_text) == 0):
-            where_cause = " where position('" + search_text + "' in user_name) >0" + " or " + " \
-                           position('" + search_text + "' in event_description) >0"
+        # 排序字段以id结尾,保证顺序确定;游标与本次请求一致时查询游标之后的记录,否则使用OFFSET
+        sorts = keyset_pagination.sort_list(request_params['sortModel'], LOG_SORT_COLUMNS, LOG_DEFAULT_SORT)
+        signature = keyset_pagination.query_signature(sorts, where_cause, where_params)
+        key_values = keyset_pagination.decode_cursor(request.json.get('cursor', None), signature, request_params['startRow'])
 
-        if request_params['sortModel']:
-            order_cause = " order by "
-            for sort_item in request_params['sortModel']:
-                order_cause = order_cause + " " + sort_item["colId"] + " " + sort_item["sort"] + " "
+        # 分页查询,同时返回本页最后一条记录的排序字段值,用于生成下一页的游标
+        records_query = pg_helper.query_datatable(*log_page_sql(sorts, where_cause, where_params, key_values, request_params))
+
+        # 如果记录总数为空或者为估计值，与分页查询并发获取记录总数
+        if total_count is None or not count_exact:
+            (total_count, count_exact), (page_record,) = await asyncio.gather(row_count.count_rows(pg_helper, 'gy_log', where_cause, where_params),
+                                                                              records_query)
+        else:
+            (page_record,) = await records_query
+
+        # 本页记录数不足时没有下一页
+        next_cursor = None
+        if page_record['pageCount'] == request_params['endRow'] - request_params['startRow']:
+            next_cursor = keyset_pagination.encode_cursor(signature, request_params['endRow'], page_record['lastKey'])
+
+        return encoded_jsonify(rowCount=total_count, countExact=count_exact, nextCursor=next_cursor,
+                               rowData=page_record['rowData'].encode('UTF-8')), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/log_manage/export_user_log', methods=('post',))
+@jwt_required()
+@logit()
+def export_user_log():
+    """导出用户日志记录
+    按照检索条件和事件时间范围导出用户日志记录,按照事件时间从旧到新排序,流式返回CSV或者NDJSON文件
+    ---
+    tags:
+      - system_manage_api/log_manage
+    parameters:
+      - in: body
+        name: searchText
+        type: string
+        required: false
+        description: 全局搜索字符串,与分页查询相同
+      - in: body
+        name: startTime
+        type: string
+        required: false
+        description: 事件时间的起始时间(包括),格式为YYYY-MM-DD或YYYY-MM-DD hh:mm:ss
+      - in: body
+        name: endTime
+        type: string
+        required: false
+        description: 事件时间的结束时间(不包括),格式同startTime
+      - in: body
+        name: format
+        type: string
+        required: false
+        description: 导出格式,csv(默认)或者ndjson(每行一个JSON对象)
+      - in: body
+        name: gzip
+        type: boolean
+        required: false
+        description: 是否gzip压缩,默认为false
+    responses:
+      200:
+        description: 日志记录文件(附件),字段为id、userGuid、userName、eventDescription、paramJson、eventTime
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        where_cause, where_params = log_where_cause(request.json)
+        export_format = request.json.get('format', None) or 'csv'
+        if export_format not in stream_export.EXPORT_FORMATS:
+            raise ValueError(f'unsupported export format: {export_format}')
+
+        # 独占连接的服务端游标,在响应返回过程中分批读取,响应结束(或客户端断开)时关闭游标、归还连接
+        records = PgHelper(shared=False).query_iterator(
+            '''select id, user_guid as "userGuid", user_name as "userName", event_description as "eventDescription",
+                      param_json as "paramJson", event_time as "eventTime"
+               from gy_log''' + where_cause + ' order by event_time, id', tuple(where_params))
+        # 第一批记录在请求中获取,查询出错时返回错误信息,而不是中断的文件
+        first_record = next(records, None)
+        records = itertools.chain([] if first_record is None else [first_record], records)
+
+        return stream_export.export_response(records,
+                                             LOG_EXPORT_COLUMNS,
+                                             export_format,
+                                             bool(request.json.get('gzip', False)),
+                                             file_name=f'user_log_{datetime.datetime.now():%Y%m%d%H%M%S}')
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/log_manage/user_log_rollup', methods=('post',))
+@jwt_required()
+async def user_log_rollup():
+    """用户操作的活动统计
+    按照时间粒度和用户、模块、函数分组统计用户的操作次数,查询日志写入时累加的汇总表,不聚合日志表
+    ---
+    tags:
+      - system_manage_api/log_manage
+    parameters:
+      - in: body
+        name: startTime
+        type: string
+        required: false
+        description: 起始时间(包括),格式为YYYY-MM-DD或YYYY-MM-DD hh:mm:ss,汇总表按小时记录,时间按小时对齐
+      - in: body
+        name: endTime
+        type: string
+        required: false
+        description: 结束时间(不包括),格式同startTime
+      - in: body
+        name: interval
+        type: string
+        required: false
+        description: 时间粒度,hour、day、week或者month,为空时统计整个时间范围
+      - in: body
+        name: groupBy
+        type: array
+        required: false
+        description: 分组,userName、moduleName、functionName中的一个或多个,为空时只按时间统计
+        items:
+          type: string
+      - in: body
+        name: userGuid
+        type: string
+        required: false
+        description: 只统计该用户的操作
+      - in: body
+        name: moduleName
+        type: string
+        required: false
+        description: 只统计该模块的操作,例如system_manage.flow_manage
+      - in: body
+        name: functionName
+        type: string
+        required: false
+        description: 只统计该函数的操作,例如add_flow
+    responses:
+      200:
+        description: 活动统计,按时间先后排序,同一时间内按照操作次数从多到少排序
+        schema:
+          properties:
+            rowData:
+              type: array
+              description: 统计结果,只包括请求的时间粒度和分组字段
+              items:
+                type: object
+                properties:
+                  bucketTime:
+                    type: string
+                    description: 时间粒度的起始时间
+                  userGuid:
+                    type: string
+                    description: 用户标识
+                  userName:
+                    type: string
+                    description: 用户名
+                  moduleName:
+                    type: string
+                    description: 模块名
+                  functionName:
+                    type: string
+                    description: 函数名
+                  eventCount:
+                    type: integer
+                    description: 操作次数
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        return encoded_jsonify(rowData=await AsyncPgHelper().query_json(*rollup_sql(request.json))), 200
 
-        # 如果记录总数为空，首先获取记录总数
-        if total_count is None:
-            total_count = pg_helper.query_single_value(''' select count(id) from gy_log ''' + where_cause)
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
 
-        # 分页查询
-        records = pg_helper.query_datatable('''select row_number() over(''' + order_cause +
-                                            ''') AS id, user_name as "userName",event_description as "eventDescription",
-            to_char(event_time,'YYYY-MM-DD hh24:mi:ss') as "eventTime" from gy_log''' + where_cause + order_cause + " limit " + str(limit_count) +
-                                            " OFFSET " + str(offset_count))
 
-        return jsonify({"rowCount": total_count, "rowData": [dict(x.items()) for x in records]}), 200
+@system_manage_api.route('/log_manage/user_log_payload', methods=('post',))
+@jwt_required()
+async def user_log_payload():
+    """用户日志的大字段内容
+    获取日志param_json中引用的大字段内容({"$payload": "摘要", "size": 原始字节数})
+    ---
+    tags:
+      - system_manage_api/log_manage
+    parameters:
+      - in: body
+        name: hash
+        type: string
+        required: true
+        description: 大字段内容的摘要,即引用中的$payload
+    responses:
+      200:
+        description: 大字段内容
+        schema:
+          properties:
+            payload:
+              type: object
+              description: 大字段的原始内容(JSON),摘要不存在时为空
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        payload_record = await AsyncPgHelper().query_datatable('select payload from gy_log_payload where hash=%s', (request.json.get('hash', None),))
+        return encoded_jsonify(payload=log_payload.decompress_payload(payload_record[0]['payload']) if payload_record else None), 200
 
     except Exception as exception:
         return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
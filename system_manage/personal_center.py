@@ -5,6 +5,9 @@ import traceback
 from flask import (jsonify, request)
 from flask_jwt_extended import jwt_required
 
+from toolbox import tree_cache
+from toolbox.async_postgresql_helper import AsyncPgHelper
+from toolbox.conditional_request import conditional
 from toolbox.postgresql_helper import PgHelper
 from toolbox.user_log import logit
 
@@ -13,7 +16,8 @@ from .blue_print import system_manage_api
 
 @system_manage_api.route('/personal_center/gender_option', methods=('get',))
 @jwt_required()
-def gender_option():
+@conditional(('gy_gender_config',))
+async def gender_option():
     """性别配置信息
     获取性别的Select控件的选项配置信息
     ---
@@ -48,8 +52,8 @@ def gender_option():
               description: 异常更加详细的信息，包括异常的位置
     """
     try:
-        pg_helper = PgHelper()
-        records = pg_helper.query_datatable('''select code,name from gy_gender_config order by id''')
+        pg_helper = AsyncPgHelper()
+        records = await pg_helper.query_datatable('''select code,name from gy_gender_config order by id''')
 
         return jsonify({"genderOptions": [dict(x.items()) for x in records]}), 200
 
@@ -59,7 +63,8 @@ def gender_option():
 
 @system_manage_api.route('/personal_center/academic_degree_option', methods=('get',))
 @jwt_required()
-def academic_degree_option():
+@conditional(('gy_academic_degree_config',))
+async def academic_degree_option():
     """学位学历配置信息
     获取学位学历Select控件的选项配置信息
     ---
@@ -94,8 +99,8 @@ def academic_degree_option():
               description: 异常更加详细的信息，包括异常的位置
     """
     try:
-        pg_helper = PgHelper()
-        records = pg_helper.query_datatable('''select code,name from gy_academic_degree_config order by id''')
+        pg_helper = AsyncPgHelper()
+        records = await pg_helper.query_datatable('''select code,name from gy_academic_degree_config order by id''')
 
         return jsonify({"academicDegreeOptions": [dict(x.items()) for x in records]}), 200
 
@@ -149,6 +154,7 @@ def user_info_field_save():
         field_value = request.json.get('fieldValue', None)
 
         pg_helper.execute_sql('''update gy_user set ''' + field_name + '''=%s where guid=%s''', (field_value, user_guid))
+        tree_cache.invalidate('gy_user')
 
         return jsonify({}), 200
 
@@ -196,6 +202,7 @@ def update_photo():
         photo_string = request.json.get('photoString', None)
 
         pg_helper.execute_sql('''update gy_user set photo=decode(%s, 'base64') where guid=%s''', (photo_string, user_guid))
+        tree_cache.invalidate('gy_user')
 
         return jsonify({}), 200
 
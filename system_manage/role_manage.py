@@ -1,4 +1,4 @@
-"""角色管理模块,包括读取所有角色;添加角色;编辑角色;删除角色;
+"""角色管理模块,包括读取所有角色;添加角色;编辑角色;删除角色;删除、移动角色子树;
    角色与权限配置;
 """
 import traceback
@@ -6,6 +6,9 @@ import traceback
 from flask import (jsonify, request)
 from flask_jwt_extended import jwt_required
 
+from toolbox import (tree_cache, tree_path)
+from toolbox.async_postgresql_helper import AsyncPgHelper
+from toolbox.conditional_request import conditional
 from toolbox.postgresql_helper import PgHelper
 from toolbox.user_log import logit
 
@@ -14,7 +17,8 @@ from .blue_print import system_manage_api
 
 @system_manage_api.route('/role_manage/all_role', methods=('get',))
 @jwt_required()
-def all_role():
+@conditional(('gy_role',))
+async def all_role():
     """所有的角色信息
     获取系统的所有角色信息，
     用于系统的角色树编辑
@@ -53,8 +57,8 @@ def all_role():
               description: 异常更加详细的信息，包括异常的位置
     """
     try:
-        pg_helper = PgHelper()
-        records = pg_helper.query_datatable('''select id,guid,name,parent_guid,type from gy_role order by id''')
+        pg_helper = AsyncPgHelper()
+        records = await pg_helper.query_datatable('''select id,guid,name,parent_guid,type from gy_role order by id''')
 
         return jsonify({"roleData": [dict(x.items()) for x in records]}), 200
 
@@ -97,6 +101,7 @@ def add_role():
         request_param = request.json.get('role_info', None)
         pg_helper.execute_sql('''INSERT INTO gy_role(guid, name, parent_guid,type) VALUES(%s, %s, %s, %s);''', (request_param.get(
             'guid', None), request_param.get('name', None), request_param.get('parent_guid', None), request_param.get('type', None)))
+        tree_cache.invalidate('gy_role')
 
         return jsonify({}), 200
 
@@ -141,6 +146,7 @@ def edit_role():
         else:
             pg_helper.execute_sql('''update gy_role set name=%s,parent_guid=%s where guid=%s''',
                                   (request_param.get('name', None), request_param.get('parent_guid', None), request_param.get('guid', None)))
+        tree_cache.invalidate('gy_role')
 
         return jsonify({}), 200
 
@@ -180,6 +186,92 @@ def delete_role():
     try:
         pg_helper = PgHelper()
         pg_helper.execute_sql('''delete from gy_role where guid=%s''', (request.json.get('guid', None),))
+        tree_cache.invalidate('gy_role')
+
+        return jsonify({}), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/role_manage/delete_role_subtree', methods=('post',))
+@jwt_required()
+@logit()
+def delete_role_subtree():
+    """删除角色子树
+    删除角色或角色类别及其全部下级角色及角色的权限设置、用户的角色设置，在一条语句中删除整个子树
+    ---
+    tags:
+      - system_manage_api/role_manage
+    parameters:
+      - in: body
+        name: guid
+        type: string
+        required: true
+        description: 子树根节点的guid
+    responses:
+      200:
+        description: 空，不返回有效数据
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = PgHelper()
+        tree_path.delete_subtree(pg_helper, 'gy_role', request.json.get('guid', None))
+        tree_cache.invalidate('gy_role')
+
+        return jsonify({}), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/role_manage/move_role', methods=('post',))
+@jwt_required()
+@logit()
+def move_role():
+    """移动角色子树
+    将角色或角色类别及其全部下级角色移动到新的上级类别下，新的上级类别不能是自身或者下级
+    ---
+    tags:
+      - system_manage_api/role_manage
+    parameters:
+      - in: body
+        name: guid
+        type: string
+        required: true
+        description: 子树根节点的guid
+      - in: body
+        name: parentGuid
+        type: string
+        required: false
+        description: 新的上级类别的guid，为空时移动到第一级
+    responses:
+      200:
+        description: 空，不返回有效数据
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = PgHelper()
+        tree_path.move_subtree(pg_helper, 'gy_role', request.json.get('guid', None), request.json.get('parentGuid', None))
+        tree_cache.invalidate('gy_role')
 
         return jsonify({}), 200
 
@@ -189,7 +281,7 @@ def delete_role():
 
 @system_manage_api.route('/role_manage/role_by_authorize', methods=('post',))
 @jwt_required()
-def role_by_authorize():
+async def role_by_authorize():
     """获取角色对应的权限信息
     获取角色对应的权限信息
     ---
@@ -216,10 +308,12 @@ def role_by_authorize():
               description: 异常更加详细的信息，包括异常的位置
     """
     try:
-        pg_helper = PgHelper()
-        records = pg_helper.query_datatable('''select authorize_guid from gy_role_authorize where role_guid=%s''', (request.json.get('guid', None),))
+        pg_helper = AsyncPgHelper()
+        records = await pg_helper.query_datatable('''select authorize_guid from gy_role_authorize where role_guid=%s''',
+                                                  (request.json.get('guid', None),))
 
-        return jsonify({"roleByAuthorizeArray": records}), 200
+        # 与同步查询返回的行(psycopg2的DictRow序列化为数组)保持相同的格式
+        return jsonify({"roleByAuthorizeArray": [[x['authorize_guid']] for x in records]}), 200
 
     except Exception as exception:
         return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
@@ -260,19 +354,12 @@ def save_role_by_authorize():
               description: 异常更加详细的信息，包括异常的位置
     """
     try:
-        sql_tuple = ()
-
-        sql_string = "delete from gy_role_authorize where role_guid=%s;"
-        sql_tuple = sql_tuple + (request.json.get('guid', None),)
-
-        #构建SQL语句
-        for x in request.json.get('authorize_array', None):
-            sql_string = sql_string + '''insert into gy_role_authorize(role_guid,authorize_guid) values(%s,%s);'''
-            sql_tuple = sql_tuple + (request.json.get('guid', None), x)
-
-        #数据库操作
         pg_helper = PgHelper()
-        pg_helper.execute_sql(sql_string, sql_tuple)
+        pg_helper.execute_sql("delete from gy_role_authorize where role_guid=%s;", (request.json.get('guid', None),))
+
+        #批量插入角色对应的权限
+        pg_helper.bulk_insert('gy_role_authorize', ('role_guid', 'authorize_guid'),
+                              [(request.json.get('guid', None), x) for x in request.json.get('authorize_array', None)])
 
         return jsonify({}), 200
 
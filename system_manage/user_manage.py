@@ -1,11 +1,15 @@
-"""用户管理模块,包括读取所有用户;添加用户;编辑用户信息;删除用户;
+"""用户管理模块,包括读取所有用户;添加用户;编辑用户信息;删除用户;删除、移动机构子树和用户;
    用户与角色配置;
 """
+import asyncio
 import traceback
 
 from flask import (jsonify, request)
 from flask_jwt_extended import jwt_required
 
+from toolbox import (tree_cache, tree_path)
+from toolbox.async_postgresql_helper import AsyncPgHelper
+from toolbox.conditional_request import conditional
 from toolbox.postgresql_helper import PgHelper
 from toolbox.user_log import logit
 
@@ -14,7 +18,8 @@ from .blue_print import system_manage_api
 
 @system_manage_api.route('/user_manage/all_user', methods=('get',))
 @jwt_required()
-def all_user():
+@conditional(('gy_user_institution', 'gy_user'))
+async def all_user():
     """所有的用户信息
     获取系统的所有用户信息，
     用于系统的用户树编辑
@@ -53,11 +58,12 @@ def all_user():
               description: 异常更加详细的信息，包括异常的位置
     """
     try:
-        pg_helper = PgHelper()
-        records_institution = pg_helper.query_datatable(
-            '''select id,guid,name,parent_guid,'false'::boolean as type from gy_user_institution order by id''')
-        records_user = pg_helper.query_datatable(
-            '''select id,guid,user_name as name,institution_guid as parent_guid,'true'::boolean as type from gy_user order by id''')
+        pg_helper = AsyncPgHelper()
+        # 机构和用户的查询相互独立,并发执行
+        records_institution, records_user = await asyncio.gather(
+            pg_helper.query_datatable('''select id,guid,name,parent_guid,'false'::boolean as type from gy_user_institution order by id'''),
+            pg_helper.query_datatable(
+                '''select id,guid,user_name as name,institution_guid as parent_guid,'true'::boolean as type from gy_user order by id'''))
 
         return jsonify({"userData": [dict(x.items()) for x in records_institution] + [dict(x.items()) for x in records_user]}), 200
 
@@ -99,12 +105,16 @@ def add_user():
         pg_helper = PgHelper()
         request_param = request.json.get('user_info', None)
         if request_param.get('type', None):
-            #新添加的人员，默认密码12345
+            #新添加的人员，默认密码12345；锁定所属的机构，机构不能同时被删除
+            if request_param.get('parent_guid', None) is not None:
+                tree_path.lock_node(pg_helper, 'gy_user_institution', request_param.get('parent_guid', None))
             pg_helper.execute_sql('''INSERT INTO gy_user(guid,user_name,institution_guid) VALUES(%s, %s, %s);''',
                                   (request_param.get('guid', None), request_param.get('name', None), request_param.get('parent_guid', None)))
         else:
             pg_helper.execute_sql('''INSERT INTO gy_user_institution(guid, name, parent_guid) VALUES(%s, %s, %s);''',
                                   (request_param.get('guid', None), request_param.get('name', None), request_param.get('parent_guid', None)))
+        tree_cache.invalidate('gy_user_institution')
+        tree_cache.invalidate('gy_user')
 
         return jsonify({}), 200
 
@@ -150,11 +160,14 @@ def edit_user():
                                      update gy_user set user_name=%s where guid=%s''',
                 (request_param.get('name', None), request_param.get('guid', None), request_param.get('name', None), request_param.get('guid', None)))
         else:
+            tree_path.lock_node(pg_helper, 'gy_user_institution', request_param.get('parent_guid', None))
             pg_helper.execute_sql(
                 '''update gy_user_institution set name=%s,parent_guid=%s where guid=%s;
                                      update gy_user set user_name=%s,institution_guid=%s where guid=%s''',
                 (request_param.get('name', None), request_param.get('parent_guid', None), request_param.get(
                     'guid', None), request_param.get('name', None), request_param.get('parent_guid', None), request_param.get('guid', None)))
+        tree_cache.invalidate('gy_user_institution')
+        tree_cache.invalidate('gy_user')
 
         return jsonify({}), 200
 
@@ -195,6 +208,119 @@ def delete_user():
         pg_helper = PgHelper()
         pg_helper.execute_sql('''delete from gy_user where guid=%s;delete from gy_user_institution where guid=%s''',
                               (request.json.get('guid', None), request.json.get('guid', None)))
+        tree_cache.invalidate('gy_user_institution')
+        tree_cache.invalidate('gy_user')
+
+        return jsonify({}), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/user_manage/delete_user_subtree', methods=('post',))
+@jwt_required()
+@logit()
+def delete_user_subtree():
+    """删除机构子树或者用户
+    删除机构及其全部下级机构，在一条语句中删除整个子树；机构或者下级机构中还有用户时不删除，返回异常信息，
+    需要先删除或者移动这些用户，不会一起删除用户；
+    删除用户时删除用户和用户的角色设置
+    ---
+    tags:
+      - system_manage_api/user_manage
+    parameters:
+      - in: body
+        name: guid
+        type: string
+        required: true
+        description: 机构或者用户的guid
+      - in: body
+        name: type
+        type: boolean
+        required: false
+        description: 是否是用户，默认为机构
+    responses:
+      200:
+        description: 空，不返回有效数据
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = PgHelper()
+        if request.json.get('type', None):
+            pg_helper.execute_sql('''delete from gy_user where guid=%s;delete from gy_user_role where user_guid=%s''',
+                                  (request.json.get('guid', None), request.json.get('guid', None)))
+        else:
+            # 机构子树中还有用户时抛出ValueError,不删除
+            tree_path.delete_subtree(pg_helper, 'gy_user_institution', request.json.get('guid', None))
+        tree_cache.invalidate('gy_user_institution')
+        tree_cache.invalidate('gy_user')
+
+        return jsonify({}), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/user_manage/move_user', methods=('post',))
+@jwt_required()
+@logit()
+def move_user():
+    """移动机构子树或者用户
+    将机构及其全部下级机构和用户移动到新的上级机构下，新的上级机构不能是自身或者下级；
+    移动用户时修改用户所属的机构
+    ---
+    tags:
+      - system_manage_api/user_manage
+    parameters:
+      - in: body
+        name: guid
+        type: string
+        required: true
+        description: 机构或者用户的guid
+      - in: body
+        name: parentGuid
+        type: string
+        required: false
+        description: 新的上级机构的guid，为空时移动到第一级
+      - in: body
+        name: type
+        type: boolean
+        required: false
+        description: 是否是用户，默认为机构
+    responses:
+      200:
+        description: 空，不返回有效数据
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = PgHelper()
+        if request.json.get('type', None):
+            if request.json.get('parentGuid', None) is not None:
+                tree_path.lock_node(pg_helper, 'gy_user_institution', request.json.get('parentGuid', None))
+            pg_helper.execute_sql('''update gy_user set institution_guid=%s where guid=%s''',
+                                  (request.json.get('parentGuid', None), request.json.get('guid', None)))
+        else:
+            tree_path.move_subtree(pg_helper, 'gy_user_institution', request.json.get('guid', None), request.json.get('parentGuid', None))
+        tree_cache.invalidate('gy_user_institution')
+        tree_cache.invalidate('gy_user')
 
         return jsonify({}), 200
 
@@ -204,7 +330,7 @@ def delete_user():
 
 @system_manage_api.route('/user_manage/user_by_role', methods=('post',))
 @jwt_required()
-def user_by_role():
+async def user_by_role():
     """获取用户对应的角色信息
     获取用户对应的角色信息
     ---
@@ -231,10 +357,11 @@ def user_by_role():
               description: 异常更加详细的信息，包括异常的位置
     """
     try:
-        pg_helper = PgHelper()
-        records = pg_helper.query_datatable('''select role_guid from gy_user_role where user_guid=%s''', (request.json.get('guid', None),))
+        pg_helper = AsyncPgHelper()
+        records = await pg_helper.query_datatable('''select role_guid from gy_user_role where user_guid=%s''', (request.json.get('guid', None),))
 
-        return jsonify({"userByRoleArray": records}), 200
+        # 与同步查询返回的行(psycopg2的DictRow序列化为数组)保持相同的格式
+        return jsonify({"userByRoleArray": [[x['role_guid']] for x in records]}), 200
 
     except Exception as exception:
         return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
@@ -275,19 +402,12 @@ def save_user_by_role():
               description: 异常更加详细的信息，包括异常的位置
     """
     try:
-        sql_tuple = ()
-
-        sql_string = "delete from gy_user_role where user_guid=%s;"
-        sql_tuple = sql_tuple + (request.json.get('guid', None),)
-
-        #构建SQL语句
-        for x in request.json.get('role_array', None):
-            sql_string = sql_string + '''insert into gy_user_role(user_guid,role_guid) values(%s,%s);'''
-            sql_tuple = sql_tuple + (request.json.get('guid', None), x)
-
-        #数据库操作
         pg_helper = PgHelper()
-        pg_helper.execute_sql(sql_string, sql_tuple)
+        pg_helper.execute_sql("delete from gy_user_role where user_guid=%s;", (request.json.get('guid', None),))
+
+        #批量插入用户对应的角色
+        pg_helper.bulk_insert('gy_user_role', ('user_guid', 'role_guid'),
+                              [(request.json.get('guid', None), x) for x in request.json.get('role_array', None)])
 
         return jsonify({}), 200
 
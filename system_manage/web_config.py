@@ -5,14 +5,16 @@ import traceback
 from flask import (jsonify, request)
 from flask_jwt_extended import jwt_required
 
-from toolbox.postgresql_helper import PgHelper
+from toolbox.async_postgresql_helper import AsyncPgHelper
+from toolbox.conditional_request import conditional
 
 from .blue_print import system_manage_api
 
 
 @system_manage_api.route('/web_config/sidebar_menu', methods=('POST',))
 @jwt_required()
-def sidebar_menu():
+@conditional(('gy_sidebar_menu',))
+async def sidebar_menu():
     """系统的侧边栏菜单
     获取系统的侧边栏菜单，如果存在navnar_menu_guid，
     则为对应navnarMenu菜单下的sidebarMenu
@@ -69,14 +71,14 @@ def sidebar_menu():
               description: 异常更加详细的信息，包括异常的位置
     """
     try:
-        pg_helper = PgHelper()
+        pg_helper = AsyncPgHelper()
         if not request.json.get('navnar_menu_guid', None):
-            records = pg_helper.query_datatable('''select id,guid,path,title,icon,class,badge,badge_class as badgeClass,
+            records = await pg_helper.query_datatable('''select id,guid,path,title,icon,class,badge,badge_class as badgeClass,
                          is_external_link as isExternalLink,parent_guid,array[]::integer[] as submenu
                                                    from gy_sidebar_menu
                                                    order by sort''')
         else:
-            records = pg_helper.query_datatable(
+            records = await pg_helper.query_datatable(
                 '''select id,guid,path,title,icon,class,badge,badge_class as badgeClass,
                           is_external_link as isExternalLink,parent_guid,array[]::integer[] as submenu
                                                    from gy_sidebar_menu
@@ -1,4 +1,4 @@
-"""业务工作流管理模块,包括读取所有业务工作流;添加业务工作流;编辑业务工作流信息;删除业务工作流等;
+"""业务工作流管理模块,包括读取所有业务工作流;分页读取业务工作流树的子节点;添加业务工作流;编辑业务工作流信息;删除业务工作流;删除、移动业务工作流子树等;
 """
 import traceback
 import datetime
@@ -6,6 +6,10 @@ import datetime
 from flask import (jsonify, request)
 from flask_jwt_extended import (jwt_required, get_jwt_identity)
 
+from toolbox import (tree_cache, tree_path)
+from toolbox.async_postgresql_helper import AsyncPgHelper
+from toolbox.conditional_request import conditional
+from toolbox.json_response import encoded_jsonify
 from toolbox.postgresql_helper import PgHelper
 from toolbox.user_log import logit
 
@@ -14,7 +18,8 @@ from .blue_print import system_manage_api
 
 @system_manage_api.route('/workflow_manage/all_workflows', methods=('get',))
 @jwt_required()
-def all_workflows():
+@conditional(('gy_workflow', 'gy_flow', 'gy_form'))
+async def all_workflows():
     """所有的业务工作流信息
     获取系统的所有业务工作流信息，名称、描述、关联的流程、关联的表单
     ---
@@ -79,24 +84,123 @@ def all_workflows():
               description: 异常更加详细的信息，包括异常的位置
     """
     try:
-        pg_helper = PgHelper()
-        records = pg_helper.query_datatable('''with recursive cte as
-                                                (
-                                                select A.guid, A.name, A.description,A.create_user as "createUser",to_char(A.create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",A.is_leaf as "isLeaf",
-                                                  A.name::text as "treeName",A.parent_guid as "parentGuid",A.flow_guid as "flowGuid",A.form_guid as "formGuid",B.name as "flowName",C.name as "formName"
-                                                from gy_workflow A left join gy_flow B on A.flow_guid=B.guid 
-                                                                left join gy_form C on A.form_guid=C.guid where A.parent_guid = '03bb1ba4-0aeb-46d7-a99c-f03bcc6ea0d5' 
-                                                union all
-                                                select origin.guid, origin.name, origin.description,origin.create_user as "createUser",to_char(origin.create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",
-                                                  origin.is_leaf as "isLeaf",cte."treeName" || '~' || origin.name as "treeName",origin.parent_guid as "parentGuid",
-                                                  origin.flow_guid as "flowGuid",origin.form_guid as "formGuid",B.name as "flowName",C.name as "formName"
-                                                from cte,gy_workflow origin left join gy_flow B on origin.flow_guid=B.guid 
-                                                                          left join gy_form C on origin.form_guid=C.guid  where origin.parent_guid = cte.guid
-                                                )
-                                                select guid, name, description,"createUser","createTime","isLeaf","treeName","parentGuid","flowGuid","flowName","formGuid","formName"
-                                                from cte;''')
-
-        return jsonify({"workflowData": [dict(x.items()) for x in records]}), 200
+        pg_helper = AsyncPgHelper()
+        records_json = await tree_cache.load_async(
+            'gy_workflow', ('gy_workflow', 'gy_flow', 'gy_form'), lambda: pg_helper.query_json('''select A.guid, A.name, A.description,
+                                                  A.create_user as "createUser",to_char(A.create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",A.is_leaf as "isLeaf",
+                                                  array_to_string(A.tree_names, '~') as "treeName",A.parent_guid as "parentGuid",A.flow_guid as "flowGuid",B.name as "flowName",A.form_guid as "formGuid",C.name as "formName"
+                                                from gy_workflow A left join gy_flow B on A.flow_guid=B.guid
+                                                                left join gy_form C on A.form_guid=C.guid
+                                                where A.tree_path is not null order by cardinality(A.tree_path);'''))
+
+        return encoded_jsonify(workflowData=records_json), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/workflow_manage/workflow_children', methods=('post',))
+@jwt_required()
+async def workflow_children():
+    """业务工作流树的子节点
+    分页获取业务工作流树中一个节点的直接子节点，用于树形控件展开节点时按需加载，
+    每个子节点包括子节点数和是否有子节点
+    ---
+    tags:
+      - system_manage_api/workflow_manage
+    parameters:
+      - in: body
+        name: parentGuid
+        type: string
+        required: false
+        description: 上级节点的唯一标识，默认为根节点
+      - in: body
+        name: startRow
+        type: integer
+        required: false
+        description: 分页的起始行，默认为0
+      - in: body
+        name: endRow
+        type: integer
+        required: false
+        description: 分页的结束行，默认为起始行之后的100行，每页最多1000行
+    responses:
+      200:
+        description: 子节点信息，数组类型
+        schema:
+          properties:
+            workflowData:
+              type: array
+              description: 子节点数组
+              items:
+                type: object
+                properties:
+                  guid:
+                    type: string
+                    description: 业务工作流的唯一标识符
+                  name:
+                    type: string
+                    description: 业务工作流名称
+                  flowGuid:
+                    type: string
+                    description: 关联的业务工作流的GUID
+                  flowName:
+                    type: string
+                    description: 关联的业务工作流的名称
+                  formGuid:
+                    type: string
+                    description: 关联的表单的GUID
+                  formName:
+                    type: string
+                    description: 关联的表单的名称
+                  description:
+                    type: string
+                    description: 描述
+                  createUser:
+                    type: string
+                    description: 业务工作流创建者
+                  createTime:
+                    type: string
+                    description: 业务工作流创建时间
+                  isLeaf:
+                    type: boolean
+                    description: 是否是叶节点，即是业务工作流还是业务工作流类别
+                  treeName:
+                    type: string
+                    description: 业务工作流在树结构中的名称，使用~连接树层次名称
+                  parentGuid:
+                    type: string
+                    description: 父类型的唯一标识
+                  childCount:
+                    type: integer
+                    description: 子节点数
+                  hasChildren:
+                    type: boolean
+                    description: 是否有子节点
+            totalCount:
+              type: integer
+              description: 上级节点的子节点总数
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = AsyncPgHelper()
+        records, total_count = await tree_path.query_children(
+            pg_helper, 'gy_workflow', '''A.guid, A.name, A.description,
+                A.create_user as "createUser",to_char(A.create_time,'YYYY-MM-DD HH24:MI:SS') as "createTime",A.is_leaf as "isLeaf",
+                array_to_string(A.tree_names, '~') as "treeName",A.parent_guid as "parentGuid",A.flow_guid as "flowGuid",B.name as "flowName",
+                A.form_guid as "formGuid",C.name as "formName"''', request.json,
+            '''left join gy_flow B on A.flow_guid=B.guid left join gy_form C on A.form_guid=C.guid''')
+
+        return jsonify({"workflowData": records, "totalCount": total_count}), 200
 
     except Exception as exception:
         return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
@@ -188,6 +292,7 @@ def add_workflow():
                VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s);''', (request_param.get('guid', None), request_param.get(
                 'name', None), request_param.get('description', None), current_user['userName'], current_time, request_param.get(
                     'parentGuid', None), request_param.get('flowGuid', None), request_param.get('formGuid', None), request_param.get('isLeaf', None)))
+        tree_cache.invalidate('gy_workflow')
 
         return jsonify({'createUser': current_user['userName'], 'createTime': current_time.strftime("%Y-%m-%d %H:%M:%S")}), 200
 
@@ -281,6 +386,7 @@ def edit_workflow():
             (request_param.get('name', None), request_param.get(
                 'description', None), current_user['userName'], current_time, request_param.get(
                     'parentGuid', None), request_param.get('flowGuid', None), request_param.get('formGuid', None), request_param.get('guid', None)))
+        tree_cache.invalidate('gy_workflow')
 
         return jsonify({'createUser': current_user['userName'], 'createTime': current_time.strftime("%Y-%m-%d %H:%M:%S")}), 200
 
@@ -320,6 +426,92 @@ def delete_workflow():
     try:
         pg_helper = PgHelper()
         pg_helper.execute_sql('''delete from gy_workflow where guid=%s''', (request.json.get('guid', None),))
+        tree_cache.invalidate('gy_workflow')
+
+        return jsonify({}), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/workflow_manage/delete_workflow_subtree', methods=('post',))
+@jwt_required()
+@logit()
+def delete_workflow_subtree():
+    """删除业务工作流子树
+    删除业务工作流或业务工作流类别及其全部下级业务工作流，在一条语句中删除整个子树
+    ---
+    tags:
+      - system_manage_api/workflow_manage
+    parameters:
+      - in: body
+        name: guid
+        type: string
+        required: true
+        description: 子树根节点的guid
+    responses:
+      200:
+        description: 空，不返回有效数据
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = PgHelper()
+        tree_path.delete_subtree(pg_helper, 'gy_workflow', request.json.get('guid', None))
+        tree_cache.invalidate('gy_workflow')
+
+        return jsonify({}), 200
+
+    except Exception as exception:
+        return jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()}), 500
+
+
+@system_manage_api.route('/workflow_manage/move_workflow', methods=('post',))
+@jwt_required()
+@logit()
+def move_workflow():
+    """移动业务工作流子树
+    将业务工作流或业务工作流类别及其全部下级业务工作流移动到新的上级类别下，新的上级类别不能是自身或者下级
+    ---
+    tags:
+      - system_manage_api/workflow_manage
+    parameters:
+      - in: body
+        name: guid
+        type: string
+        required: true
+        description: 子树根节点的guid
+      - in: body
+        name: parentGuid
+        type: string
+        required: false
+        description: 新的上级类别的guid，为空时移动到第一级
+    responses:
+      200:
+        description: 空，不返回有效数据
+      500:
+        description: 服务运行错误,异常信息
+        schema:
+          properties:
+            errMessage:
+              type: string
+              description: 异常信息，包括异常信息的类型
+            traceMessage:
+              type: string
+              description: 异常更加详细的信息，包括异常的位置
+    """
+    try:
+        pg_helper = PgHelper()
+        tree_path.move_subtree(pg_helper, 'gy_workflow', request.json.get('guid', None), request.json.get('parentGuid', None))
+        tree_cache.invalidate('gy_workflow')
 
         return jsonify({}), 200
 
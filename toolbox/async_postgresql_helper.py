@@ -0,0 +1,354 @@
+"""postgresql数据库异步操作模块，使用psycopg(3)的异步连接和psycopg_pool的异步连接池,
+   提供与PgHelper相同的query_datatable、query_single_value、execute_sql、execute_func接口,供Flask的异步视图使用;
+   Flask的异步视图每次调用都在新的事件循环中运行,而异步连接池绑定在创建它的事件循环上,
+   因此连接池运行在一个后台事件循环线程中,视图中的协程将语句提交到后台事件循环并等待结果;
+   等待数据库返回期间不占用线程,同一视图中相互独立的查询可以通过asyncio.gather并发执行;
+   查询在自动提交模式下执行,配置了只读库(PG_REPLICAS)时与PgHelper相同轮询使用只读库的异步连接池,只读库无法连接时使用主库;
+   同一语句在一个连接上执行PG_STATEMENT_PREPARE_THRESHOLD次后由psycopg自动预备(PREPARE),
+   每个连接最多PG_STATEMENT_CACHE_SIZE个预备语句,与PgHelper的预备语句缓存(toolbox.statement_cache)使用相同的配置;
+   写操作(execute_sql、execute_func)在线程中由PgHelper执行,使用请求共享的连接和事务,并使本次请求固定使用主库;
+   请求已固定使用主库(读己之写)时,查询同样由PgHelper在请求共享的事务中执行,能够读取到本次请求尚未提交的修改;
+   每次调用的耗时(包括等待连接池)按照调用的接口记录到toolbox.query_metrics;
+   语句超时时间与PgHelper相同由toolbox.query_timeout计算,请求截止时间已过时取消等待并取消正在执行的语句
+"""
+import asyncio
+import atexit
+import itertools
+import threading
+import time
+
+import psycopg
+import psycopg.adapt
+import psycopg.rows
+from flask import (current_app, has_app_context)
+from psycopg_pool import (AsyncConnectionPool, PoolTimeout)
+
+from . import (query_metrics, query_timeout)
+from .connection_pool import is_primary_pinned
+from .postgresql_helper import (PgHelper, json_agg_sql)
+from .statement_cache import (DEFAULT_CACHE_SIZE, DEFAULT_PREPARE_THRESHOLD)
+
+# 已创建的异步连接池,用于没有Flask应用上下文的场景
+ASYNC_POOL_REGISTRY = {}
+
+# 轮询选择只读库异步连接池的计数器
+REPLICA_COUNTER = itertools.count()
+
+
+# pylint: disable=too-few-public-methods
+class RawTextLoader(psycopg.adapt.Loader):
+    """ 文本类型的加载类,直接返回数据库的原始字节,不解码为字符串
+    """
+
+    def load(self, data):
+        """返回原始字节
+        """
+        return bytes(data)
+
+
+class AsyncPgPool:
+    """ 运行在后台事件循环线程中的异步连接池类
+    连接池及其连接只在后台事件循环中使用,其它事件循环通过submit提交协程并等待结果
+    """
+    __loop__ = None
+    __thread__ = None
+    __pool__ = None
+
+    def __init__(self, min_size, max_size, checkout_timeout, reset=None, prepare=(None, None), **connect_kwargs):
+        """ 类的构造函数,启动后台事件循环线程并打开连接池
+        参数：
+           min_size：最小连接数
+           max_size：最大连接数
+           checkout_timeout：获取连接的超时时间,单位为秒
+           reset：连接归还连接池时调用的协程函数,参数为连接,用于恢复会话级的设置
+           prepare：(同一语句在一个连接上执行多少次后进行预备, 每个连接最多的预备语句数),None表示不预备
+           connect_kwargs：数据库连接参数(host、port、dbname、user、password)
+        返回值：
+        """
+        prepare_threshold, prepared_max = prepare
+
+        async def configure(connection):
+            if prepared_max is not None:
+                connection.prepared_max = prepared_max
+
+        # psycopg的异步连接不支持Windows默认的ProactorEventLoop,统一使用SelectorEventLoop
+        self.__loop__ = asyncio.SelectorEventLoop()
+        self.__thread__ = threading.Thread(target=self.__loop__.run_forever, name='pg-async-pool', daemon=True)
+        self.__thread__.start()
+        self.__pool__ = AsyncConnectionPool(psycopg.conninfo.make_conninfo(**connect_kwargs),
+                                            min_size=min_size,
+                                            max_size=max_size,
+                                            timeout=checkout_timeout,
+                                            kwargs={
+                                                'autocommit': True,
+                                                'prepare_threshold': prepare_threshold
+                                            },
+                                            configure=configure,
+                                            reset=reset,
+                                            open=False)
+        asyncio.run_coroutine_threadsafe(self.__pool__.open(), self.__loop__).result()
+
+    async def submit(self, coroutine_function, *args):
+        """在后台事件循环中使用连接池的一个连接执行协程函数,在调用者的事件循环中等待结果
+        参数：
+           coroutine_function：协程函数,第一个参数为数据库连接
+           args：协程函数的其它参数
+        返回值：
+           协程函数的返回值
+        """
+
+        async def run():
+            async with self.__pool__.connection() as connection:
+                return await coroutine_function(connection, *args)
+
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(run(), self.__loop__))
+
+    def statistics(self):
+        """连接池的统计信息
+        返回值：
+           字典形式,psycopg_pool的统计信息
+        """
+        return self.__pool__.get_stats()
+
+    def close(self):
+        """关闭连接池并停止后台事件循环,在应用退出时调用
+        """
+        if self.__loop__.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self.__pool__.close(), self.__loop__).result()
+        self.__loop__.call_soon_threadsafe(self.__loop__.stop)
+        self.__thread__.join()
+        self.__loop__.close()
+
+
+def init_app(app):
+    """根据应用配置创建主库和只读库的异步连接池,应用退出时关闭
+    参数：
+       app：Flask应用
+    返回值：
+       创建的主库异步连接池
+    """
+    # 预备语句使用与PgHelper的预备语句缓存相同的配置
+    prepare_threshold = app.config.get('PG_STATEMENT_PREPARE_THRESHOLD', DEFAULT_PREPARE_THRESHOLD)
+    prepared_max = app.config.get('PG_STATEMENT_CACHE_SIZE', DEFAULT_CACHE_SIZE)
+    pool_kwargs = {
+        'reset': query_timeout.reset_async_timeouts,
+        'prepare': (prepare_threshold, prepared_max),
+        'host': app.config['PG_HOST'],
+        'port': app.config['PG_PORT'],
+        'dbname': app.config['PG_DBNAME'],
+        'user': app.config['PG_USER'],
+        'password': app.config['PG_PASSWORD'],
+        'client_encoding': 'UTF8',
+        'options': query_timeout.connect_options(app.config)
+    }
+    pool_args = (app.config['PG_ASYNC_POOL_MIN_SIZE'], app.config['PG_ASYNC_POOL_MAX_SIZE'], app.config['PG_POOL_CHECKOUT_TIMEOUT'])
+    pool = AsyncPgPool(*pool_args, **pool_kwargs)
+    # 只读库的连接参数只需配置与主库不同的部分(例如host)
+    replicas = [AsyncPgPool(*pool_args, **dict(pool_kwargs, **replica)) for replica in app.config.get('PG_REPLICAS', [])]
+    app.extensions['pg_async_pool'] = pool
+    app.extensions['pg_async_replica_pools'] = replicas
+    ASYNC_POOL_REGISTRY['default'] = pool
+    ASYNC_POOL_REGISTRY['replicas'] = replicas
+    for x in [pool] + replicas:
+        atexit.register(x.close)
+    return pool
+
+
+def get_async_pool(replica=False):
+    """获取当前应用的异步连接池,没有应用上下文时使用最近创建的异步连接池
+    参数：
+       replica：是否获取只读库的异步连接池,多个只读库时轮询选择,没有配置只读库时返回主库的异步连接池
+    返回值：
+       异步连接池
+    """
+    replicas = async_replica_pools() if replica else []
+    if replicas:
+        return replicas[next(REPLICA_COUNTER) % len(replicas)]
+    if has_app_context():
+        return current_app.extensions['pg_async_pool']
+    return ASYNC_POOL_REGISTRY['default']
+
+
+def async_replica_pools():
+    """获取当前应用所有只读库的异步连接池
+    返回值：
+       异步连接池列表,没有配置只读库时为空列表
+    """
+    if has_app_context():
+        return current_app.extensions.get('pg_async_replica_pools', [])
+    return ASYNC_POOL_REGISTRY.get('replicas', [])
+
+
+def is_connection_error(exception):
+    """是否为无法获取或者建立连接的异常,此时可以改用其它连接池重新执行;语句执行中的异常(例如超时取消)不重新执行
+    """
+    if isinstance(exception, PoolTimeout):
+        return True
+    return isinstance(exception, psycopg.OperationalError) and (exception.sqlstate is None or exception.sqlstate.startswith('08'))
+
+
+class AsyncPgHelper:
+    """ Python异步操作PostgreSQL数据库的类
+    每次查询从异步连接池获取一个连接,执行完成后归还,
+    因此同一个AsyncPgHelper的多个查询可以并发执行;
+    写操作和请求固定使用主库之后的查询由PgHelper在请求共享的事务中执行
+    """
+    __pool__ = None
+    __statement_timeout__ = None
+    __lock_timeout__ = None
+
+    def __init__(self, statement_timeout=None, lock_timeout=None):
+        """ 类的构造函数,获取当前应用的异步连接池
+        参数：
+           statement_timeout：本对象执行语句的超时时间,单位为毫秒,默认使用接口的配置或全局配置
+           lock_timeout：本对象执行语句的锁等待超时时间,单位为毫秒,默认使用接口的配置或全局配置
+        返回值：
+        """
+        self.__pool__ = get_async_pool()
+        self.__statement_timeout__ = statement_timeout
+        self.__lock_timeout__ = lock_timeout
+
+    async def query_datatable(self, sql_string, param_tuple=None):
+        """查询函数,查询多条记录
+        参数：
+           sql_string：SQL语句（SELECT等）
+           param_tuple：参数元组
+        返回值：
+           列表形式,每条记录为字典形式
+           [{'id': 1, 'name': 'abc'}, {'id': 2, 'name': 'def'}]
+        """
+
+        if is_primary_pinned():
+            return [dict(x.items()) for x in await self.__delegate('query_datatable', sql_string, param_tuple)]
+
+        async def query(connection):
+            async with connection.cursor(row_factory=psycopg.rows.dict_row) as cursor:
+                await cursor.execute(sql_string, param_tuple)
+                return await cursor.fetchall()
+
+        return await self.__run(query, sql_string, param_tuple)
+
+    async def query_single_value(self, sql_string, param_tuple=None):
+        """查询函数,查询单个数值 SELECT COUNT(*) FROM等
+        参数：
+           sql_string：SQL语句（SELECT等）
+           param_tuple：参数元组
+        返回值：
+           单个数值
+        """
+
+        if is_primary_pinned():
+            return await self.__delegate('query_single_value', sql_string, param_tuple)
+
+        async def query(connection):
+            async with connection.cursor() as cursor:
+                await cursor.execute(sql_string, param_tuple)
+                return (await cursor.fetchone())[0]
+
+        return await self.__run(query, sql_string, param_tuple)
+
+    async def query_json(self, sql_string, param_tuple=None):
+        """JSON查询函数,与PgHelper.query_json相同,在数据库中使用json_agg将结果集序列化为JSON数组
+        参数：
+           sql_string：SQL语句（SELECT等）
+           param_tuple：参数元组
+        返回值：
+           UTF-8编码的JSON数组
+        """
+
+        if is_primary_pinned():
+            return await self.__delegate('query_json', sql_string, param_tuple)
+
+        async def query(connection):
+            async with connection.cursor() as cursor:
+                cursor.adapters.register_loader('text', RawTextLoader)
+                await cursor.execute(json_agg_sql(sql_string), param_tuple)
+                return (await cursor.fetchone())[0]
+
+        return await self.__run(query, sql_string, param_tuple)
+
+    async def execute_sql(self, ddml_sql, param_tuple=None):
+        """SQL语句执行函数,多个语句使用分号;分割,与PgHelper.execute_sql相同;
+           在线程中由PgHelper执行,请求中使用请求共享的事务,由请求结束时统一提交,并使本次请求之后的查询固定使用主库
+        参数：
+           ddml_sql：SQL语句（Insert、Update、Delete等）
+           param_tuple：参数元组
+        返回值：
+        """
+        await self.__delegate('execute_sql', ddml_sql, param_tuple)
+
+    async def execute_func(self, func_name, param_tuple=None):
+        """执行PostgreSQL数据库中写的函数或者过程,与PgHelper.execute_func相同,在线程中由PgHelper执行
+        参数：
+           func_name：函数名称
+           param_tuple：参数元组;同时支持命名参数(字典)
+        返回值：
+           数据库中函数的返回值,每条记录为字典形式
+        """
+        return [dict(x.items()) for x in await self.__delegate('execute_func', func_name, param_tuple)]
+
+    async def __delegate(self, method_name, *args):
+        """在线程中调用PgHelper的方法,线程复制当前的上下文,因此使用请求共享的连接和事务
+        参数：
+           method_name：PgHelper的方法名称
+           args：方法的参数
+        返回值：
+           方法的返回值
+        """
+        pg_helper = PgHelper(statement_timeout=self.__statement_timeout__, lock_timeout=self.__lock_timeout__)
+        return await asyncio.to_thread(getattr(pg_helper, method_name), *args)
+
+    async def __submit(self, coroutine_function):
+        """使用只读库的异步连接池执行只读的协程函数,只读库无法连接时依次尝试下一个只读库,最后使用主库
+        参数：
+           coroutine_function：协程函数,参数为数据库连接
+        返回值：
+           (执行的异步连接池, 协程函数的返回值)
+        """
+        for _ in range(len(async_replica_pools())):
+            pool = get_async_pool(replica=True)
+            try:
+                return pool, await pool.submit(coroutine_function)
+            except (psycopg.Error, PoolTimeout) as exception:
+                if not is_connection_error(exception):
+                    raise
+        return self.__pool__, await self.__pool__.submit(coroutine_function)
+
+    async def __run(self, coroutine_function, sql_string, param_tuple):
+        """在异步连接池中执行只读的协程函数并记录耗时,在视图的上下文中记录,耗时统计到调用的接口;
+           执行前在连接上设置超时时间,请求截止时间已过时取消执行(psycopg同时取消数据库中正在执行的语句);
+           开启PG_SLOW_QUERY_EXPLAIN时,慢查询在同一个连接池上再执行一次EXPLAIN ANALYZE获取执行计划,获取失败不影响查询结果
+        参数：
+           coroutine_function：执行语句的协程函数,参数为数据库连接
+           sql_string：SQL语句
+           param_tuple：参数元组
+        返回值：
+           协程函数的返回值
+        """
+        timeouts = query_timeout.resolve_timeouts(self.__statement_timeout__, self.__lock_timeout__)
+
+        async def run(connection):
+            await query_timeout.apply_async_timeouts(connection, timeouts)
+            return await coroutine_function(connection)
+
+        start_time = time.perf_counter()
+        try:
+            pool, result = await asyncio.wait_for(self.__submit(run), query_timeout.remaining_time())
+        except asyncio.TimeoutError as exception:
+            query_timeout.update_statistics('deadlineCancelCount')
+            raise psycopg.errors.QueryCanceled('canceling statement due to request deadline') from exception
+        slow_query = query_metrics.record(sql_string, param_tuple, start_time)
+        if slow_query is None or not query_metrics.explain_enabled():
+            return result
+
+        async def explain(connection):
+            async with connection.cursor() as cursor:
+                await cursor.execute(query_metrics.explain_sql(sql_string), param_tuple)
+                return (await cursor.fetchone())[0]
+
+        try:
+            query_metrics.record_plan(slow_query, await pool.submit(explain))
+        except psycopg.Error:
+            ...
+        return result
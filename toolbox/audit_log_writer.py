@@ -0,0 +1,234 @@
+"""用户操作日志的异步批量写入模块,logit装饰器将日志记录放入进程内的有界队列后立即返回,
+   后台写入线程从队列中取出日志,累计到批量大小(PG_LOG_BATCH_SIZE)或者距上次写入超过间隔(PG_LOG_FLUSH_INTERVAL)时,
+   使用一条COPY语句写入gy_log表,写入时从连接池获取连接,不占用请求的连接和事务;
+   在同一个事务中写入日志的大字段(toolbox.log_payload),并将本批日志的计数累加到汇总表(toolbox.log_rollup),汇总失败时仍然写入日志;
+   队列已满(PG_LOG_QUEUE_SIZE)时丢弃新的日志并计数,应用退出时写入队列中剩余的日志
+"""
+import atexit
+import io
+import logging
+import queue
+import threading
+import time
+
+import psycopg2
+
+from flask import (current_app, has_app_context)
+
+from . import (log_payload, log_rollup)
+from .connection_pool import PoolTimeoutError
+
+# 默认的队列长度、批量大小和写入间隔(秒),可通过配置修改
+DEFAULT_LOG_QUEUE_SIZE = 10000
+DEFAULT_LOG_BATCH_SIZE = 500
+DEFAULT_LOG_FLUSH_INTERVAL = 1.0
+
+# 应用退出时等待写入剩余日志的最长时间,单位为秒
+CLOSE_TIMEOUT = 10
+
+# 日志表的字段,与submit的记录元组顺序一致
+LOG_COLUMNS = ('user_guid', 'user_name', 'event_description', 'param_json', 'event_time')
+COPY_LOG_SQL = f"COPY gy_log({','.join(LOG_COLUMNS)}) FROM STDIN"
+
+# COPY文本格式中需要转义的字符
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+LOGGER = logging.getLogger(__name__)
+
+# 已创建的日志写入对象,用于没有Flask应用上下文的场景
+WRITER_REGISTRY = {}
+
+
+# pylint: disable=too-many-instance-attributes
+class AuditLogWriter:
+    """ 日志批量写入类
+    submit只把记录放入队列,不访问数据库;后台线程负责批量写入,写入失败的批次记录到失败计数和应用日志
+    """
+    __queue__ = None
+    __batch_size__ = None
+    __flush_interval__ = None
+    __pool__ = None
+    __thread__ = None
+    __stopping__ = None
+    __lock__ = None
+    __counters__ = None
+
+    def __init__(self, pool, queue_size=DEFAULT_LOG_QUEUE_SIZE, batch_size=DEFAULT_LOG_BATCH_SIZE, flush_interval=DEFAULT_LOG_FLUSH_INTERVAL):
+        """ 类的构造函数,启动后台写入线程
+        参数：
+           pool：写入使用的数据库连接池(PgConnectionPool)
+           queue_size：队列的最大长度,队列已满时丢弃新的日志
+           batch_size：每批写入的最大记录数
+           flush_interval：距上次写入超过该时间(秒)时,即使不足一批也写入
+        返回值：
+        """
+        self.__queue__ = queue.Queue(maxsize=queue_size)
+        self.__batch_size__ = batch_size
+        self.__flush_interval__ = flush_interval
+        self.__pool__ = pool
+        self.__stopping__ = threading.Event()
+        self.__lock__ = threading.Lock()
+        self.__counters__ = {'submittedCount': 0, 'writtenCount': 0, 'droppedCount': 0, 'failedCount': 0, 'batchCount': 0, 'rollupFailedCount': 0}
+        self.__thread__ = threading.Thread(target=self.__run, name='pg-audit-log-writer', daemon=True)
+        self.__thread__.start()
+
+    def submit(self, record, payloads=None):
+        """将一条日志放入队列,不等待写入;队列已满或者正在关闭时丢弃
+        参数：
+           record：日志记录元组,(user_guid, user_name, event_description, param_json, event_time)
+           payloads：param_json中引用的大字段内容,键为摘要(log_payload.extract_payloads)
+        返回值：
+           是否放入队列
+        """
+        if self.__stopping__.is_set():
+            self.__count('droppedCount')
+            return False
+        try:
+            self.__queue__.put_nowait((record, payloads))
+        except queue.Full:
+            dropped_count = self.__count('droppedCount')
+            # 避免队列持续满时刷屏,每丢弃1000条记录一次警告
+            if dropped_count % 1000 == 1:
+                LOGGER.warning('audit log queue is full, %s records dropped', dropped_count)
+            return False
+        self.__count('submittedCount')
+        return True
+
+    def close(self):
+        """停止接收新的日志,等待后台线程写入队列中剩余的日志,在应用退出时调用
+        """
+        if self.__stopping__.is_set():
+            return
+        self.__stopping__.set()
+        self.__thread__.join(CLOSE_TIMEOUT)
+
+    def statistics(self):
+        """日志写入的统计信息
+        返回值：
+           字典形式,包括放入队列、写入、丢弃、写入失败的记录数,写入批次数、汇总失败的批次数和队列中等待的记录数
+        """
+        with self.__lock__:
+            result = dict(self.__counters__)
+        result['queueSize'] = self.__queue__.qsize()
+        result['queueMaxSize'] = self.__queue__.maxsize
+        return result
+
+    def __run(self):
+        """后台写入线程,累计到批量大小或者超过写入间隔时写入一批,关闭时写入剩余的日志后退出
+        """
+        batch = []
+        deadline = time.monotonic() + self.__flush_interval__
+        while True:
+            try:
+                batch.append(self.__queue__.get(timeout=max(deadline - time.monotonic(), 0.01)))
+            except queue.Empty:
+                ...
+            stopping = self.__stopping__.is_set()
+            if len(batch) >= self.__batch_size__ or time.monotonic() >= deadline or stopping:
+                if stopping:
+                    batch.extend(self.__drain())
+                for index in range(0, len(batch), self.__batch_size__):
+                    self.__flush(batch[index:index + self.__batch_size__])
+                if stopping:
+                    return
+                batch = []
+                deadline = time.monotonic() + self.__flush_interval__
+
+    def __drain(self):
+        """取出队列中剩余的全部日志
+        """
+        records = []
+        while True:
+            try:
+                records.append(self.__queue__.get_nowait())
+            except queue.Empty:
+                return records
+
+    def __flush(self, batch):
+        """使用COPY将一批日志写入gy_log表并提交
+        参数：
+           batch：(日志记录元组, 大字段内容)的列表
+        返回值：
+        """
+        if not batch:
+            return
+        connection = None
+        try:
+            payloads = {}
+            for _, record_payloads in batch:
+                payloads.update(record_payloads or {})
+            batch = [x[0] for x in batch]
+            buffer = io.StringIO(''.join('\t'.join(copy_field(x) for x in record) + '\n' for record in batch))
+            connection = self.__pool__.getconn()
+            # 日志、大字段和汇总在同一个事务中提交
+            connection.autocommit = False
+            with connection.cursor() as cursor:
+                log_payload.store_payloads(cursor, payloads)
+                cursor.copy_expert(COPY_LOG_SQL, buffer)
+                self.__update_rollup(cursor, batch)
+            connection.commit()
+            self.__count('writtenCount', len(batch))
+            self.__count('batchCount')
+        except (psycopg2.Error, PoolTimeoutError):
+            # 写入失败不影响业务请求,记录失败数和异常信息
+            self.__count('failedCount', len(batch))
+            LOGGER.exception('failed to write %s audit log records', len(batch))
+        except Exception:
+            # 其它异常(例如日志内容无法转换)同样只丢弃本批日志,写入线程继续运行,否则队列写满后之后的日志全部被丢弃
+            self.__count('failedCount', len(batch))
+            LOGGER.exception('failed to write %s audit log records: %r', len(batch), batch)
+        finally:
+            if connection is not None:
+                self.__pool__.putconn(connection)
+
+    def __update_rollup(self, cursor, batch):
+        """累加本批日志的汇总计数,失败时回滚到保存点,日志仍然提交
+        """
+        if not log_rollup.is_ready():
+            return
+        cursor.execute('savepoint gy_log_rollup')
+        try:
+            log_rollup.update_rollup(cursor, batch)
+        except Exception:
+            cursor.execute('rollback to savepoint gy_log_rollup')
+            self.__count('rollupFailedCount')
+            LOGGER.exception('failed to update gy_log_rollup')
+
+    def __count(self, key, value=1):
+        """增加计数,返回增加后的值
+        """
+        with self.__lock__:
+            self.__counters__[key] += value
+            return self.__counters__[key]
+
+
+def copy_field(value):
+    """将字段值转换为COPY文本格式,None转换为NULL标记,其它值转换为字符串并转义制表符、换行符和反斜杠
+    """
+    if value is None:
+        return '\\N'
+    return str(value).translate(COPY_ESCAPES)
+
+
+def init_app(app):
+    """根据应用配置创建日志写入对象,使用主库连接池,应用退出时写入剩余的日志;需要在connection_pool.init_app之后调用
+    参数：
+       app：Flask应用
+    返回值：
+       创建的日志写入对象
+    """
+    writer = AuditLogWriter(app.extensions['pg_pool'], app.config.get('PG_LOG_QUEUE_SIZE', DEFAULT_LOG_QUEUE_SIZE),
+                            app.config.get('PG_LOG_BATCH_SIZE', DEFAULT_LOG_BATCH_SIZE),
+                            app.config.get('PG_LOG_FLUSH_INTERVAL', DEFAULT_LOG_FLUSH_INTERVAL))
+    app.extensions['audit_log_writer'] = writer
+    WRITER_REGISTRY['default'] = writer
+    atexit.register(writer.close)
+    return writer
+
+
+def get_writer():
+    """获取当前应用的日志写入对象,没有应用上下文时使用最近创建的日志写入对象
+    """
+    if has_app_context():
+        return current_app.extensions['audit_log_writer']
+    return WRITER_REGISTRY['default']
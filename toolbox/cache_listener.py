@@ -0,0 +1,211 @@
+"""缓存失效通知的监听模块,每个进程一个后台线程使用专用连接监听(LISTEN)tree_cache.NOTIFY_CHANNEL频道,
+   其它进程的添加、编辑、删除接口提交事务时,增加本进程中对应表的版本号,使树形列表缓存和ETag失效,不需要轮询;
+   本进程发送的通知已经在请求中处理,直接忽略;
+   连接断开时增加全局版本号并每隔RECONNECT_DELAY秒重新连接,连接成功后再次增加全局版本号,避免断开期间遗漏的通知导致读取到旧数据;
+   remote_version返回其它进程修改表的次数,用于只需要在其它进程修改时重建、本进程的修改已经增量更新的缓存(例如toolbox.word_index);
+   侧边栏菜单和选项配置等表(DATABASE_TABLES)没有修改接口,只能直接在数据库中修改,应用启动时为这些表安装语句级触发器,
+   修改的事务提交时由数据库发送通知,所有进程(包括本进程)增加表的版本号;触发器安装失败的表不使用ETag(toolbox.conditional_request)
+"""
+import collections
+import logging
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2 import sql
+
+from . import tree_cache
+from .connection_pool import (PoolTimeoutError, primary_connect_kwargs)
+
+# 没有通知时检查连接是否可用的间隔和重新连接的间隔,单位为秒
+HEARTBEAT_INTERVAL = 30
+RECONNECT_DELAY = 5
+
+# 只在数据库中直接修改的表,由触发器发送通知,通知的进程标识为DATABASE_TAG,不会与任何进程的标识相同
+DATABASE_TABLES = ('gy_sidebar_menu', 'gy_gender_config', 'gy_academic_degree_config')
+DATABASE_TAG = 'database'
+
+# 语句级触发器的函数,通知在事务提交时发送,一条语句修改多行时只发送一次
+FUNCTION_SQL = f'''create or replace function gy_cache_notify() returns trigger language plpgsql as $$
+                   begin
+                       perform pg_notify('{tree_cache.NOTIFY_CHANNEL}', '{DATABASE_TAG} ' || TG_TABLE_NAME);
+                       return null;
+                   end $$'''
+
+TRIGGER_SQL = '''create trigger {trigger} after insert or update or delete or truncate on {table}
+                 for each statement execute function gy_cache_notify()'''
+
+TRIGGER_EXISTS_SQL = 'select exists(select 1 from pg_trigger where tgrelid = to_regclass(%s) and tgname = %s)'
+
+# 多个进程同时启动时依次执行,之后的进程检查到已经安装时跳过
+LOCK_SQL = "select pg_advisory_xact_lock(hashtext('gy_cache_notify'))"
+
+LOGGER = logging.getLogger(__name__)
+
+# 监听连接的状态和接收通知的统计信息
+LISTENER_REGISTRY = {}
+LISTENER_LOCK = threading.Lock()
+STATISTICS = collections.Counter()
+# 各表收到其它进程的通知数
+REMOTE_VERSIONS = collections.Counter()
+
+
+def handle_notify(payload):
+    """处理一条通知,增加表的版本号
+    参数：
+       payload：通知的内容,"进程标识 表名"
+    返回值：
+    """
+    process_tag, _, table = payload.partition(' ')
+    if process_tag == tree_cache.PROCESS_TAG:
+        update_statistics('ownCount')
+        return
+    tree_cache.bump(table)
+    with LISTENER_LOCK:
+        REMOTE_VERSIONS[table] += 1
+    update_statistics('receivedCount')
+
+
+def remote_version(table):
+    """其它进程修改表的版本号,不包括本进程的修改
+    参数：
+       table：表名
+    返回值：
+       (收到该表的通知数, 全局版本号),监听连接断开和重新连接时全局版本号增加
+    """
+    with LISTENER_LOCK:
+        received = REMOTE_VERSIONS[table]
+    return (received,) + tree_cache.versions(())
+
+
+def listen(connect_kwargs):
+    """建立监听连接并等待通知,连接断开时抛出psycopg2.Error
+    参数：
+       connect_kwargs：psycopg2.connect的连接参数
+    返回值：
+    """
+    connection = psycopg2.connect(**connect_kwargs)
+    try:
+        connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with connection.cursor() as cursor:
+            cursor.execute(f'LISTEN {tree_cache.NOTIFY_CHANNEL}')
+            tree_cache.bump_all()
+            with LISTENER_LOCK:
+                LISTENER_REGISTRY['connected'] = True
+            while True:
+                if not select.select([connection], [], [], HEARTBEAT_INTERVAL)[0]:
+                    cursor.execute('SELECT 1')
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    handle_notify(connection.notifies.pop(0).payload)
+    finally:
+        with LISTENER_LOCK:
+            LISTENER_REGISTRY['connected'] = False
+        try:
+            connection.close()
+        except psycopg2.Error:
+            ...
+
+
+def run_listener(connect_kwargs):
+    """监听线程,连接断开时使全部缓存失效并重新连接
+    """
+    while True:
+        try:
+            listen(connect_kwargs)
+        except (psycopg2.Error, OSError) as exception:
+            tree_cache.bump_all()
+            update_statistics('reconnectCount')
+            with LISTENER_LOCK:
+                LISTENER_REGISTRY['lastError'] = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'error': repr(exception)}
+            LOGGER.warning('cache invalidation listener disconnected, reconnecting in %s s: %r', RECONNECT_DELAY, exception)
+        time.sleep(RECONNECT_DELAY)
+
+
+def install_triggers(pool, tables=DATABASE_TABLES):
+    """为只在数据库中直接修改的表安装发送通知的触发器,已经安装时跳过
+    参数：
+       pool：数据库连接池
+       tables：表名的列表
+    返回值：
+       已安装触发器的表名列表,不存在的表不包括在内
+    """
+    result = []
+    connection = pool.getconn()
+    # 连接可能处于自动提交模式,咨询锁和语句需要在同一个事务中
+    connection.autocommit = False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(LOCK_SQL)
+            cursor.execute(FUNCTION_SQL)
+            for table in tables:
+                cursor.execute('select to_regclass(%s) is not null', (table,))
+                if not cursor.fetchone()[0]:
+                    continue
+                cursor.execute(TRIGGER_EXISTS_SQL, (table, f'{table}_cache_notify'))
+                if not cursor.fetchone()[0]:
+                    cursor.execute(sql.SQL(TRIGGER_SQL).format(trigger=sql.Identifier(f'{table}_cache_notify'), table=sql.Identifier(table)))
+                result.append(table)
+        connection.commit()
+        return result
+    except psycopg2.Error:
+        connection.rollback()
+        raise
+    finally:
+        pool.putconn(connection)
+
+
+def is_notified(table):
+    """表的修改是否会收到通知,DATABASE_TABLES中触发器安装失败的表返回False,其它表由修改接口调用tree_cache.invalidate
+    参数：
+       table：表名
+    返回值：
+       是否会收到通知
+    """
+    if table not in DATABASE_TABLES:
+        return True
+    with LISTENER_LOCK:
+        return table in LISTENER_REGISTRY.get('notifiedTables', ())
+
+
+def init_app(app):
+    """为只在数据库中直接修改的表安装触发器,并启动监听线程,需要在connection_pool.init_app之后调用
+    参数：
+       app：Flask应用
+    返回值：
+    """
+    try:
+        notified_tables = install_triggers(app.extensions['pg_pool'])
+    except (psycopg2.Error, PoolTimeoutError):
+        notified_tables = []
+        LOGGER.exception('failed to install cache notify triggers, responses of %s have no ETag', DATABASE_TABLES)
+    with LISTENER_LOCK:
+        LISTENER_REGISTRY['notifiedTables'] = tuple(notified_tables)
+    connect_kwargs = primary_connect_kwargs(app.config)
+    # 监听连接长期空闲等待通知,不使用语句缓存
+    connect_kwargs.pop('connection_factory', None)
+    threading.Thread(target=run_listener, args=(connect_kwargs,), name='pg-cache-listener', daemon=True).start()
+
+
+def update_statistics(key):
+    """更新接收通知、重新连接的次数
+    """
+    with LISTENER_LOCK:
+        STATISTICS[key] += 1
+
+
+def statistics():
+    """缓存失效通知的统计信息
+    返回值：
+       字典形式,包括监听连接是否可用,接收其它进程的通知数、忽略本进程的通知数、重新连接次数、最近一次断开的异常信息
+       和已安装通知触发器的表
+    """
+    with LISTENER_LOCK:
+        result = {key: STATISTICS[key] for key in ('receivedCount', 'ownCount', 'reconnectCount')}
+        result['connected'] = LISTENER_REGISTRY.get('connected', False)
+        result['lastError'] = dict(LISTENER_REGISTRY.get('lastError', {}))
+        result['notifiedTables'] = list(LISTENER_REGISTRY.get('notifiedTables', ()))
+    return result
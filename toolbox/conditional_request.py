@@ -0,0 +1,117 @@
+"""HTTP条件请求模块,读多写少的接口(权限、角色、用户、侧边栏菜单、选项配置和树形列表)的响应带有强ETag,
+   ETag由进程标识和接口依赖的各表的版本号(toolbox.tree_cache)生成,添加、编辑、删除接口调用tree_cache.invalidate增加版本号;
+   请求的If-None-Match与当前的ETag一致时直接返回304,不执行查询、不序列化数据;
+   版本号是进程内的计数,ETag包括进程标识,其它进程生成的ETag不会匹配,只会返回完整的响应,不会返回过期的304;
+   POST接口(例如sidebar_menu)的ETag还包括请求参数的摘要;
+   侧边栏菜单和选项配置没有修改接口,版本号由数据库的触发器发送的通知增加(toolbox.cache_listener),
+   触发器没有安装时这些接口不返回ETag,每次执行查询
+"""
+import collections
+import hashlib
+import inspect
+import threading
+
+from functools import wraps
+from flask import (make_response, request)
+
+from . import (cache_listener, tree_cache)
+
+# 响应需要每次向服务端验证,响应与用户的认证信息相关,不能由共享缓存保存
+CACHE_CONTROL = 'private, no-cache'
+
+STATISTICS = collections.Counter()
+STATISTICS_LOCK = threading.Lock()
+
+
+def current_etag(tables):
+    """当前请求的ETag(不带引号)
+    参数：
+       tables：接口依赖的表名元组
+    返回值：
+       ETag
+    """
+    # 进程重启后版本号从0开始,进程标识不同,之前的ETag全部失效
+    etag = '-'.join([tree_cache.PROCESS_TAG] + [str(x) for x in tree_cache.versions(tables)])
+    request_data = request.get_data(cache=True)
+    if request_data:
+        etag += '-' + hashlib.sha1(request_data).hexdigest()[:16]
+    return etag
+
+
+def not_modified(etag):
+    """返回304响应
+    """
+    response = make_response('', 304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
+
+
+def with_etag(result, etag):
+    """为成功的响应设置ETag,错误的响应不设置
+    """
+    response = make_response(result)
+    if response.status_code == 200:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
+
+
+def update_statistics(key):
+    """更新304、完整响应的次数
+    """
+    with STATISTICS_LOCK:
+        STATISTICS[key] += 1
+
+
+def conditional(tables):
+    """条件请求装饰器函数,在jwt_required之后使用,ETag在执行查询之前获取,
+       查询期间表被修改时版本号已经增加,下一次请求返回新的数据;依赖的表的修改不会收到通知时不使用ETag
+
+    Args:
+        tables (tuple): 接口依赖的表名元组
+    """
+
+    def conditional_decorator(func):
+
+        # 异步视图函数需要返回协程函数,由Flask在事件循环中执行
+        if inspect.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def async_wrapped_function(*args, **kwargs):
+                if not all(cache_listener.is_notified(x) for x in tables):
+                    update_statistics('uncheckedCount')
+                    return await func(*args, **kwargs)
+                etag = current_etag(tables)
+                if etag in request.if_none_match:
+                    update_statistics('notModifiedCount')
+                    return not_modified(etag)
+                update_statistics('fullResponseCount')
+                return with_etag(await func(*args, **kwargs), etag)
+
+            return async_wrapped_function
+
+        @wraps(func)
+        def wrapped_function(*args, **kwargs):
+            if not all(cache_listener.is_notified(x) for x in tables):
+                update_statistics('uncheckedCount')
+                return func(*args, **kwargs)
+            etag = current_etag(tables)
+            if etag in request.if_none_match:
+                update_statistics('notModifiedCount')
+                return not_modified(etag)
+            update_statistics('fullResponseCount')
+            return with_etag(func(*args, **kwargs), etag)
+
+        return wrapped_function
+
+    return conditional_decorator
+
+
+def statistics():
+    """条件请求的统计信息
+    返回值：
+       字典形式,包括返回304、完整响应和不使用ETag的次数
+    """
+    with STATISTICS_LOCK:
+        return {key: STATISTICS[key] for key in ('notModifiedCount', 'fullResponseCount', 'uncheckedCount')}
@@ -0,0 +1,418 @@
+"""PostgreSQL数据库连接池模块,随Flask应用创建一次,
+   连接池支持最小/最大连接数、获取连接超时、获取时的连接健康检查,
+   并统计获取连接的等待时间、连接池饱和次数等信息;
+   一次请求(应用上下文)中的所有PgHelper共享一个连接和一个事务,
+   请求成功时统一提交一次,请求出错时统一回滚一次,请求结束(teardown)时归还连接;
+   配置了只读库(PG_REPLICAS)时,只读查询轮询分发到只读库的连接池,写操作使用主库,
+   请求中发生写操作后,该请求剩余的查询固定使用主库,保证读取到本请求写入的数据.
+"""
+import itertools
+import threading
+import time
+import traceback
+
+import psycopg2
+import psycopg2.extensions
+from flask import (current_app, g, has_app_context, jsonify)
+
+from . import query_timeout
+from .statement_cache import CachedConnection
+
+# 已创建的连接池,用于没有Flask应用上下文的场景(后台线程等)
+POOL_REGISTRY = {}
+
+# 只读库连接池的轮询序号
+REPLICA_COUNTER = itertools.count()
+
+
+class PoolTimeoutError(Exception):
+    """ 在超时时间内没有从连接池获取到空闲连接
+    """
+
+
+# pylint: disable=too-many-instance-attributes
+class PgConnectionPool:
+    """ 线程安全的PostgreSQL连接池类
+    空闲连接按照后进先出的顺序复用,连接数达到最大值时等待其他线程归还连接,
+    等待超过checkout_timeout抛出PoolTimeoutError异常
+    """
+    __connect_kwargs__ = None
+    __condition__ = None
+    __idle_connections__ = None
+    __size__ = 0
+
+    def __init__(self, min_size, max_size, checkout_timeout, health_check_interval, reset=None, **connect_kwargs):
+        """ 类的构造函数,创建最小连接数的数据库连接
+        参数：
+           min_size：最小连接数,创建连接池时即建立
+           max_size：最大连接数,超过后获取连接需要等待
+           checkout_timeout：获取连接的超时时间,单位为秒
+           health_check_interval：连接空闲超过该时间,获取时执行SELECT 1健康检查,单位为秒
+           reset：连接归还连接池时调用的函数,参数为连接,用于恢复会话级的设置
+           connect_kwargs：psycopg2.connect的连接参数
+        返回值：
+        """
+        self.__connect_kwargs__ = connect_kwargs
+        self.__reset__ = reset
+        self.__min_size__ = min_size
+        self.__max_size__ = max_size
+        self.__checkout_timeout__ = checkout_timeout
+        self.__health_check_interval__ = health_check_interval
+        self.__condition__ = threading.Condition()
+        self.__idle_connections__ = []
+        self.__statistics__ = {
+            'checkoutCount': 0,    #获取连接的次数
+            'waitCount': 0,    #连接池饱和,需要等待的次数
+            'waitTimeTotal': 0.0,    #获取连接的累计等待时间,单位为秒
+            'waitTimeMax': 0.0,    #获取连接的最大等待时间,单位为秒
+            'timeoutCount': 0,    #获取连接超时的次数
+            'healthCheckFailCount': 0,    #健康检查失败,重建连接的次数
+            'createCount': 0,    #新建连接的次数
+            'discardCount': 0,    #丢弃损坏连接的次数
+        }
+
+        for _ in range(min_size):
+            self.__idle_connections__.append((self.__connect(), time.monotonic()))
+            self.__size__ += 1
+
+    def getconn(self):
+        """从连接池获取一个连接,没有空闲连接且连接数达到最大值时等待
+        参数：
+        返回值：
+           psycopg2的数据库连接
+        """
+        start_time = time.monotonic()
+        waited = False
+        connection = None
+        last_used = None
+        with self.__condition__:
+            while True:
+                if self.__idle_connections__:
+                    connection, last_used = self.__idle_connections__.pop()
+                    break
+                if self.__size__ < self.__max_size__:
+                    self.__size__ += 1
+                    break
+
+                if not waited:
+                    waited = True
+                    self.__statistics__['waitCount'] += 1
+                remaining_time = start_time + self.__checkout_timeout__ - time.monotonic()
+                if remaining_time <= 0:
+                    self.__statistics__['timeoutCount'] += 1
+                    raise PoolTimeoutError(f'no free connection in pool after {self.__checkout_timeout__} seconds')
+                self.__condition__.wait(remaining_time)
+
+            wait_time = time.monotonic() - start_time
+            self.__statistics__['checkoutCount'] += 1
+            self.__statistics__['waitTimeTotal'] += wait_time
+            self.__statistics__['waitTimeMax'] = max(self.__statistics__['waitTimeMax'], wait_time)
+
+        # 建立连接和健康检查均为网络操作,在锁外执行
+        if connection is not None and not self.__is_healthy(connection, last_used):
+            with self.__condition__:
+                self.__statistics__['healthCheckFailCount'] += 1
+            self.__close(connection)
+            connection = None
+
+        if connection is None:
+            try:
+                connection = self.__connect()
+            except Exception:
+                self.__release_slot()
+                raise
+
+        return connection
+
+    def putconn(self, connection, close=False):
+        """将连接归还连接池,未结束的事务回滚,恢复会话级的设置,已损坏的连接直接丢弃
+        参数：
+           connection：从本连接池获取的连接
+           close：是否关闭连接而不放回连接池
+        返回值：
+        """
+        if not close and not connection.closed:
+            try:
+                if connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+                if self.__reset__ is not None:
+                    self.__reset__(connection)
+            except psycopg2.Error:
+                close = True
+
+        if close or connection.closed:
+            self.__close(connection)
+            self.__release_slot(discard=True)
+            return
+
+        with self.__condition__:
+            self.__idle_connections__.append((connection, time.monotonic()))
+            self.__condition__.notify()
+
+    def closeall(self):
+        """关闭连接池中所有空闲的连接,在应用退出时调用
+        """
+        with self.__condition__:
+            while self.__idle_connections__:
+                connection, _ = self.__idle_connections__.pop()
+                self.__close(connection)
+                self.__size__ -= 1
+            self.__condition__.notify_all()
+
+    def statistics(self):
+        """连接池的统计信息
+        返回值：
+           字典形式,包括连接数、空闲连接数、使用中连接数、等待时间、饱和次数等
+        """
+        with self.__condition__:
+            statistics = dict(self.__statistics__)
+            statistics['minSize'] = self.__min_size__
+            statistics['maxSize'] = self.__max_size__
+            statistics['size'] = self.__size__
+            statistics['idleCount'] = len(self.__idle_connections__)
+            statistics['inUseCount'] = self.__size__ - len(self.__idle_connections__)
+        return statistics
+
+    def __connect(self):
+        """新建数据库连接
+        """
+        connection = psycopg2.connect(**self.__connect_kwargs__)
+        with self.__condition__:
+            self.__statistics__['createCount'] += 1
+        return connection
+
+    def __release_slot(self, discard=False):
+        """连接被丢弃或新建失败后减少连接数,并唤醒一个等待的线程
+        """
+        with self.__condition__:
+            self.__size__ -= 1
+            if discard:
+                self.__statistics__['discardCount'] += 1
+            self.__condition__.notify()
+
+    def __is_healthy(self, connection, last_used):
+        """检查连接是否可用,空闲时间较短的连接仅检查是否关闭
+        """
+        if connection.closed:
+            return False
+        if time.monotonic() - last_used < self.__health_check_interval__:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def __close(connection):
+        """关闭连接,忽略已损坏连接关闭时的异常
+        """
+        try:
+            connection.close()
+        except psycopg2.Error:
+            ...
+
+
+def primary_connect_kwargs(config):
+    """主库的连接参数,也用于连接池之外的专用连接(例如缓存失效通知的监听连接)
+    参数：
+       config：应用配置
+    返回值：
+       psycopg2.connect的连接参数
+    """
+    return {
+        'host': config['PG_HOST'],
+        'port': config['PG_PORT'],
+        'dbname': config['PG_DBNAME'],
+        'user': config['PG_USER'],
+        'password': config['PG_PASSWORD'],
+        'client_encoding': 'UTF8',    #JSON查询(query_json)直接返回数据库的原始字节,需要为UTF-8编码
+        'options': query_timeout.connect_options(config),    #全局配置的语句超时、锁等待超时时间
+        'connection_factory': CachedConnection
+    }
+
+
+def init_app(app):
+    """根据应用配置创建连接池,并注册请求结束时归还连接的处理函数
+    参数：
+       app：Flask应用
+    返回值：
+       创建的连接池
+    """
+    pool_args = (app.config['PG_POOL_MIN_SIZE'], app.config['PG_POOL_MAX_SIZE'], app.config['PG_POOL_CHECKOUT_TIMEOUT'],
+                 app.config['PG_POOL_HEALTH_CHECK_INTERVAL'])
+    connect_kwargs = primary_connect_kwargs(app.config)
+    pool = PgConnectionPool(*pool_args, reset=query_timeout.reset_timeouts, **connect_kwargs)
+    # 只读库的连接参数只需配置与主库不同的部分(例如host)
+    replicas = [
+        PgConnectionPool(*pool_args, reset=query_timeout.reset_timeouts, **dict(connect_kwargs, **replica))
+        for replica in app.config.get('PG_REPLICAS', [])
+    ]
+    app.extensions['pg_pool'] = pool
+    app.extensions['pg_replica_pools'] = replicas
+    POOL_REGISTRY['default'] = pool
+    POOL_REGISTRY['replicas'] = replicas
+    app.after_request(commit_transaction)
+    app.teardown_appcontext(release_connection)
+    query_timeout.init_app(app)
+    return pool
+
+
+def get_pool(replica=False):
+    """获取当前应用的连接池,没有应用上下文时使用最近创建的连接池
+    参数：
+       replica：是否获取只读库的连接池,多个只读库时轮询选择,没有配置只读库时返回主库的连接池
+    返回值：
+       连接池
+    """
+    replicas = replica_pools() if replica else []
+    if replicas:
+        return replicas[next(REPLICA_COUNTER) % len(replicas)]
+    if has_app_context():
+        return current_app.extensions['pg_pool']
+    return POOL_REGISTRY['default']
+
+
+def replica_pools():
+    """获取当前应用所有只读库的连接池
+    返回值：
+       连接池列表,没有配置只读库时为空列表
+    """
+    if has_app_context():
+        return current_app.extensions.get('pg_replica_pools', [])
+    return POOL_REGISTRY.get('replicas', [])
+
+
+def checkout_replica():
+    """从只读库的连接池获取连接,只读库无法连接或连接池饱和时依次尝试下一个只读库
+    返回值：
+       (连接池, 连接),所有只读库均不可用时返回(None, None),由调用者改用主库
+    """
+    for _ in range(len(replica_pools())):
+        pool = get_pool(replica=True)
+        try:
+            return pool, pool.getconn()
+        except (psycopg2.OperationalError, PoolTimeoutError):
+            ...
+    return None, None
+
+
+def context_connection():
+    """获取本次请求(应用上下文)共享的连接,首次调用时从连接池获取
+    返回值：
+       共享的数据库连接,没有应用上下文时返回None,由调用者自行管理连接
+    """
+    if not has_app_context():
+        return None
+    if 'pg_connection' not in g:
+        g.pg_connection = get_pool().getconn()
+        g.pg_rollback_only = False
+    return g.pg_connection
+
+
+def context_replica_connection():
+    """获取本次请求(应用上下文)共享的只读库连接,首次调用时从只读库的连接池获取
+    返回值：
+       只读库的连接,没有应用上下文、没有可用的只读库或者请求已固定使用主库时返回None
+    """
+    if not has_app_context() or g.get('pg_pinned_primary', False):
+        return None
+    if 'pg_replica_connection' not in g:
+        g.pg_replica_pool, g.pg_replica_connection = checkout_replica()
+    return g.pg_replica_connection
+
+
+def pin_primary():
+    """本次请求剩余的查询固定使用主库,在请求中执行写操作时调用(读己之写)
+    """
+    if has_app_context():
+        g.pg_pinned_primary = True
+
+
+def is_primary_pinned():
+    """本次请求是否已固定使用主库
+    """
+    return has_app_context() and g.get('pg_pinned_primary', False)
+
+
+def mark_rollback_only():
+    """标记本次请求的事务只能回滚,在共享连接上执行SQL出错时调用
+    """
+    if has_app_context():
+        g.pg_rollback_only = True
+
+
+def after_commit(callback):
+    """注册本次请求的共享事务提交之后执行的函数(例如使缓存失效),事务回滚时不执行;没有应用上下文时立即执行
+    参数：
+       callback：没有参数的函数
+    返回值：
+    """
+    if not has_app_context():
+        callback()
+        return
+    g.setdefault('pg_after_commit', []).append(callback)
+
+
+def commit_transaction(response):
+    """请求处理完成(after_request)时提交一次共享事务,
+       响应状态码为错误或者事务被标记为只能回滚时回滚;
+       在响应返回之前提交,提交失败时返回500错误信息
+    参数：
+       response：请求的响应对象
+    返回值：
+       响应对象
+    """
+    connection = g.get('pg_connection', None)
+    if connection is None or connection.closed:
+        return response
+
+    if response.status_code >= 400 or g.get('pg_rollback_only', False):
+        g.pop('pg_after_commit', None)
+        try:
+            connection.rollback()
+        except psycopg2.Error:
+            ...
+        return response
+
+    try:
+        connection.commit()
+    except Exception as exception:
+        g.pop('pg_after_commit', None)
+        g.pg_rollback_only = True
+        response = jsonify({"errMessage": repr(exception), "traceMessage": traceback.format_exc()})
+        response.status_code = 500
+    return response
+
+
+def release_connection(exception=None):
+    """请求(应用上下文)结束(teardown)时归还共享连接,
+       没有经过after_request的事务(例如非请求的应用上下文)在这里提交或回滚;
+       事务提交(或者没有使用共享连接)时执行after_commit注册的函数
+    参数：
+       exception：请求处理过程中未捕获的异常
+    返回值：
+    """
+    g.pop('pg_pinned_primary', None)
+    replica_pool = g.pop('pg_replica_pool', None)
+    replica_connection = g.pop('pg_replica_connection', None)
+    if replica_connection is not None:
+        # 只读库上只有查询,未结束的只读事务在归还连接池时回滚
+        replica_pool.putconn(replica_connection)
+
+    connection = g.pop('pg_connection', None)
+    rollback_only = g.pop('pg_rollback_only', False) or exception is not None
+    callbacks = g.pop('pg_after_commit', [])
+    if connection is not None:
+        if (not rollback_only and not connection.closed and connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+            try:
+                connection.commit()
+            except psycopg2.Error:
+                rollback_only = True
+        # 未提交的事务在归还连接池时回滚
+        get_pool().putconn(connection)
+    if not rollback_only:
+        for callback in callbacks:
+            callback()
@@ -16,6 +16,51 @@ class Config():
         'title': 'API',    #形成API文档的配置
         'uiversion': 3
     }
+    PG_HOST = '192.168.1.177'    #PostgreSQL数据库连接参数
+    PG_PORT = '5432'
+    PG_DBNAME = 'pepper'
+    PG_USER = 'postgres'
+    PG_PASSWORD = 'Gis123'
+    PG_POOL_MIN_SIZE = 2    #连接池最小连接数，应用启动时建立
+    PG_POOL_MAX_SIZE = 20    #连接池最大连接数，超过后获取连接需要等待
+    PG_POOL_CHECKOUT_TIMEOUT = 10    #获取连接的超时时间，单位为秒
+    PG_POOL_HEALTH_CHECK_INTERVAL = 30    #连接空闲超过该时间，获取时执行健康检查，单位为秒
+    PG_STREAM_ITERSIZE = 2000    #服务端游标流式查询每次获取的记录数
+    PG_EXPORT_CHUNK_SIZE = 65536    #流式导出时每次写入响应的字节数
+    PG_STATEMENT_CACHE_SIZE = 64    #每个连接缓存的预备语句(PREPARE)最大数量
+    PG_STATEMENT_PREPARE_THRESHOLD = 2    #同一语句在一个连接上执行多少次后进行预备
+    PG_BULK_PAGE_SIZE = 5000    #批量写入时每条INSERT语句包含的最大行数
+    PG_ASYNC_POOL_MIN_SIZE = 2    #异步视图使用的异步连接池最小连接数
+    PG_ASYNC_POOL_MAX_SIZE = 20    #异步连接池最大连接数
+    PG_SLOW_QUERY_THRESHOLD = 500    #慢查询阈值，单位为毫秒，超过阈值的语句记录慢查询日志
+    PG_SLOW_QUERY_EXPLAIN = False    #慢的只读查询是否再执行一次EXPLAIN (ANALYZE, BUFFERS)记录执行计划
+    PG_SLOW_QUERY_HISTORY = 100    #数据库监控接口中保留的最近慢查询记录数
+    PG_STATEMENT_TIMEOUT = 30000    #语句超时时间，单位为毫秒，0表示不限制
+    PG_LOCK_TIMEOUT = 10000    #锁等待超时时间，单位为毫秒，0表示不限制
+    PG_REQUEST_TIMEOUT = 60000    #请求截止时间，单位为毫秒，超过后取消正在执行的语句，0表示不限制
+    PG_CANCEL_CHECK_INTERVAL = 1.0    #检查请求截止时间和客户端断开的间隔，单位为秒
+    PG_ENDPOINT_TIMEOUTS = {    #接口的超时配置，可配置statement_timeout、lock_timeout、request_timeout
+        'system_manage_api.user_log_server_side_data': {
+            'statement_timeout': 10000,
+            'request_timeout': 15000
+        }
+    }
+    PG_LOG_QUEUE_SIZE = 10000    #用户操作日志队列的最大长度，队列已满时丢弃新的日志
+    PG_LOG_BATCH_SIZE = 500    #用户操作日志每批写入的最大记录数
+    PG_LOG_FLUSH_INTERVAL = 1.0    #用户操作日志不足一批时的写入间隔，单位为秒
+    PG_LOG_PARTITION_PREMAKE = 3    #用户操作日志表提前创建的月分区数
+    PG_LOG_RETENTION_MONTHS = 0    #用户操作日志保留的月数(包括当前月)，0表示不清理
+    PG_LOG_RETENTION_ACTION = 'detach'    #过期日志分区的处理方式，detach分离为独立的表，drop删除
+    PG_LOG_PARTITION_CHECK_INTERVAL = 3600    #用户操作日志分区的维护间隔，单位为秒
+    PG_LOG_SEARCH_PARAM_KEYS = ['name']    #用户操作日志检索的param_json字段，每个字段建立三元组索引
+    PG_LOG_PAYLOAD_THRESHOLD = 8192    #请求参数中序列化后不小于该字节数的字段按照摘要压缩存储到gy_log_payload，日志中只记录引用
+    PG_LOG_EXCLUDED_FIELDS = {}    #各接口不记录到日志的请求参数字段，例如{'system_manage_api.save_flow_diagram': ['diagramJson']}
+    PG_TREE_CACHE_SIZE = 32    #树形列表缓存的最大缓存项数
+    PG_TREE_CACHE_MAX_BYTES = 16777216    #树形列表缓存每项的最大字节数，超过时不缓存
+    PG_COUNT_CACHE_TTL = 30    #检索结果精确记录数的缓存时间(秒)
+    PG_COUNT_CACHE_SIZE = 256    #缓存精确记录数的检索条件数
+    PG_EXACT_COUNT_THRESHOLD = 100000    #执行计划估计的记录数不超过该值时执行count获取精确值，否则返回估计值
+    PG_REPLICAS = []    #只读库(流复制备库)的连接参数，只需配置与主库不同的部分，例如[{'host': '192.168.1.178'}]
 
 
 class ProductionConfig(Config):
@@ -0,0 +1,22 @@
+"""JSON响应模块,将数据库返回的已编码JSON(PgHelper.query_json)直接写入响应,
+   响应中的其它字段仍使用Flask的JSON编码
+"""
+import json
+
+from flask import current_app
+
+
+def encoded_jsonify(**fields):
+    """构造JSON对象响应,与jsonify类似,bytes类型的字段值作为已编码的JSON直接写入,不再解码和重新编码
+       encoded_jsonify(rowCount=100, rowData=b'[{"id":1}]')
+    参数：
+       fields：响应JSON对象的字段,值为已编码的JSON(bytes)或者可以JSON编码的对象
+    返回值：
+       application/json类型的响应对象
+    """
+    parts = []
+    for key, value in fields.items():
+        if not isinstance(value, bytes):
+            value = current_app.json.dumps(value).encode('UTF-8')
+        parts.append(json.dumps(key).encode('UTF-8') + b':' + value)
+    return current_app.response_class(b'{' + b','.join(parts) + b'}', mimetype='application/json')
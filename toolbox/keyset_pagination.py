@@ -0,0 +1,119 @@
+"""键集(keyset)分页模块,用于ag-grid服务端行模型的分页查询,
+   OFFSET分页需要数据库生成并丢弃之前的全部记录,越往后翻页越慢;
+   键集分页记录上一页最后一条记录的排序字段值(游标),下一页查询排序字段"大于"游标值的记录,
+   排序字段上有索引时(例如gy_log的(event_time, id)),每一页的查询时间与页码无关;
+   游标对调用者是不透明的字符串,包括排序方式、查询条件的标识和下一页的起始行,与请求不一致时调用者改用OFFSET分页
+"""
+import base64
+import binascii
+import hashlib
+import json
+
+
+def sort_list(sort_model, column_map, default_sort, unique_column='id'):
+    """将ag-grid的排序信息转换为排序字段列表,只允许column_map中的字段,并以唯一字段作为最后的排序字段,保证顺序确定
+    参数：
+       sort_model：ag-grid的排序信息,[{'colId': 'eventTime', 'sort': 'desc'}]
+       column_map：允许排序的列标识与数据库字段的对应关系,{'eventTime': 'event_time'}
+       default_sort：没有排序信息时的排序字段列表,[('event_time', 'desc')]
+       unique_column：唯一字段,默认为id
+    返回值：
+       排序字段列表,[('event_time', 'desc'), ('id', 'desc')]
+    """
+    result = []
+    for sort_item in sort_model or []:
+        column = column_map.get(sort_item['colId'], None)
+        if column is None:
+            raise ValueError(f"unsupported sort column: {sort_item['colId']}")
+        direction = 'desc' if str(sort_item.get('sort', '')).lower() == 'desc' else 'asc'
+        if column not in (x[0] for x in result):
+            result.append((column, direction))
+    result = result or list(default_sort)
+    if unique_column not in (x[0] for x in result):
+        result.append((unique_column, result[-1][1]))
+    return result
+
+
+def order_clause(sorts):
+    """排序字段列表对应的order by子句,NULL值使用PostgreSQL默认的位置(升序在最后,降序在最前),与索引的顺序一致
+    """
+    return ' order by ' + ','.join(f'{column} {direction}' for column, direction in sorts)
+
+
+def keyset_condition(sorts, key_values):
+    """游标之后的记录的查询条件
+       排序方向相同且游标值都不为空时使用行比较(row comparison),可以直接使用排序字段上的索引;
+       升序时NULL值排在最后,另外加上NULL值的条件;排序方向不同时逐个字段比较
+    参数：
+       sorts：排序字段列表
+       key_values：上一页最后一条记录的排序字段值,与排序字段一一对应
+    返回值：
+       (查询条件, 参数列表)
+    """
+    directions = {x[1] for x in sorts}
+    if len(directions) == 1 and None not in key_values:
+        operator = '<' if 'desc' in directions else '>'
+        condition_list = [f"({','.join(x[0] for x in sorts)}) {operator} ({','.join(['%s'] * len(sorts))})"]
+        param_list = list(key_values)
+        if operator == '>':
+            for index, (column, _) in enumerate(sorts[:-1]):
+                condition_list.append(' and '.join([f'{x[0]} = %s' for x in sorts[:index]] + [f'{column} is null']))
+                param_list.extend(key_values[:index])
+        return '(' + ' or '.join(condition_list) + ')', param_list
+
+    condition_list = []
+    param_list = []
+    for index, (column, direction) in enumerate(sorts):
+        value = key_values[index]
+        # 升序时NULL值在最后,该字段之后没有记录;降序时NULL值在最前,之后为不为NULL的记录
+        if value is None and direction == 'asc':
+            continue
+        if value is None:
+            after_condition, after_params = f'{column} is not null', []
+        elif direction == 'asc':
+            after_condition, after_params = f'({column} > %s or {column} is null)', [value]
+        else:
+            after_condition, after_params = f'{column} < %s', [value]
+        equal_list = [f'{x[0]} is null' if y is None else f'{x[0]} = %s' for x, y in zip(sorts[:index], key_values[:index])]
+        condition_list.append('(' + ' and '.join(equal_list + [after_condition]) + ')')
+        param_list.extend([x for x in key_values[:index] if x is not None] + after_params)
+    return '(' + (' or '.join(condition_list) or 'false') + ')', param_list
+
+
+def query_signature(sorts, where_cause, where_params=()):
+    """排序方式和查询条件(包括参数)的标识,游标只能用于相同排序方式、相同查询条件的下一页
+    """
+    return hashlib.md5(json.dumps([sorts, where_cause, list(where_params)]).encode(encoding='UTF-8')).hexdigest()[:16]
+
+
+def encode_cursor(signature, row_index, key_values):
+    """生成游标
+    参数：
+       signature：排序方式和查询条件的标识
+       row_index：下一页的起始行
+       key_values：本页最后一条记录的排序字段值
+    返回值：
+       游标字符串
+    """
+    cursor_json = json.dumps({'signature': signature, 'row': row_index, 'values': key_values}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(cursor_json.encode(encoding='UTF-8')).decode('ascii')
+
+
+def decode_cursor(cursor_string, signature, row_index):
+    """解析游标,游标无效、排序方式或查询条件不同、起始行不同(例如跳转滚动)时返回None,调用者改用OFFSET分页
+    参数：
+       cursor_string：游标字符串
+       signature：本次请求的排序方式和查询条件的标识
+       row_index：本次请求的起始行
+    返回值：
+       上一页最后一条记录的排序字段值
+    """
+    if not cursor_string:
+        return None
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor_string.encode('ascii')))
+    except (ValueError, binascii.Error):
+        return None
+    if not isinstance(cursor, dict) or cursor.get('signature') != signature or cursor.get('row') != row_index:
+        return None
+    return cursor.get('values', None)
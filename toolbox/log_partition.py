@@ -0,0 +1,395 @@
+"""用户操作日志表(gy_log)的分区管理模块,gy_log按照event_time每月一个范围分区(gy_log_YYYYMM),
+   另有默认分区(gy_log_default)存放超出已建分区范围的记录和迁移前event_time为空的记录;
+   后台线程在应用启动后和之后每隔PG_LOG_PARTITION_CHECK_INTERVAL秒,提前创建当前月及之后PG_LOG_PARTITION_PREMAKE个月的分区,
+   并按照PG_LOG_RETENTION_MONTHS将过期的分区分离(detach,保留为独立的表,可以归档)或者删除(drop);
+   分区创建之前写入默认分区的记录在创建该月的分区时移入,之后按照保留月数清理;迁移前event_time为空的记录('-infinity')不清理;
+   多个进程同时维护时使用咨询锁,只有一个进程执行;
+   原有的非分区gy_log表需要执行一次迁移,在项目根目录执行(同时重建索引和计数触发器):
+       python -m toolbox.log_partition migrate
+   带有event_time范围条件的查询(例如日志管理的分页查询)只扫描范围内的分区
+"""
+import argparse
+import datetime
+import logging
+import re
+import threading
+import time
+
+import psycopg2
+from flask import Flask
+from psycopg2 import sql
+
+from . import (connection_pool, log_search, row_count)
+from .connection_pool import PoolTimeoutError
+
+# 默认提前创建的月数、保留的月数(0表示不清理)、过期分区的处理方式和检查间隔(秒),可通过配置修改
+DEFAULT_PARTITION_PREMAKE = 3
+DEFAULT_RETENTION_MONTHS = 0
+DEFAULT_RETENTION_ACTION = 'detach'
+DEFAULT_CHECK_INTERVAL = 3600
+
+# 分区表名称为gy_log_YYYYMM
+PARTITION_PATTERN = re.compile(r'^gy_log_(\d{4})(\d{2})$')
+DEFAULT_PARTITION = 'gy_log_default'
+
+# 多个进程同时维护分区时的咨询锁
+LOCK_SQL = "select pg_try_advisory_xact_lock(hashtext('gy_log_partition'))"
+
+IS_PARTITIONED_SQL = "select exists(select 1 from pg_partitioned_table where partrelid = to_regclass('gy_log'))"
+PARTITIONS_SQL = '''select C.relname from pg_inherits I join pg_class C on C.oid = I.inhrelid
+                    where I.inhparent = to_regclass('gy_log')'''
+
+# 默认分区中是否有某月的记录,有记录的月份;event_time为'-infinity'(迁移前为空)的记录一直保存在默认分区,不按照保留月数清理
+DEFAULT_ROWS_SQL = f"select exists(select 1 from {DEFAULT_PARTITION} where event_time >= %s and event_time < %s)"
+DEFAULT_MONTHS_SQL = f'''select distinct date_trunc('month', event_time)::date from {DEFAULT_PARTITION}
+                         where event_time > '-infinity' and event_time < 'infinity'::timestamp'''
+
+# 原表索引定义(pg_get_indexdef)中的表名
+UNPARTITIONED_PATTERN = re.compile(r' ON (ONLY )?((?:\S+\.)?)gy_log_unpartitioned ')
+
+LOGGER = logging.getLogger(__name__)
+
+# 分区维护的配置、后台线程和最近一次维护的结果
+MAINTENANCE_REGISTRY = {}
+MAINTENANCE_LOCK = threading.Lock()
+
+
+def add_months(month, count):
+    """月份加减
+    参数：
+       month：月份的第一天(datetime.date)
+       count：增加的月数,可以为负数
+    返回值：
+       增加后月份的第一天
+    """
+    month_index = month.year * 12 + month.month - 1 + count
+    return datetime.date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_name(month):
+    """月份对应的分区表名称
+    """
+    return f'gy_log_{month:%Y%m}'
+
+
+def partition_month(table_name):
+    """分区表名称对应的月份,不是月分区(例如默认分区)时返回None
+    """
+    match = PARTITION_PATTERN.match(table_name)
+    return datetime.date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def create_partition(cursor, month):
+    """创建指定月份的分区,已经存在时不创建;
+       默认分区中已有该月的记录时(分区创建之前写入的日志)不能直接创建,先分离默认分区,创建分区并将该月的记录移入,再挂载默认分区;
+       直接修改分区不触发gy_log上的计数触发器,记录只是移动,总数不变
+    参数：
+       cursor：数据库游标
+       month：月份的第一天
+    返回值：
+       是否新创建了分区
+    """
+    cursor.execute('select to_regclass(%s) is null', (partition_name(month),))
+    if not cursor.fetchone()[0]:
+        return False
+    month_range = (month, add_months(month, 1))
+    create_sql = sql.SQL('create table {} partition of gy_log for values from (%s) to (%s)').format(sql.Identifier(partition_name(month)))
+    cursor.execute(DEFAULT_ROWS_SQL, month_range)
+    if not cursor.fetchone()[0]:
+        cursor.execute(create_sql, month_range)
+        return True
+
+    cursor.execute(sql.SQL('alter table gy_log detach partition {}').format(sql.Identifier(DEFAULT_PARTITION)))
+    cursor.execute(create_sql, month_range)
+    cursor.execute(
+        sql.SQL('''with moved as (delete from {default} where event_time >= %s and event_time < %s returning *)
+                   insert into {partition} overriding system value select * from moved''').format(default=sql.Identifier(DEFAULT_PARTITION),
+                                                                                                  partition=sql.Identifier(partition_name(month))),
+        month_range)
+    LOGGER.info('moved %s rows from %s to %s', cursor.rowcount, DEFAULT_PARTITION, partition_name(month))
+    cursor.execute(sql.SQL('alter table gy_log attach partition {} default').format(sql.Identifier(DEFAULT_PARTITION)))
+    return True
+
+
+def retire_partition(cursor, table_name, retention_action):
+    """分离或者删除过期的分区
+    参数：
+       cursor：数据库游标
+       table_name：分区名
+       retention_action：detach分离为独立的表,drop删除
+    返回值：
+       维护结果中的键,detached或者dropped
+    """
+    # 分离、删除分区不触发计数触发器
+    row_count.subtract_rows(cursor, 'gy_log', table_name)
+    if retention_action == 'drop':
+        cursor.execute(sql.SQL('drop table {}').format(sql.Identifier(table_name)))
+        return 'dropped'
+    cursor.execute(sql.SQL('alter table gy_log detach partition {}').format(sql.Identifier(table_name)))
+    return 'detached'
+
+
+def in_savepoint(cursor, table_name, function, *args):
+    """在保存点中维护一个分区,失败时回滚到保存点并记录到应用日志,不影响其它分区的维护
+    参数：
+       cursor：数据库游标
+       table_name：分区名,用于日志
+       function：维护函数,第一个参数为游标
+       args：维护函数的其它参数
+    返回值：
+       维护函数的返回值,失败时为None
+    """
+    cursor.execute('savepoint gy_log_partition')
+    try:
+        value = function(cursor, *args)
+    except psycopg2.Error:
+        cursor.execute('rollback to savepoint gy_log_partition')
+        LOGGER.exception('gy_log partition maintenance failed for %s', table_name)
+        return None
+    cursor.execute('release savepoint gy_log_partition')
+    return value
+
+
+def maintain(pool, premake=DEFAULT_PARTITION_PREMAKE, retention_months=DEFAULT_RETENTION_MONTHS, retention_action=DEFAULT_RETENTION_ACTION):
+    """维护gy_log的分区,创建当前月及之后premake个月的分区,分离或者删除早于retention_months个月的分区;
+       默认分区中有记录的月份(例如维护停止期间跨月写入的日志)同样创建分区并移入记录,之后与其它分区一样按照保留月数清理;
+       每个分区在各自的保存点中维护,一个分区失败时只跳过该分区,记录在failed中
+    参数：
+       pool：数据库连接池
+       premake：提前创建的月数
+       retention_months：保留的月数(包括当前月),0表示不清理
+       retention_action：过期分区的处理方式,detach分离为独立的表,drop删除
+    返回值：
+       字典形式,新创建、分离、删除和维护失败的分区名称列表;gy_log不是分区表或者其它进程正在维护时skipped为True
+    """
+    result = {'created': [], 'detached': [], 'dropped': [], 'failed': [], 'skipped': False}
+    connection = pool.getconn()
+    # 连接可能处于自动提交模式,咨询锁和语句需要在同一个事务中
+    connection.autocommit = False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(LOCK_SQL)
+            locked = cursor.fetchone()[0]
+            cursor.execute(IS_PARTITIONED_SQL)
+            if not locked or not cursor.fetchone()[0]:
+                result['skipped'] = True
+                connection.rollback()
+                return result
+
+            current_month = datetime.date.today().replace(day=1)
+            months = {add_months(current_month, count) for count in range(premake + 1)}
+            cursor.execute('select to_regclass(%s) is not null', (DEFAULT_PARTITION,))
+            if cursor.fetchone()[0]:
+                cursor.execute(DEFAULT_MONTHS_SQL)
+                months.update(x[0] for x in cursor.fetchall())
+            for month in sorted(months):
+                created = in_savepoint(cursor, partition_name(month), create_partition, month)
+                if created is None:
+                    result['failed'].append(partition_name(month))
+                elif created:
+                    result['created'].append(partition_name(month))
+
+            if retention_months > 0:
+                cutoff_month = add_months(current_month, 1 - retention_months)
+                cursor.execute(PARTITIONS_SQL)
+                for table_name in sorted(x[0] for x in cursor.fetchall()):
+                    month = partition_month(table_name)
+                    if month is None or month >= cutoff_month:
+                        continue
+                    action = in_savepoint(cursor, table_name, retire_partition, table_name, retention_action)
+                    result[action or 'failed'].append(table_name)
+
+        connection.commit()
+        return result
+    except psycopg2.Error:
+        connection.rollback()
+        raise
+    finally:
+        pool.putconn(connection)
+
+
+def copy_index_statements(cursor):
+    """原表上非唯一索引(例如检索使用的三元组索引)在新表上的创建语句,原表删除后执行,索引名称不变;
+       唯一索引不包括分区字段,不能建立在分区表上,不复制
+    参数：
+       cursor：数据库游标
+    返回值：
+       语句列表
+    """
+    cursor.execute('''select pg_get_indexdef(indexrelid) from pg_index
+                      where indrelid = to_regclass('gy_log_unpartitioned') and not indisunique''')
+    return [UNPARTITIONED_PATTERN.sub(r' ON \1gy_log ', x[0], count=1) for x in cursor.fetchall()]
+
+
+def create_search_indexes(cursor, param_keys):
+    """在新表上创建检索使用的三元组索引(已经从原表复制的跳过),新表已被锁定,不需要CONCURRENTLY;
+       没有pg_trgm扩展时回滚到保存点,之后可以执行python -m toolbox.log_search create-indexes
+    参数：
+       cursor：数据库游标
+       param_keys：检索的param_json字段名列表
+    返回值：
+       是否创建成功
+    """
+    cursor.execute(log_search.FUNCTION_EXISTS_SQL)
+    if not cursor.fetchone()[0]:
+        cursor.execute(log_search.PARAM_FUNCTION_SQL)
+    cursor.execute('savepoint gy_log_search_index')
+    try:
+        cursor.execute('create extension if not exists pg_trgm')
+        for suffix, column in log_search.index_definitions(param_keys):
+            cursor.execute(log_search.index_statement(f'gy_log_{suffix}_trgm_idx', 'gy_log', column))
+        return True
+    except psycopg2.Error:
+        cursor.execute('rollback to savepoint gy_log_search_index')
+        LOGGER.warning('failed to create gy_log search indexes, run python -m toolbox.log_search create-indexes later', exc_info=True)
+        return False
+
+
+def migrate(pool, premake=DEFAULT_PARTITION_PREMAKE, param_keys=log_search.DEFAULT_SEARCH_PARAM_KEYS):
+    """将非分区的gy_log迁移为按月分区的表,在一个事务中执行,迁移期间gy_log被锁定;
+       新表的字段、默认值、NOT NULL和CHECK约束、标识列(identity)与原表相同,id为serial时原有的序列归新表所有,
+       为identity时新表的标识列从原有的最大值之后继续;
+       分区表的主键必须包括分区字段,主键改为(id, event_time),原有记录中为空的event_time改为'-infinity'(to_char的结果仍为空),存放在默认分区;
+       原表的非唯一索引、(event_time, id)索引、检索使用的三元组索引和计数触发器在新表上重新建立
+    参数：
+       pool：数据库连接池
+       premake：提前创建的月数
+       param_keys：检索的param_json字段名列表
+    返回值：
+       迁移的记录数,gy_log已经是分区表时返回None
+    """
+    connection = pool.getconn()
+    # 连接可能处于自动提交模式,咨询锁和语句需要在同一个事务中
+    connection.autocommit = False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("select set_config('statement_timeout', '0', true)")
+            cursor.execute('lock table gy_log in access exclusive mode')
+            cursor.execute(IS_PARTITIONED_SQL)
+            if cursor.fetchone()[0]:
+                connection.rollback()
+                return None
+
+            cursor.execute("select attidentity <> '' from pg_attribute where attrelid = to_regclass('gy_log') and attname = 'id'")
+            is_identity = cursor.fetchone()[0]
+            cursor.execute("select pg_get_serial_sequence('gy_log', 'id')")
+            sequence_name = cursor.fetchone()[0]
+            # 为原有记录所在的月份和之后的月份创建分区,event_time为空的记录不参与计算
+            cursor.execute("select date_trunc('month', min(event_time))::date from gy_log")
+            first_month = cursor.fetchone()[0]
+
+            cursor.execute('''alter table gy_log rename to gy_log_unpartitioned;
+                              update gy_log_unpartitioned set event_time = '-infinity' where event_time is null;
+                              create table gy_log (like gy_log_unpartitioned including defaults including constraints including identity
+                                  including generated including storage including comments) partition by range (event_time);
+                              create index gy_log_event_time_idx on gy_log (event_time, id);''')
+            cursor.execute(sql.SQL('create table {} partition of gy_log default').format(sql.Identifier(DEFAULT_PARTITION)))
+            if sequence_name and not is_identity:
+                # serial字段的默认值仍使用原有的序列,原表删除时不删除该序列
+                cursor.execute(sql.SQL('alter sequence {} owned by gy_log.id').format(sql.SQL(sequence_name)))
+
+            current_month = datetime.date.today().replace(day=1)
+            month = min(first_month or current_month, current_month)
+            while month <= add_months(current_month, premake):
+                create_partition(cursor, month)
+                month = add_months(month, 1)
+
+            cursor.execute('insert into gy_log overriding system value select * from gy_log_unpartitioned')
+            migrated_count = cursor.rowcount
+            if is_identity:
+                cursor.execute("select setval(pg_get_serial_sequence('gy_log', 'id'), coalesce(max(id), 0) + 1, false) from gy_log")
+
+            index_statements = copy_index_statements(cursor)
+            cursor.execute('drop table gy_log_unpartitioned')
+            # 原表删除之后主键和标识列的序列才能使用原来的名称
+            cursor.execute('alter table gy_log add constraint gy_log_pkey primary key (id, event_time)')
+            if is_identity:
+                cursor.execute("select pg_get_serial_sequence('gy_log', 'id')")
+                cursor.execute(sql.SQL('alter sequence {} rename to gy_log_id_seq').format(sql.SQL(cursor.fetchone()[0])))
+            for statement in index_statements:
+                cursor.execute(statement)
+            create_search_indexes(cursor, param_keys)
+            # 原表的计数触发器随原表删除,在新表上重新安装
+            cursor.execute(row_count.LOCK_SQL)
+            row_count.install_triggers(cursor, 'gy_log')
+        connection.commit()
+        return migrated_count
+    except psycopg2.Error:
+        connection.rollback()
+        raise
+    finally:
+        pool.putconn(connection)
+
+
+def init_app(app):
+    """启动后台线程维护分区,启动后立即维护一次,之后定期维护;需要在connection_pool.init_app之后调用;
+       导入应用时不执行分区的DDL,也不等待其它进程持有的咨询锁,分区创建之前写入的日志存放在默认分区
+    参数：
+       app：Flask应用
+    返回值：
+    """
+    MAINTENANCE_REGISTRY['pool'] = app.extensions['pg_pool']
+    MAINTENANCE_REGISTRY['options'] = (app.config.get('PG_LOG_PARTITION_PREMAKE',
+                                                      DEFAULT_PARTITION_PREMAKE), app.config.get('PG_LOG_RETENTION_MONTHS', DEFAULT_RETENTION_MONTHS),
+                                       app.config.get('PG_LOG_RETENTION_ACTION', DEFAULT_RETENTION_ACTION))
+    MAINTENANCE_REGISTRY['interval'] = app.config.get('PG_LOG_PARTITION_CHECK_INTERVAL', DEFAULT_CHECK_INTERVAL)
+    if 'thread' not in MAINTENANCE_REGISTRY:
+        MAINTENANCE_REGISTRY['thread'] = threading.Thread(target=maintenance_loop, name='pg-log-partition', daemon=True)
+        MAINTENANCE_REGISTRY['thread'].start()
+
+
+def run_maintenance():
+    """按照应用配置维护一次分区,维护失败时记录到应用日志,不影响应用运行
+    """
+    try:
+        result = maintain(MAINTENANCE_REGISTRY['pool'], *MAINTENANCE_REGISTRY['options'])
+        error = None
+        if result['skipped']:
+            LOGGER.info('gy_log partition maintenance skipped (not partitioned or locked by another process)')
+    except (psycopg2.Error, PoolTimeoutError) as exception:
+        result = None
+        error = repr(exception)
+        LOGGER.exception('gy_log partition maintenance failed')
+    with MAINTENANCE_LOCK:
+        MAINTENANCE_REGISTRY['last'] = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'result': result, 'error': error}
+
+
+def maintenance_loop():
+    """后台线程,先维护一次分区,之后定期维护
+    """
+    while True:
+        run_maintenance()
+        time.sleep(MAINTENANCE_REGISTRY['interval'])
+
+
+def statistics():
+    """最近一次分区维护的信息
+    返回值：
+       字典形式,包括维护时间、新创建、分离和删除的分区,维护失败时的异常信息
+    """
+    with MAINTENANCE_LOCK:
+        return dict(MAINTENANCE_REGISTRY.get('last', {}))
+
+
+def main():
+    """命令行入口,migrate迁移为分区表,maintain立即维护一次分区
+    """
+    parser = argparse.ArgumentParser(description='用户操作日志表(gy_log)的分区管理')
+    parser.add_argument('command', choices=('migrate', 'maintain'), help='migrate迁移为分区表,maintain维护分区')
+    args = parser.parse_args()
+
+    # 只创建连接池,不加载蓝图等其它模块
+    app = Flask(__name__)
+    app.config.from_object('toolbox.flask_config.DevelopmentConfig')
+    pool = connection_pool.init_app(app)
+    premake = app.config.get('PG_LOG_PARTITION_PREMAKE', DEFAULT_PARTITION_PREMAKE)
+    retention_months = app.config.get('PG_LOG_RETENTION_MONTHS', DEFAULT_RETENTION_MONTHS)
+    retention_action = app.config.get('PG_LOG_RETENTION_ACTION', DEFAULT_RETENTION_ACTION)
+    if args.command == 'migrate':
+        migrated_count = migrate(pool, premake, tuple(app.config.get('PG_LOG_SEARCH_PARAM_KEYS', log_search.DEFAULT_SEARCH_PARAM_KEYS)))
+        print('gy_log is already partitioned' if migrated_count is None else f'migrated {migrated_count} rows')
+    print(maintain(pool, premake, retention_months, retention_action))
+
+
+if __name__ == '__main__':
+    main()
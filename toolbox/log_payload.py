@@ -0,0 +1,160 @@
+"""用户操作日志的大字段存储模块,logit记录的请求参数中,序列化后不小于PG_LOG_PAYLOAD_THRESHOLD字节的字段
+   (例如保存流程图、地理处理模型时的diagramJson)不再写入gy_log.param_json,
+   而是按照内容的SHA-256摘要压缩存储到gy_log_payload,相同内容只存储一次,param_json中替换为引用:
+       {"diagramJson": {"$payload": "摘要", "size": 原始字节数}}
+   PG_LOG_EXCLUDED_FIELDS配置不记录的字段(按照接口),param_json中只记录字段名:{"$excluded": ["diagramJson"]};
+   摘要在请求中计算,压缩和写入由日志写入线程(toolbox.audit_log_writer)与日志在同一个事务中执行,已存在的内容不再压缩
+"""
+import hashlib
+import json
+import logging
+import threading
+import zlib
+
+import psycopg2
+import psycopg2.extras
+from flask import current_app
+
+from .connection_pool import PoolTimeoutError
+
+# 默认的大字段阈值(字节),可通过配置修改
+DEFAULT_PAYLOAD_THRESHOLD = 8192
+
+# logit添加的字段,不作为大字段处理
+RESERVED_FIELDS = ('moduleName', 'functionName')
+
+TABLE_SQL = '''create table if not exists gy_log_payload(hash text primary key, payload bytea not null, raw_size integer not null,
+                                                          create_time timestamp not null default now())'''
+
+INSERT_SQL = 'insert into gy_log_payload(hash, payload, raw_size) values %s on conflict (hash) do nothing'
+
+LOGGER = logging.getLogger(__name__)
+
+# 大字段表是否可用和存储的统计信息
+PAYLOAD_REGISTRY = {}
+STATISTICS_LOCK = threading.Lock()
+STATISTICS = {
+    'extractedCount': 0,    #替换为引用的字段数
+    'extractedBytes': 0,    #替换为引用的字段的原始字节数
+    'excludedCount': 0,    #按照配置不记录的字段数
+    'storedCount': 0,    #新存储的内容数
+    'storedBytes': 0,    #新存储的内容压缩后的字节数
+    'duplicateCount': 0    #已经存储过、不再存储的内容数
+}
+
+
+def is_ready():
+    """大字段表是否可用,不可用时(创建失败或者没有调用init_app)请求参数全部写入param_json
+    """
+    return PAYLOAD_REGISTRY.get('ready', False)
+
+
+def extract_payloads(param_dict, endpoint):
+    """将请求参数中的大字段替换为引用,删除不记录的字段;大字段表不可用时只删除不记录的字段
+    参数：
+       param_dict：请求参数的字典,直接修改
+       endpoint：接口名称,例如system_manage_api.save_flow_diagram
+    返回值：
+       大字段内容的字典,键为摘要,值为序列化后的UTF-8字节
+    """
+    threshold = current_app.config.get('PG_LOG_PAYLOAD_THRESHOLD', DEFAULT_PAYLOAD_THRESHOLD)
+    excluded_fields = [x for x in current_app.config.get('PG_LOG_EXCLUDED_FIELDS', {}).get(endpoint, ()) if x in param_dict]
+    for field in excluded_fields:
+        del param_dict[field]
+    if excluded_fields:
+        param_dict['$excluded'] = excluded_fields
+
+    payloads = {}
+    extracted_bytes = 0
+    for field, value in param_dict.items() if is_ready() else ():
+        if field in RESERVED_FIELDS or not isinstance(value, (str, list, dict)):
+            continue
+        raw_bytes = json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('UTF-8')
+        if len(raw_bytes) < threshold:
+            continue
+        payload_hash = hashlib.sha256(raw_bytes).hexdigest()
+        payloads[payload_hash] = raw_bytes
+        param_dict[field] = {'$payload': payload_hash, 'size': len(raw_bytes)}
+        extracted_bytes += len(raw_bytes)
+
+    if payloads or excluded_fields:
+        with STATISTICS_LOCK:
+            STATISTICS['extractedCount'] += len(payloads)
+            STATISTICS['extractedBytes'] += extracted_bytes
+            STATISTICS['excludedCount'] += len(excluded_fields)
+    return payloads
+
+
+def store_payloads(cursor, payloads):
+    """压缩存储大字段内容,已经存储过的内容不再压缩;与日志的写入在同一个事务中执行
+    参数：
+       cursor：写入日志的事务中的游标
+       payloads：大字段内容的字典,键为摘要
+    返回值：
+    """
+    if not payloads:
+        return
+    cursor.execute('select hash from gy_log_payload where hash = any(%s)', (list(payloads),))
+    existing_hashes = {x[0] for x in cursor.fetchall()}
+    value_list = [(x, zlib.compress(y, 6), len(y)) for x, y in sorted(payloads.items()) if x not in existing_hashes]
+    if value_list:
+        psycopg2.extras.execute_values(cursor, INSERT_SQL, value_list)
+    with STATISTICS_LOCK:
+        STATISTICS['storedCount'] += len(value_list)
+        STATISTICS['storedBytes'] += sum(len(x[1]) for x in value_list)
+        STATISTICS['duplicateCount'] += len(existing_hashes)
+
+
+def decompress_payload(payload):
+    """解压缩存储的大字段内容
+    参数：
+       payload：gy_log_payload.payload
+    返回值：
+       序列化后的UTF-8字节(JSON)
+    """
+    return zlib.decompress(bytes(payload))
+
+
+def ensure_table(pool):
+    """创建大字段表,已经存在时跳过
+    参数：
+       pool：数据库连接池
+    返回值：
+    """
+    connection = pool.getconn()
+    connection.autocommit = False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("select pg_advisory_xact_lock(hashtext('gy_log_payload'))")
+            cursor.execute(TABLE_SQL)
+        connection.commit()
+    except psycopg2.Error:
+        connection.rollback()
+        raise
+    finally:
+        pool.putconn(connection)
+
+
+def init_app(app):
+    """创建大字段表;需要在connection_pool.init_app之后、日志开始写入之前调用
+    参数：
+       app：Flask应用
+    返回值：
+    """
+    try:
+        ensure_table(app.extensions['pg_pool'])
+    except (psycopg2.Error, PoolTimeoutError):
+        LOGGER.exception('failed to create gy_log_payload, audit payloads are stored inline')
+        return
+    PAYLOAD_REGISTRY['ready'] = True
+
+
+def statistics():
+    """大字段存储的统计信息
+    返回值：
+       字典形式,包括大字段表是否可用,替换为引用、不记录的字段数,新存储、重复的内容数等
+    """
+    with STATISTICS_LOCK:
+        result = dict(STATISTICS)
+    result['ready'] = is_ready()
+    return result
@@ -0,0 +1,204 @@
+"""用户操作日志的汇总模块,gy_log_rollup按照小时、用户、模块(moduleName)和函数(functionName)记录操作次数,
+   用于活动统计图表(每小时、每个用户、每个模块、每个函数的操作次数),查询汇总表不再聚合整个日志表;
+   日志写入线程(toolbox.audit_log_writer)写入每批日志时,在同一个事务中将本批日志的计数累加到汇总表,汇总与日志一致;
+   应用启动时创建汇总表,新创建时在后台线程中由已有的日志重建一次,也可以在项目根目录执行:
+       python -m toolbox.log_rollup rebuild
+   汇总表不随日志分区的分离、删除而减少,保留全部历史的统计
+"""
+import argparse
+import collections
+import json
+import logging
+import threading
+import time
+
+import psycopg2
+import psycopg2.extras
+from flask import Flask
+
+from . import connection_pool
+from .connection_pool import PoolTimeoutError
+from .log_search import PARAM_FUNCTION_SQL
+
+# 汇总的时间粒度为小时,查询时可以再按天、周、月汇总;没有记录模块、函数的日志汇总为空字符串
+TABLE_SQL = '''create table if not exists gy_log_rollup(bucket_time timestamp not null, user_guid text not null, user_name text,
+                                                        module_name text not null, function_name text not null, event_count bigint not null,
+                                                        primary key (bucket_time, module_name, function_name, user_guid))'''
+
+UPSERT_SQL = '''insert into gy_log_rollup(bucket_time, user_guid, user_name, module_name, function_name, event_count) values %s
+                on conflict (bucket_time, module_name, function_name, user_guid)
+                do update set event_count = gy_log_rollup.event_count + excluded.event_count, user_name = excluded.user_name'''
+
+# 由日志表重建汇总表,param_json不是有效的JSON时gy_log_param返回NULL
+REBUILD_SQL = '''delete from gy_log_rollup;
+                 insert into gy_log_rollup(bucket_time, user_guid, user_name, module_name, function_name, event_count)
+                 select date_trunc('hour', event_time), coalesce(user_guid, ''), max(user_name),
+                        coalesce(gy_log_param(param_json, 'moduleName'), ''), coalesce(gy_log_param(param_json, 'functionName'), ''), count(*)
+                 from gy_log where event_time is not null group by 1, 2, 4, 5'''
+
+# 多个进程同时启动时依次创建,之后的进程检查到已经存在时跳过
+LOCK_SQL = "select pg_advisory_xact_lock(hashtext('gy_log_rollup'))"
+
+LOGGER = logging.getLogger(__name__)
+
+# 汇总表是否可用、最近一次重建的结果
+ROLLUP_REGISTRY = {}
+ROLLUP_LOCK = threading.Lock()
+
+
+def rollup_key(record):
+    """日志记录对应的汇总键
+    参数：
+       record：日志记录元组(user_guid, user_name, event_description, param_json, event_time)
+    返回值：
+       (小时, 模块, 函数, 用户标识),与汇总表的主键相同;没有事件时间时返回None
+    """
+    user_guid, _, _, param_json, event_time = record
+    if event_time is None:
+        return None
+    try:
+        param_dict = json.loads(param_json) if param_json else {}
+    except ValueError:
+        param_dict = {}
+    if not isinstance(param_dict, dict):
+        param_dict = {}
+    return (event_time.replace(minute=0, second=0, microsecond=0), str(param_dict.get('moduleName', '')), str(param_dict.get('functionName',
+                                                                                                                             '')), user_guid or '')
+
+
+def update_rollup(cursor, batch):
+    """将一批日志的计数累加到汇总表,与日志的写入在同一个事务中执行
+       多个进程同时写入时按照主键顺序更新,避免死锁
+    参数：
+       cursor：写入日志的事务中的游标
+       batch：日志记录元组的列表
+    返回值：
+    """
+    counter = collections.Counter(rollup_key(x) for x in batch)
+    counter.pop(None, None)
+    # 同一个用户标识使用本批中最后的用户名,同一条语句中主键不能重复
+    user_names = {x[0] or '': x[1] for x in batch}
+    value_list = [(x[0], x[3], user_names[x[3]], x[1], x[2], counter[x]) for x in sorted(counter)]
+    psycopg2.extras.execute_values(cursor, UPSERT_SQL, value_list)
+
+
+def is_ready():
+    """汇总表是否可用,不可用时(创建失败或者没有调用init_app)日志写入时不更新汇总表
+    """
+    return ROLLUP_REGISTRY.get('ready', False)
+
+
+def ensure_table(pool):
+    """创建汇总表,已经存在时跳过
+    参数：
+       pool：数据库连接池
+    返回值：
+       是否新创建了汇总表
+    """
+    connection = pool.getconn()
+    # 连接可能处于自动提交模式,咨询锁和语句需要在同一个事务中
+    connection.autocommit = False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(LOCK_SQL)
+            cursor.execute("select to_regclass('gy_log_rollup') is null")
+            created = cursor.fetchone()[0]
+            cursor.execute(TABLE_SQL)
+        connection.commit()
+        return created
+    except psycopg2.Error:
+        connection.rollback()
+        raise
+    finally:
+        pool.putconn(connection)
+
+
+def rebuild(pool):
+    """由日志表重建汇总表,重建期间锁定日志表的写入(日志由后台线程批量写入,请求不受影响)
+    参数：
+       pool：数据库连接池
+    返回值：
+       汇总表的记录数
+    """
+    connection = pool.getconn()
+    connection.autocommit = False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(LOCK_SQL)
+            cursor.execute("select set_config('statement_timeout', '0', true)")
+            cursor.execute("select to_regprocedure('gy_log_param(text,text)') is null")
+            if cursor.fetchone()[0]:
+                cursor.execute(PARAM_FUNCTION_SQL)
+            cursor.execute('lock table gy_log in share mode')
+            cursor.execute(REBUILD_SQL)
+            row_count = cursor.rowcount
+        connection.commit()
+        return row_count
+    except psycopg2.Error:
+        connection.rollback()
+        raise
+    finally:
+        pool.putconn(connection)
+
+
+def init_app(app):
+    """创建汇总表,新创建时在后台线程中由已有的日志重建;需要在connection_pool.init_app之后、日志开始写入之前调用
+    参数：
+       app：Flask应用
+    返回值：
+    """
+    ROLLUP_REGISTRY['pool'] = app.extensions['pg_pool']
+    try:
+        created = ensure_table(ROLLUP_REGISTRY['pool'])
+    except (psycopg2.Error, PoolTimeoutError) as exception:
+        # 汇总表不可用时只写入日志,不影响日志的记录
+        LOGGER.exception('failed to create gy_log_rollup')
+        with ROLLUP_LOCK:
+            ROLLUP_REGISTRY['last'] = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'rowCount': None, 'error': repr(exception)}
+        return
+    ROLLUP_REGISTRY['ready'] = True
+    if created:
+        threading.Thread(target=run_rebuild, name='pg-log-rollup', daemon=True).start()
+
+
+def run_rebuild():
+    """重建汇总表,失败时记录到应用日志
+    """
+    try:
+        row_count = rebuild(ROLLUP_REGISTRY['pool'])
+        error = None
+    except (psycopg2.Error, PoolTimeoutError) as exception:
+        row_count = None
+        error = repr(exception)
+        LOGGER.exception('failed to rebuild gy_log_rollup')
+    with ROLLUP_LOCK:
+        ROLLUP_REGISTRY['last'] = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'rowCount': row_count, 'error': error}
+
+
+def statistics():
+    """汇总表的状态
+    返回值：
+       字典形式,包括汇总表是否可用,最近一次重建的时间、汇总表的记录数和失败时的异常信息
+    """
+    with ROLLUP_LOCK:
+        return {'ready': ROLLUP_REGISTRY.get('ready', False), 'last': dict(ROLLUP_REGISTRY.get('last', {}))}
+
+
+def main():
+    """命令行入口,rebuild由日志表重建汇总表
+    """
+    parser = argparse.ArgumentParser(description='用户操作日志的汇总表(gy_log_rollup)')
+    parser.add_argument('command', choices=('rebuild',), help='rebuild由日志表重建汇总表')
+    parser.parse_args()
+
+    # 只创建连接池,不加载蓝图等其它模块
+    app = Flask(__name__)
+    app.config.from_object('toolbox.flask_config.DevelopmentConfig')
+    pool = connection_pool.init_app(app)
+    ensure_table(pool)
+    start_time = time.perf_counter()
+    print(f'rebuilt {rebuild(pool)} rollup rows in {time.perf_counter() - start_time:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+"""用户操作日志的检索模块,检索条件使用参数化的LIKE '%文本%',不再拼接检索文本;
+   user_name、event_description和param_json中配置的字段(PG_LOG_SEARCH_PARAM_KEYS)上建立pg_trgm的GIN三元组索引,
+   检索文本不少于3个字符时,LIKE '%文本%'可以使用索引,不再扫描整个日志表;
+   检索条件使用的gy_log_param函数由应用启动时创建(已存在时跳过),启动时数据库不可用则在第一次检索时创建;
+   建立索引需要较长时间,不在应用启动时执行,在项目根目录执行一次:
+       python -m toolbox.log_search create-indexes
+   索引使用CREATE INDEX CONCURRENTLY逐个分区建立,不阻塞日志的写入;
+   gy_log为分区表时,先在父表上建立(ONLY)分区索引,各分区的索引建立完成后挂载(ATTACH)到父表的索引上,
+   之后创建的分区(toolbox.log_partition)自动建立索引;中断后重新执行时跳过已完成的分区,重建无效(INVALID)的索引
+"""
+import argparse
+import logging
+import re
+import threading
+import time
+
+import psycopg2
+from flask import Flask
+from psycopg2 import sql
+
+from . import connection_pool
+from .connection_pool import PoolTimeoutError
+
+# 默认检索的param_json字段
+DEFAULT_SEARCH_PARAM_KEYS = ('name',)
+
+# 三元组索引可以使用的最短检索文本长度
+MIN_TRIGRAM_LENGTH = 3
+
+# param_json中的字段名只允许字母、数字和下划线,以常量写入索引表达式和检索条件,两者一致时才能使用索引
+PARAM_KEY_PATTERN = re.compile(r'^\w+$')
+
+# 获取param_json字段值的函数,param_json不是有效的JSON时返回NULL,索引表达式需要IMMUTABLE函数;
+# 捕获异常需要子事务,不能在并行查询中执行,因此不声明为parallel safe
+PARAM_FUNCTION_SQL = '''create or replace function gy_log_param(param_json text, param_key text) returns text
+                        language plpgsql immutable as $$
+                        begin
+                            return param_json::jsonb ->> param_key;
+                        exception when others then
+                            return null;
+                        end $$'''
+
+# 多个进程同时启动时依次创建函数,避免同时替换函数的冲突
+FUNCTION_LOCK_SQL = "select pg_advisory_xact_lock(hashtext('gy_log_search_function'))"
+
+FUNCTION_EXISTS_SQL = "select to_regprocedure('gy_log_param(text, text)') is not null"
+
+IS_PARTITIONED_SQL = "select exists(select 1 from pg_partitioned_table where partrelid = to_regclass(%s))"
+PARTITIONS_SQL = 'select C.relname from pg_inherits I join pg_class C on C.oid = I.inhrelid where I.inhparent = to_regclass(%s) order by 1'
+
+# 索引是否存在及是否有效,不存在时返回NULL
+INDEX_VALID_SQL = 'select X.indisvalid from pg_index X where X.indexrelid = to_regclass(%s)'
+
+# 分区上是否已有挂载到父表索引的索引(例如分区创建时自动建立的索引)
+ATTACHED_SQL = '''select exists(select 1 from pg_inherits I join pg_index X on X.indexrelid = I.inhrelid
+                                where I.inhparent = to_regclass(%s) and X.indrelid = to_regclass(%s))'''
+
+LOGGER = logging.getLogger(__name__)
+
+# 函数创建的配置和结果
+INDEX_REGISTRY = {}
+INDEX_LOCK = threading.Lock()
+
+
+def search_columns(param_keys):
+    """检索的字段表达式列表
+    参数：
+       param_keys：检索的param_json字段名列表
+    返回值：
+       字段表达式列表
+    """
+    for key in param_keys:
+        if not PARAM_KEY_PATTERN.match(key):
+            raise ValueError(f'invalid param_json key: {key}')
+    return ['user_name', 'event_description'] + [f"gy_log_param(param_json, '{key}')" for key in param_keys]
+
+
+def escape_like(search_text):
+    """转义LIKE的通配符,检索文本按照字面匹配
+    """
+    return search_text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search_condition(search_text, param_keys=DEFAULT_SEARCH_PARAM_KEYS):
+    """检索条件,任意一个检索字段包含检索文本(区分大小写,与原来的position相同);
+       应用启动时没有创建gy_log_param函数(例如数据库不可用)时在这里创建
+    参数：
+       search_text：检索文本
+       param_keys：检索的param_json字段名列表
+    返回值：
+       (查询条件, 参数列表)
+    """
+    columns = search_columns(param_keys)
+    if INDEX_REGISTRY.get('pool') is not None and not function_installed():
+        run_ensure_function()
+    pattern = '%' + escape_like(search_text) + '%'
+    return '(' + ' or '.join(f'{x} like %s' for x in columns) + ')', [pattern] * len(columns)
+
+
+def index_definitions(param_keys=DEFAULT_SEARCH_PARAM_KEYS):
+    """三元组索引的名称后缀和索引表达式
+    参数：
+       param_keys：检索的param_json字段名列表
+    返回值：
+       [(名称后缀, 字段表达式), ...]
+    """
+    return list(zip(['user_name', 'event_description'] + [f'param_{x}' for x in param_keys], search_columns(param_keys)))
+
+
+def index_statement(index_name, table_name, column, concurrently=False, only=False):
+    """创建三元组索引的语句
+    参数：
+       index_name：索引名称
+       table_name：表名称
+       column：字段表达式
+       concurrently：是否使用CONCURRENTLY,不阻塞表的写入
+       only：是否只在分区表的父表上建立(各分区的索引之后挂载)
+    返回值：
+       语句
+    """
+    return sql.SQL('create index {} if not exists {} on {} {} using gin (({}) gin_trgm_ops)').format(sql.SQL('concurrently' if concurrently else ''),
+                                                                                                     sql.Identifier(index_name),
+                                                                                                     sql.SQL('only' if only else ''),
+                                                                                                     sql.Identifier(table_name), sql.SQL(column))
+
+
+def ensure_function(pool):
+    """创建gy_log_param函数,已存在时跳过
+    参数：
+       pool：数据库连接池
+    返回值：
+       是否新创建了函数
+    """
+    connection = pool.getconn()
+    # 连接可能处于自动提交模式,咨询锁和语句需要在同一个事务中
+    connection.autocommit = False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(FUNCTION_LOCK_SQL)
+            cursor.execute(FUNCTION_EXISTS_SQL)
+            if cursor.fetchone()[0]:
+                connection.rollback()
+                return False
+            cursor.execute(PARAM_FUNCTION_SQL)
+        connection.commit()
+        return True
+    except psycopg2.Error:
+        connection.rollback()
+        raise
+    finally:
+        pool.putconn(connection)
+
+
+def create_index_concurrently(cursor, index_name, table_name, column):
+    """使用CREATE INDEX CONCURRENTLY建立一个表(或分区)的索引,之前中断留下的无效索引先删除再重建
+    参数：
+       cursor：自动提交模式的游标
+       index_name：索引名称
+       table_name：表名称
+       column：字段表达式
+    返回值：
+       是否新建立了索引
+    """
+    cursor.execute(INDEX_VALID_SQL, (index_name,))
+    valid = cursor.fetchone()
+    if valid is not None and valid[0]:
+        return False
+    if valid is not None:
+        cursor.execute(sql.SQL('drop index concurrently if exists {}').format(sql.Identifier(index_name)))
+    cursor.execute(index_statement(index_name, table_name, column, concurrently=True))
+    return True
+
+
+def create_indexes(pool, param_keys=DEFAULT_SEARCH_PARAM_KEYS, table_name='gy_log'):
+    """创建pg_trgm扩展、gy_log_param函数和三元组索引,已存在的有效索引跳过;
+       分区表逐个分区使用CONCURRENTLY建立索引并挂载到父表的索引上,普通表直接使用CONCURRENTLY建立索引
+    参数：
+       pool：数据库连接池
+       param_keys：检索的param_json字段名列表
+       table_name：日志表名称,基准测试时为测试表
+    返回值：
+       新建立的索引名称列表
+    """
+    ensure_function(pool)
+    created = []
+    connection = pool.getconn()
+    # CREATE INDEX CONCURRENTLY不能在事务中执行
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            # 建立大表的索引需要较长时间,不受语句超时时间的限制;连接归还时关闭,不保留会话设置
+            cursor.execute('set statement_timeout = 0')
+            cursor.execute('create extension if not exists pg_trgm')
+            cursor.execute(IS_PARTITIONED_SQL, (table_name,))
+            if not cursor.fetchone()[0]:
+                for suffix, column in index_definitions(param_keys):
+                    if create_index_concurrently(cursor, f'{table_name}_{suffix}_trgm_idx', table_name, column):
+                        created.append(f'{table_name}_{suffix}_trgm_idx')
+                return created
+
+            cursor.execute(PARTITIONS_SQL, (table_name,))
+            partitions = [x[0] for x in cursor.fetchall()]
+            for suffix, column in index_definitions(param_keys):
+                parent_index = f'{table_name}_{suffix}_trgm_idx'
+                # 父表上的分区索引在所有分区的索引挂载之前是无效的,只修改系统表,不扫描数据
+                cursor.execute(INDEX_VALID_SQL, (parent_index,))
+                if cursor.fetchone() is None:
+                    cursor.execute(index_statement(parent_index, table_name, column, only=True))
+                    created.append(parent_index)
+                for partition in partitions:
+                    cursor.execute(ATTACHED_SQL, (parent_index, partition))
+                    if cursor.fetchone()[0]:
+                        continue
+                    partition_index = f'{partition}_{suffix}_trgm_idx'
+                    if create_index_concurrently(cursor, partition_index, partition, column):
+                        created.append(partition_index)
+                    cursor.execute(
+                        sql.SQL('alter index {} attach partition {}').format(sql.Identifier(parent_index), sql.Identifier(partition_index)))
+        return created
+    finally:
+        pool.putconn(connection, close=True)
+
+
+def function_installed():
+    """gy_log_param函数是否已经创建
+    """
+    with INDEX_LOCK:
+        return INDEX_REGISTRY.get('last', {}).get('installed', False)
+
+
+def init_app(app):
+    """创建检索条件使用的gy_log_param函数,在处理请求之前完成;需要在connection_pool.init_app之后调用;
+       数据库不可用时记录到应用日志,不影响应用启动,第一次检索时再次创建
+    参数：
+       app：Flask应用
+    返回值：
+    """
+    INDEX_REGISTRY['pool'] = app.extensions['pg_pool']
+    run_ensure_function()
+
+
+def run_ensure_function():
+    """创建gy_log_param函数,创建失败时记录到应用日志
+    """
+    start_time = time.perf_counter()
+    try:
+        ensure_function(INDEX_REGISTRY['pool'])
+        installed = True
+        error = None
+    except (psycopg2.Error, PoolTimeoutError) as exception:
+        installed = False
+        error = repr(exception)
+        LOGGER.exception('failed to create gy_log_param function')
+    with INDEX_LOCK:
+        INDEX_REGISTRY['last'] = {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'duration': (time.perf_counter() - start_time) * 1000,
+            'installed': installed,
+            'error': error
+        }
+
+
+def statistics():
+    """最近一次创建gy_log_param函数的信息
+    返回值：
+       字典形式,包括时间、耗时(毫秒)、函数是否可用,失败时的异常信息
+    """
+    with INDEX_LOCK:
+        return dict(INDEX_REGISTRY.get('last', {}))
+
+
+def main():
+    """命令行入口,create-indexes创建检索使用的三元组索引
+    """
+    parser = argparse.ArgumentParser(description='用户操作日志检索的三元组索引')
+    parser.add_argument('command', choices=('create-indexes',), help='create-indexes逐个分区创建三元组索引')
+    parser.parse_args()
+
+    # 只创建连接池,不加载蓝图等其它模块
+    app = Flask(__name__)
+    app.config.from_object('toolbox.flask_config.DevelopmentConfig')
+    pool = connection_pool.init_app(app)
+    param_keys = tuple(app.config.get('PG_LOG_SEARCH_PARAM_KEYS', DEFAULT_SEARCH_PARAM_KEYS))
+    start_time = time.perf_counter()
+    created = create_indexes(pool, param_keys)
+    print(f'created {len(created)} indexes in {(time.perf_counter() - start_time):.1f} s: {created}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,85 @@
 """postgresql数据库操作模块，使用psycopg2包,
-   一直存在建立连接执行数据库操作后立即关闭连接，还是一个用户登录后一直保持一个连接??
+   数据库连接从应用的连接池(toolbox.connection_pool)中获取;
+   在请求(应用上下文)中,所有PgHelper共享一个连接和事务,由请求结束时统一提交或回滚;
+   没有应用上下文时(后台线程等),PgHelper独占一个连接,每次操作后立即提交;
+   只读查询在自动提交模式下执行,没有BEGIN、COMMIT的额外往返,第一次写操作时才开启事务;
+   大结果集使用服务端命名游标流式读取,内存占用与结果集大小无关;
+   频繁执行的单条语句通过连接上的预备语句缓存(toolbox.statement_cache)执行;
+   多行数据的写入使用execute_values合并为一条语句,避免逐行拼接INSERT语句;
+   配置了只读库时,query_*查询使用只读库,execute_*写操作使用主库,写操作之后的查询固定使用主库;
+   数据库连接在第一次执行语句时获取,只使用主库或只读库的请求不占用另一个连接池的连接;
+   列表查询可以使用query_json在数据库中通过json_agg序列化为JSON,直接得到编码后的字节;
+   每次执行语句的耗时按照调用的接口记录到toolbox.query_metrics,超过阈值的记录慢查询日志;
+   语句的超时时间、请求截止时间和客户端断开时的取消由toolbox.query_timeout处理
 """
-import psycopg2
+import itertools
+import time
+
+import psycopg2.extensions
 import psycopg2.extras
+from flask import (current_app, has_app_context)
+from psycopg2 import sql
+
+from . import (query_metrics, query_timeout)
+from .connection_pool import (checkout_replica, context_connection, context_replica_connection, get_pool, is_primary_pinned, mark_rollback_only,
+                              pin_primary)
+from .statement_cache import execute_cached
+
+# 服务端命名游标的序号,保证同一连接上游标名称唯一
+CURSOR_COUNTER = itertools.count()
+
+# 服务端游标每次从数据库获取的记录数,可通过配置PG_STREAM_ITERSIZE修改
+DEFAULT_ITERSIZE = 2000
+
+# 批量写入时每条语句包含的最大行数,可通过配置PG_BULK_PAGE_SIZE修改
+DEFAULT_BULK_PAGE_SIZE = 5000
 
 
+def json_agg_sql(sql_string):
+    """将查询语句包装为json_agg聚合查询,数据库返回整个结果集序列化后的一个JSON数组文本,
+       每条记录为一个JSON对象,键为查询结果的列名(别名)
+    参数：
+       sql_string：SQL语句（SELECT、WITH等）
+    返回值：
+       包装后的SQL语句
+    """
+    return "select coalesce(json_agg(pg_helper_json_row), '[]')::text from (" + sql_string.strip().rstrip(';') + ") pg_helper_json_row"
+
+
+# pylint: disable=too-many-instance-attributes
 class PgHelper:
     """ Python操作PostgreSQL数据库的类
     相关详细描述
     类的相关属性描述
     """
+    __pool__ = None
     __connection__ = None
     __cursor__ = None
+    __replica_pool__ = None
+    __replica_connection__ = None
+    __replica_cursor__ = None
+    __shared__ = False
+    __pinned__ = False
+    __read_your_writes__ = True
+    __statement_timeout__ = None
+    __lock_timeout__ = None
 
-    def __init__(self):
-        """ 类的构造函数,创建数据库连接,打开游标进行数据库操作
+    def __init__(self, shared=True, read_your_writes=True, statement_timeout=None, lock_timeout=None):
+        """ 类的构造函数,第一次执行语句时获取数据库连接,打开游标进行数据库操作
+            请求中使用请求共享的连接,否则从连接池获取连接,在析构函数中归还连接池
         参数：
+           shared：请求中是否使用请求共享的连接和事务,
+                   为False时独占连接(例如在响应返回后继续读取的流式查询)
+           read_your_writes：写操作之后的查询是否固定使用主库,
+                   为False时写操作不影响查询的路由(例如与业务数据无关的日志写入)
+           statement_timeout：本对象执行语句的超时时间,单位为毫秒,默认使用接口的配置或全局配置
+           lock_timeout：本对象执行语句的锁等待超时时间,单位为毫秒,默认使用接口的配置或全局配置
         返回值：
         """
-        try:
-            self.__connection__ = psycopg2.connect(host="192.168.1.177", port="5432", dbname="pepper", user="postgres", password="Gis123")
-            self.__cursor__ = self.__connection__.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        except Exception:
-            ...
-            raise
+        self.__shared__ = shared and has_app_context()
+        self.__read_your_writes__ = read_your_writes
+        self.__statement_timeout__ = statement_timeout
+        self.__lock_timeout__ = lock_timeout
 
     def query_datatable(self, sql_string, param_tuple=None):
         """查询函数,查询多条记录
@@ -35,13 +91,17 @@ class PgHelper:
            列表形式
            [(1, 100, "abc'def"), (2, None, 'dada'), (3, 42, 'bar')]
         """
+        cursor = self.__read_cursor()
         try:
-            self.__cursor__.execute(sql_string, param_tuple)
-            query_result = self.__cursor__.fetchall()
-            self.__connection__.commit()
-            return query_result
+            self.__begin_read(cursor.connection)
+            start_time = time.perf_counter()
+            with self.__guard(cursor.connection):
+                execute_cached(cursor, sql_string, param_tuple)
+                records = cursor.fetchall()
+            self.__observe(cursor.connection, sql_string, param_tuple, start_time, read=True)
+            return records
         except Exception:
-            self.__connection__.rollback()
+            self.__rollback(cursor.connection)
             raise
 
     def query_single_value(self, sql_string, param_tuple=None):
@@ -52,14 +112,79 @@ class PgHelper:
         返回值：
            单个数值
         """
+        cursor = self.__read_cursor()
         try:
-            self.__cursor__.execute(sql_string, param_tuple)
-            query_result = (self.__cursor__.fetchone())[0]
-            self.__connection__.commit()
-            return query_result
+            self.__begin_read(cursor.connection)
+            start_time = time.perf_counter()
+            with self.__guard(cursor.connection):
+                execute_cached(cursor, sql_string, param_tuple)
+                value = (cursor.fetchone())[0]
+            self.__observe(cursor.connection, sql_string, param_tuple, start_time, read=True)
+            return value
+        except Exception:
+            self.__rollback(cursor.connection)
+            raise
+
+    def query_json(self, sql_string, param_tuple=None):
+        """JSON查询函数,在数据库中使用json_agg将结果集序列化为JSON数组,
+           以字节形式返回,不经过Python的解码、字典复制和JSON编码,可直接写入响应(toolbox.json_response)
+        参数：
+           sql_string：SQL语句（SELECT等）
+           param_tuple：参数元组
+        返回值：
+           UTF-8编码的JSON数组
+           b'[{"id":1,"name":"abc"}, {"id":2,"name":"def"}]'
+        """
+        connection = self.__read_cursor().connection
+        try:
+            self.__begin_read(connection)
+            with connection.cursor() as cursor, self.__guard(connection):
+                # 文本类型直接返回数据库的原始字节,不解码为字符串
+                psycopg2.extensions.register_type(psycopg2.extensions.BYTES, cursor)
+                start_time = time.perf_counter()
+                execute_cached(cursor, json_agg_sql(sql_string), param_tuple)
+                records_json = cursor.fetchone()[0]
+            self.__observe(connection, sql_string, param_tuple, start_time, read=True)
+            return records_json
+        except Exception:
+            self.__rollback(connection)
+            raise
+
+    def query_iterator(self, sql_string, param_tuple=None, itersize=None):
+        """流式查询函数,使用服务端命名游标分批获取记录,逐条返回,
+           适用于日志导出等大结果集,内存占用只与itersize有关;
+           服务端游标需要在事务中使用,迭代结束(或中途关闭)后关闭游标
+        参数：
+           sql_string：SQL语句（SELECT等）
+           param_tuple：参数元组
+           itersize：每次从数据库获取的记录数,默认使用配置PG_STREAM_ITERSIZE
+        返回值：
+           生成器,每条记录为字典形式
+           {'id': 1, 'userName': 'admin'}
+        """
+        if itersize is None:
+            itersize = current_app.config.get('PG_STREAM_ITERSIZE', DEFAULT_ITERSIZE) if has_app_context() else DEFAULT_ITERSIZE
+
+        connection = self.__read_cursor().connection
+        self.__begin_transaction(connection)
+        # 流式查询在响应返回过程中读取,不受请求截止时间的限制,每次FETCH受语句超时时间的限制
+        query_timeout.apply_timeouts(connection, query_timeout.resolve_timeouts(self.__statement_timeout__, self.__lock_timeout__))
+        cursor = connection.cursor(name=f'pg_helper_stream_{next(CURSOR_COUNTER)}', cursor_factory=psycopg2.extras.RealDictCursor)
+        cursor.itersize = itersize
+        try:
+            cursor.execute(sql_string, param_tuple)
+            yield from cursor
         except Exception:
-            self.__connection__.rollback()
+            self.__rollback(connection)
             raise
+        finally:
+            try:
+                cursor.close()
+            except psycopg2.Error:
+                ...
+            # 独占连接的只读事务在这里结束,共享连接的事务由请求结束时处理
+            if not self.__shared__ and not connection.closed:
+                connection.rollback()
 
     def execute_sql(self, ddml_sql, param_tuple=None):
         """SQL语句执行函数,多个语句使用分号;分割
@@ -70,13 +195,66 @@ class PgHelper:
            param_tuple：参数元组
         返回值：
         """
+        cursor = self.__write_cursor()
         try:
-            self.__cursor__.execute(ddml_sql, param_tuple)
-            self.__connection__.commit()
+            start_time = time.perf_counter()
+            with self.__guard(cursor.connection):
+                execute_cached(cursor, ddml_sql, param_tuple)
+            self.__observe(cursor.connection, ddml_sql, param_tuple, start_time)
+            self.__commit()
         except Exception:
-            self.__connection__.rollback()
+            self.__rollback(cursor.connection)
             raise
 
+    def execute_values(self, ddml_sql, value_list, template=None, page_size=None):
+        """批量SQL语句执行函数,使用psycopg2.extras.execute_values将多行数据合并到一条语句中执行
+              INSERT INTO some_table (an_int, a_string) VALUES %s;
+              [(10, "O'Reilly"), (20, 'abc')]
+        参数：
+           ddml_sql：包含一个VALUES %s占位符的SQL语句（Insert、Upsert等）
+           value_list：行数据列表,每行为一个元组
+           template：单行数据的模板,默认为(%s, %s, ...)
+           page_size：每条语句包含的最大行数,默认使用配置PG_BULK_PAGE_SIZE
+        返回值：
+        """
+        if not value_list:
+            return
+        if page_size is None:
+            page_size = current_app.config.get('PG_BULK_PAGE_SIZE', DEFAULT_BULK_PAGE_SIZE) if has_app_context() else DEFAULT_BULK_PAGE_SIZE
+
+        cursor = self.__write_cursor()
+        try:
+            start_time = time.perf_counter()
+            with self.__guard(cursor.connection):
+                psycopg2.extras.execute_values(cursor, ddml_sql, value_list, template=template, page_size=page_size)
+            self.__observe(cursor.connection, ddml_sql, None, start_time)
+            self.__commit()
+        except Exception:
+            self.__rollback(cursor.connection)
+            raise
+
+    def bulk_insert(self, table_name, column_names, value_list, conflict_columns=None):
+        """批量插入函数,conflict_columns不为空时冲突的行更新其余的列(Upsert)
+              bulk_insert('gy_user_role', ('user_guid', 'role_guid'), [('guid1', 'guid2'), ('guid1', 'guid3')])
+        参数：
+           table_name：表名称
+           column_names：列名称元组
+           value_list：行数据列表,每行为与列名称顺序一致的元组
+           conflict_columns：唯一约束的列名称元组,为空时直接插入
+        返回值：
+        """
+        insert_sql = sql.SQL('INSERT INTO {}({}) VALUES %s').format(sql.Identifier(table_name), sql.SQL(',').join(map(sql.Identifier, column_names)))
+        if conflict_columns:
+            update_columns = [x for x in column_names if x not in conflict_columns]
+            insert_sql += sql.SQL(' ON CONFLICT ({}) ').format(sql.SQL(',').join(map(sql.Identifier, conflict_columns)))
+            if update_columns:
+                insert_sql += sql.SQL('DO UPDATE SET ') + sql.SQL(',').join(
+                    sql.SQL('{0}=EXCLUDED.{0}').format(sql.Identifier(x)) for x in update_columns)
+            else:
+                insert_sql += sql.SQL('DO NOTHING')
+
+        self.execute_values(insert_sql, value_list)
+
     def execute_func(self, func_name, param_tuple=None):
         """执行PostgreSQL数据库中写的函数或者过程
            __cursor__.callproc('function name', tuple)与
@@ -87,21 +265,133 @@ class PgHelper:
         返回值：
            数据库中函数的返回值
         """
+        cursor = self.__write_cursor()
         try:
-            self.__cursor__.callproc(func_name, param_tuple)
-            query_result = self.__cursor__.fetchall()
-            self.__connection__.commit()
+            start_time = time.perf_counter()
+            with self.__guard(cursor.connection):
+                cursor.callproc(func_name, param_tuple)
+                query_result = cursor.fetchall()
+            self.__observe(cursor.connection, f'select * from {func_name}()', param_tuple, start_time)
+            self.__commit()
             return query_result
         except Exception:
-            self.__connection__.rollback()
+            self.__rollback(cursor.connection)
             raise
 
+    def __read_cursor(self):
+        """获取查询使用的游标,优先使用只读库;
+           没有可用的只读库或者已经执行过写操作(读己之写)时使用主库
+        """
+        if self.__pinned__ or is_primary_pinned():
+            return self.__write_cursor(pin=False)
+        if self.__replica_cursor__ is None:
+            if self.__shared__:
+                self.__replica_connection__ = context_replica_connection()
+            else:
+                self.__replica_pool__, self.__replica_connection__ = checkout_replica()
+            if self.__replica_connection__ is None:
+                return self.__write_cursor(pin=False)
+            self.__replica_cursor__ = self.__replica_connection__.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        return self.__replica_cursor__
+
+    def __write_cursor(self, pin=True):
+        """获取主库连接上的游标,写操作时关闭自动提交模式并固定之后的查询使用主库
+        参数：
+           pin：是否为写操作
+        返回值：
+           主库连接上的游标
+        """
+        if self.__cursor__ is None:
+            if self.__shared__:
+                self.__connection__ = context_connection()
+            else:
+                self.__pool__ = get_pool()
+                self.__connection__ = self.__pool__.getconn()
+            self.__cursor__ = self.__connection__.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        if pin:
+            self.__begin_transaction(self.__connection__)
+            if self.__read_your_writes__:
+                self.__pinned__ = True
+                pin_primary()
+        return self.__cursor__
+
+    def __guard(self, connection):
+        """执行语句的上下文,设置语句超时、锁等待超时时间,截止时间已过或者客户端断开时取消语句
+        """
+        return query_timeout.guard(connection, self.__statement_timeout__, self.__lock_timeout__)
+
+    @staticmethod
+    def __observe(connection, sql_string, param_tuple, start_time, read=False):
+        """记录语句的执行耗时;开启PG_SLOW_QUERY_EXPLAIN时,自动提交模式下的慢查询再执行一次EXPLAIN ANALYZE获取执行计划,
+           EXPLAIN ANALYZE会实际执行语句,写操作和事务中的查询不获取,获取失败不影响查询结果
+        参数：
+           connection：执行语句的连接
+           sql_string：SQL语句,可以为psycopg2.sql的组合语句
+           param_tuple：参数元组
+           start_time：开始执行的时间
+           read：是否为只读查询
+        返回值：
+        """
+        if isinstance(sql_string, sql.Composable):
+            sql_string = sql_string.as_string(connection)
+        slow_query = query_metrics.record(sql_string, param_tuple, start_time)
+        if slow_query is None or not read or not connection.autocommit or not query_metrics.explain_enabled():
+            return
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(query_metrics.explain_sql(sql_string), param_tuple)
+                query_metrics.record_plan(slow_query, cursor.fetchone()[0])
+        except psycopg2.Error:
+            ...
+
+    @staticmethod
+    def __begin_read(connection):
+        """只读查询前调用,连接没有进行中的事务时切换为自动提交模式,
+           查询不再产生BEGIN、COMMIT的数据库往返;
+           已有未提交的写事务时仍在事务中查询,保证读取到本事务写入的数据
+        """
+        if (not connection.autocommit and connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+            connection.autocommit = True
+
+    @staticmethod
+    def __begin_transaction(connection):
+        """写操作和服务端游标前调用,关闭自动提交模式,由下一条语句开启事务
+        """
+        if connection.autocommit:
+            connection.autocommit = False
+
+    def __commit(self):
+        """提交事务,共享连接的事务由请求结束时统一提交
+        """
+        if not self.__shared__:
+            self.__connection__.commit()
+
+    def __rollback(self, connection):
+        """回滚事务,共享主库连接的事务标记为只能回滚,由请求结束时统一回滚;
+           只读库的连接上没有写入的数据,直接回滚
+        """
+        if self.__shared__ and connection is self.__connection__:
+            mark_rollback_only()
+        elif not connection.closed:
+            connection.rollback()
+
+    def __release(self):
+        """独占的连接归还各自的连接池,共享连接由请求结束时归还
+        """
+        if not self.__shared__:
+            if self.__connection__ is not None:
+                self.__pool__.putconn(self.__connection__)
+            if self.__replica_connection__ is not None:
+                self.__replica_pool__.putconn(self.__replica_connection__)
+        self.__connection__ = None
+        self.__replica_connection__ = None
+
     def __del__(self):
-        """ 类的析构函数,清除数据库连接,清除数据库游标
-        """
-        if self.__cursor__ is not None:
-            self.__cursor__.close()
-            self.__cursor__ = None
-        if self.__connection__ is not None:
-            self.__connection__.close()
-            self.__connection__ = None
+        """ 类的析构函数,清除数据库游标,独占的连接归还连接池
+        """
+        for cursor in (self.__cursor__, self.__replica_cursor__):
+            if cursor is not None and not cursor.closed:
+                cursor.close()
+        self.__cursor__ = None
+        self.__replica_cursor__ = None
+        self.__release()
@@ -0,0 +1,184 @@
+"""数据库语句执行监控模块,记录PgHelper、AsyncPgHelper每次执行语句的耗时,
+   按照语句指纹(常量替换为?、合并空白后的SQL)汇总执行次数、累计耗时和耗时分布(直方图),
+   并按照调用的接口(Flask endpoint)分别统计;
+   耗时超过阈值(PG_SLOW_QUERY_THRESHOLD)的语句记录慢查询日志,包括语句指纹和参数,
+   开启PG_SLOW_QUERY_EXPLAIN时,慢的只读查询再执行一次EXPLAIN (ANALYZE, BUFFERS)记录执行计划
+"""
+import collections
+import hashlib
+import logging
+import re
+import threading
+import time
+
+from flask import (current_app, has_app_context, has_request_context, request)
+
+# 耗时直方图的分桶上限,单位为毫秒,最后一个分桶为超过5000毫秒
+HISTOGRAM_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# 默认的慢查询阈值(毫秒)和保留的慢查询记录数,可通过配置PG_SLOW_QUERY_THRESHOLD、PG_SLOW_QUERY_HISTORY修改
+DEFAULT_SLOW_QUERY_THRESHOLD = 500
+DEFAULT_SLOW_QUERY_HISTORY = 100
+
+# 最多统计的语句指纹数,拼接生成的语句过多时不再增加新的指纹
+MAX_STATEMENT_COUNT = 1000
+
+# 慢查询日志中参数的最大长度
+MAX_PARAM_LENGTH = 1000
+
+LOGGER = logging.getLogger(__name__)
+
+# 所有语句的统计信息
+METRICS_LOCK = threading.Lock()
+STATEMENT_METRICS = {}
+SLOW_QUERIES = collections.deque()
+OVERFLOW_COUNTER = collections.Counter()
+
+# 语句指纹中替换的常量:字符串、数字
+LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def fingerprint(sql_string):
+    """语句指纹,字符串和数字常量替换为?,合并空白并转为小写,
+       只有常量不同的语句(例如拼接生成的检索条件、分页)汇总为同一指纹
+    参数：
+       sql_string：SQL语句
+    返回值：
+       语句指纹
+    """
+    return ' '.join(LITERAL_PATTERN.sub('?', sql_string).split()).lower()
+
+
+def current_endpoint():
+    """当前请求的接口名称,没有请求上下文时(后台线程等)返回'-'
+    """
+    if has_request_context() and request.endpoint:
+        return request.endpoint
+    return '-'
+
+
+def config_value(key, default):
+    """读取应用配置,没有应用上下文时使用默认值
+    """
+    return current_app.config.get(key, default) if has_app_context() else default
+
+
+def explain_enabled():
+    """慢查询是否记录EXPLAIN (ANALYZE, BUFFERS)执行计划
+    """
+    return config_value('PG_SLOW_QUERY_EXPLAIN', False)
+
+
+def explain_sql(sql_string):
+    """构造获取执行计划的语句,EXPLAIN ANALYZE会实际执行语句,只用于只读查询
+    """
+    return 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql_string.strip().rstrip(';')
+
+
+def record(sql_string, param_tuple, start_time, endpoint=None):
+    """记录一次语句执行,耗时超过阈值时记录慢查询日志
+    参数：
+       sql_string：SQL语句
+       param_tuple：参数元组
+       start_time：开始执行的时间,time.perf_counter()的返回值
+       endpoint：调用的接口名称,默认为当前请求的接口
+    返回值：
+       慢查询记录(字典形式,之后可以补充执行计划plan),不是慢查询时返回None
+    """
+    duration = (time.perf_counter() - start_time) * 1000
+    endpoint = endpoint or current_endpoint()
+    statement = fingerprint(sql_string)
+    bucket_index = next((index for index, bucket in enumerate(HISTOGRAM_BUCKETS) if duration <= bucket), len(HISTOGRAM_BUCKETS))
+
+    with METRICS_LOCK:
+        metrics = STATEMENT_METRICS.get(statement, None)
+        if metrics is None and len(STATEMENT_METRICS) < MAX_STATEMENT_COUNT:
+            metrics = STATEMENT_METRICS[statement] = {
+                'count': 0,
+                'totalTime': 0.0,
+                'maxTime': 0.0,
+                'histogram': [0] * (len(HISTOGRAM_BUCKETS) + 1),
+                'endpoints': {}
+            }
+        if metrics is None:
+            OVERFLOW_COUNTER['count'] += 1
+        else:
+            metrics['count'] += 1
+            metrics['totalTime'] += duration
+            metrics['maxTime'] = max(metrics['maxTime'], duration)
+            metrics['histogram'][bucket_index] += 1
+            endpoint_metrics = metrics['endpoints'].setdefault(endpoint, {'count': 0, 'totalTime': 0.0})
+            endpoint_metrics['count'] += 1
+            endpoint_metrics['totalTime'] += duration
+
+    if duration < config_value('PG_SLOW_QUERY_THRESHOLD', DEFAULT_SLOW_QUERY_THRESHOLD):
+        return None
+
+    param_string = repr(param_tuple)
+    if len(param_string) > MAX_PARAM_LENGTH:
+        param_string = param_string[:MAX_PARAM_LENGTH] + '...'
+    slow_query = {
+        'fingerprintId': hashlib.md5(statement.encode(encoding='UTF-8')).hexdigest()[:16],
+        'fingerprint': statement,
+        'params': param_string,
+        'endpoint': endpoint,
+        'duration': duration,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'plan': None
+    }
+    LOGGER.warning('slow query %.1f ms [%s] %s: %s params=%s', duration, endpoint, slow_query['fingerprintId'], statement, param_string)
+    with METRICS_LOCK:
+        SLOW_QUERIES.append(slow_query)
+        while len(SLOW_QUERIES) > config_value('PG_SLOW_QUERY_HISTORY', DEFAULT_SLOW_QUERY_HISTORY):
+            SLOW_QUERIES.popleft()
+    return slow_query
+
+
+def record_plan(slow_query, plan):
+    """补充慢查询的执行计划,并写入慢查询日志
+    参数：
+       slow_query：record返回的慢查询记录
+       plan：EXPLAIN (FORMAT JSON)返回的执行计划
+    返回值：
+    """
+    slow_query['plan'] = plan
+    LOGGER.warning('slow query plan %s: %s', slow_query['fingerprintId'], plan)
+
+
+def statistics():
+    """所有语句的统计信息
+    返回值：
+       字典形式,语句按照累计耗时从大到小排序,包括执行次数、平均耗时、耗时直方图、各接口的统计和最近的慢查询
+    """
+    with METRICS_LOCK:
+        statements = []
+        for statement, metrics in STATEMENT_METRICS.items():
+            statements.append({
+                'fingerprintId': hashlib.md5(statement.encode(encoding='UTF-8')).hexdigest()[:16],
+                'fingerprint': statement,
+                'count': metrics['count'],
+                'totalTime': metrics['totalTime'],
+                'meanTime': metrics['totalTime'] / metrics['count'],
+                'maxTime': metrics['maxTime'],
+                'histogram': [{
+                    'le': bucket,
+                    'count': count
+                } for bucket, count in zip(HISTOGRAM_BUCKETS + ('+Inf',), metrics['histogram'])],
+                'endpoints': {
+                    key: dict(value) for key, value in metrics['endpoints'].items()
+                }
+            })
+        slow_queries = [dict(x) for x in SLOW_QUERIES]
+        overflow_count = OVERFLOW_COUNTER['count']
+
+    statements.sort(key=lambda x: x['totalTime'], reverse=True)
+    return {'statements': statements, 'slowQueries': slow_queries, 'overflowCount': overflow_count}
+
+
+def reset():
+    """清空所有统计信息
+    """
+    with METRICS_LOCK:
+        STATEMENT_METRICS.clear()
+        SLOW_QUERIES.clear()
+        OVERFLOW_COUNTER.clear()
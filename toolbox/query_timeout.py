@@ -0,0 +1,288 @@
+"""语句超时和取消模块,为PgHelper、AsyncPgHelper执行的语句设置statement_timeout、lock_timeout,
+   超时时间依次取调用时指定的值、接口的配置(PG_ENDPOINT_TIMEOUTS)和全局配置(PG_STATEMENT_TIMEOUT、PG_LOCK_TIMEOUT),
+   全局配置通过连接参数(options)设置,只有与全局配置不同时才执行set_config,归还连接池时恢复为全局配置;
+   请求执行语句期间,后台监视线程检查请求截止时间(PG_REQUEST_TIMEOUT)和客户端连接,
+   截止时间已过或者客户端断开时取消正在执行的语句,截止时间已过的请求不再执行新的语句
+"""
+import contextlib
+import itertools
+import select
+import socket
+import threading
+import time
+
+import psycopg2.extensions
+from flask import (current_app, g, has_app_context, has_request_context, request)
+
+# 默认的超时时间,单位为毫秒,0表示不限制,可通过配置修改
+DEFAULT_STATEMENT_TIMEOUT = 0
+DEFAULT_LOCK_TIMEOUT = 0
+DEFAULT_REQUEST_TIMEOUT = 0
+
+# 后台监视线程检查截止时间和客户端连接的间隔,单位为秒,可通过配置PG_CANCEL_CHECK_INTERVAL修改
+DEFAULT_CANCEL_CHECK_INTERVAL = 1.0
+
+# 设置超时时间的语句,在同一次数据库往返中设置两个参数
+SET_TIMEOUTS_SQL = "select set_config('statement_timeout', %s, false), set_config('lock_timeout', %s, false)"
+RESET_TIMEOUTS_SQL = 'RESET statement_timeout;RESET lock_timeout'
+
+# 连接上已经设置的超时时间,连接使用全局配置时不记录;在事务中设置的值可能随事务回滚,记录为未知(空元组)
+UNKNOWN_TIMEOUTS = ()
+
+# 正在执行的语句,后台监视线程检查截止时间、客户端连接并取消语句
+ACTIVE_LOCK = threading.Lock()
+ACTIVE_STATEMENTS = {}
+ACTIVE_COUNTER = itertools.count()
+WATCHDOG_REGISTRY = {}
+
+STATISTICS_LOCK = threading.Lock()
+STATISTICS = {
+    'deadlineExceededCount': 0,    #请求截止时间已过,不再执行语句的次数
+    'deadlineCancelCount': 0,    #请求截止时间已过,取消正在执行的语句的次数
+    'disconnectCancelCount': 0,    #客户端断开,取消正在执行的语句的次数
+    'resetCount': 0,    #归还连接池时恢复超时配置的次数
+}
+
+
+def connect_options(config):
+    """全局配置的超时时间对应的连接参数(options),新建连接时即生效,不需要额外的数据库往返
+    参数：
+       config：应用配置
+    返回值：
+       连接参数options的值
+    """
+    return (f"-c statement_timeout={config.get('PG_STATEMENT_TIMEOUT', DEFAULT_STATEMENT_TIMEOUT)} "
+            f"-c lock_timeout={config.get('PG_LOCK_TIMEOUT', DEFAULT_LOCK_TIMEOUT)}")
+
+
+def init_app(app):
+    """注册请求开始时记录截止时间的处理函数,并启动后台监视线程
+    参数：
+       app：Flask应用
+    返回值：
+    """
+    app.before_request(start_deadline)
+    if 'thread' not in WATCHDOG_REGISTRY:
+        WATCHDOG_REGISTRY['interval'] = app.config.get('PG_CANCEL_CHECK_INTERVAL', DEFAULT_CANCEL_CHECK_INTERVAL)
+        WATCHDOG_REGISTRY['thread'] = threading.Thread(target=watch_statements, name='pg-statement-watchdog', daemon=True)
+        WATCHDOG_REGISTRY['thread'].start()
+
+
+def endpoint_config():
+    """当前请求接口的超时配置,没有配置时返回空字典
+    """
+    if not has_request_context() or not request.endpoint:
+        return {}
+    return current_app.config.get('PG_ENDPOINT_TIMEOUTS', {}).get(request.endpoint, {})
+
+
+def start_deadline():
+    """请求开始(before_request)时记录请求的截止时间,接口配置的request_timeout优先
+    """
+    request_timeout = endpoint_config().get('request_timeout', current_app.config.get('PG_REQUEST_TIMEOUT', DEFAULT_REQUEST_TIMEOUT))
+    g.pg_deadline = time.monotonic() + request_timeout / 1000 if request_timeout else None
+
+
+def request_deadline():
+    """当前请求的截止时间,time.monotonic()的值,没有截止时间时返回None
+    """
+    return g.get('pg_deadline', None) if has_app_context() else None
+
+
+def remaining_time():
+    """请求截止时间的剩余时间
+    返回值：
+       剩余时间,单位为秒,没有截止时间时返回None;截止时间已过时抛出QueryCanceledError异常
+    """
+    deadline = request_deadline()
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        update_statistics('deadlineExceededCount')
+        raise psycopg2.extensions.QueryCanceledError('canceling statement due to request deadline')
+    return remaining
+
+
+def resolve_timeouts(statement_timeout=None, lock_timeout=None):
+    """计算语句的超时时间,请求截止时间已过时抛出QueryCanceledError异常;
+       截止时间不计入语句超时时间(每条语句的剩余时间不同,需要每次设置),由后台监视线程取消语句
+    参数：
+       statement_timeout：调用时指定的语句超时时间,单位为毫秒
+       lock_timeout：调用时指定的锁等待超时时间,单位为毫秒
+    返回值：
+       (语句超时时间, 锁等待超时时间),单位为毫秒,0表示不限制
+    """
+    remaining_time()
+    config = current_app.config if has_app_context() else {}
+    endpoint_timeouts = endpoint_config()
+    if statement_timeout is None:
+        statement_timeout = endpoint_timeouts.get('statement_timeout', config.get('PG_STATEMENT_TIMEOUT', DEFAULT_STATEMENT_TIMEOUT))
+    if lock_timeout is None:
+        lock_timeout = endpoint_timeouts.get('lock_timeout', config.get('PG_LOCK_TIMEOUT', DEFAULT_LOCK_TIMEOUT))
+    return statement_timeout, lock_timeout
+
+
+def default_timeouts():
+    """全局配置的超时时间,即连接参数中设置的值
+    """
+    config = current_app.config if has_app_context() else {}
+    return config.get('PG_STATEMENT_TIMEOUT', DEFAULT_STATEMENT_TIMEOUT), config.get('PG_LOCK_TIMEOUT', DEFAULT_LOCK_TIMEOUT)
+
+
+def timeouts_to_set(connection, timeouts):
+    """判断连接是否需要设置超时时间,连接上的值与需要的值相同时不再设置
+    参数：
+       connection：数据库连接(psycopg2或psycopg)
+       timeouts：(语句超时时间, 锁等待超时时间)
+    返回值：
+       set_config的参数元组,不需要设置时返回None
+    """
+    current = getattr(connection, '__timeouts__', None)
+    if current == timeouts or (current is None and timeouts == default_timeouts()):
+        return None
+    return f'{timeouts[0]}ms', f'{timeouts[1]}ms'
+
+
+def apply_timeouts(connection, timeouts):
+    """在psycopg2连接上设置超时时间
+    参数：
+       connection：数据库连接
+       timeouts：(语句超时时间, 锁等待超时时间)
+    返回值：
+    """
+    param_tuple = timeouts_to_set(connection, timeouts)
+    if param_tuple is None:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(SET_TIMEOUTS_SQL, param_tuple)
+    connection.__timeouts__ = timeouts if connection.autocommit else UNKNOWN_TIMEOUTS
+
+
+async def apply_async_timeouts(connection, timeouts):
+    """在psycopg的异步连接上设置超时时间,异步连接池的连接为自动提交模式
+    参数：
+       connection：异步数据库连接
+       timeouts：(语句超时时间, 锁等待超时时间)
+    返回值：
+    """
+    param_tuple = timeouts_to_set(connection, timeouts)
+    if param_tuple is None:
+        return
+    await connection.execute(SET_TIMEOUTS_SQL, param_tuple)
+    connection.__timeouts__ = timeouts
+
+
+def reset_timeouts(connection):
+    """连接归还连接池时恢复为全局配置的超时时间
+    参数：
+       connection：psycopg2的数据库连接,没有进行中的事务
+    返回值：
+    """
+    if getattr(connection, '__timeouts__', None) is None:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(RESET_TIMEOUTS_SQL)
+    if not connection.autocommit:
+        connection.commit()
+    connection.__timeouts__ = None
+    update_statistics('resetCount')
+
+
+async def reset_async_timeouts(connection):
+    """异步连接池的reset回调,连接归还时恢复为全局配置的超时时间
+    """
+    if getattr(connection, '__timeouts__', None) is None:
+        return
+    await connection.execute(RESET_TIMEOUTS_SQL)
+    connection.__timeouts__ = None
+    update_statistics('resetCount')
+
+
+def client_socket():
+    """当前请求客户端的套接字,WSGI服务器没有提供时返回None(例如wfastcgi),此时只能依靠超时时间取消语句
+    """
+    if not has_request_context():
+        return None
+    client = request.environ.get('werkzeug.socket', None)
+    return client if isinstance(client, socket.socket) else None
+
+
+def client_disconnected(client):
+    """检查客户端是否已经断开,请求体已经读取完成,可读且读取到空数据即为断开
+    """
+    try:
+        readable, _, _ = select.select([client], [], [], 0)
+        return bool(readable) and client.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        return True
+
+
+@contextlib.contextmanager
+def guard(connection, statement_timeout=None, lock_timeout=None):
+    """执行语句的上下文,设置超时时间,并在执行期间由后台监视线程检查请求截止时间和客户端连接
+    参数：
+       connection：执行语句的psycopg2连接
+       statement_timeout：调用时指定的语句超时时间,单位为毫秒
+       lock_timeout：调用时指定的锁等待超时时间,单位为毫秒
+    返回值：
+    """
+    apply_timeouts(connection, resolve_timeouts(statement_timeout, lock_timeout))
+    client = client_socket()
+    deadline = request_deadline()
+    if client is None and deadline is None:
+        yield
+        return
+
+    statement_id = next(ACTIVE_COUNTER)
+    with ACTIVE_LOCK:
+        ACTIVE_STATEMENTS[statement_id] = (connection, client, deadline)
+    try:
+        yield
+    finally:
+        with ACTIVE_LOCK:
+            ACTIVE_STATEMENTS.pop(statement_id, None)
+
+
+def watch_statements():
+    """后台监视线程,定期检查正在执行语句的请求,截止时间已过或者客户端断开时取消语句
+    """
+    while True:
+        time.sleep(WATCHDOG_REGISTRY['interval'])
+        with ACTIVE_LOCK:
+            statements = list(ACTIVE_STATEMENTS.items())
+        for statement_id, (connection, client, deadline) in statements:
+            if deadline is not None and time.monotonic() > deadline:
+                reason = 'deadlineCancelCount'
+            elif client is not None and client_disconnected(client):
+                reason = 'disconnectCancelCount'
+            else:
+                continue
+            with ACTIVE_LOCK:
+                # 语句可能已经执行完成,连接已被其它语句使用
+                if ACTIVE_STATEMENTS.pop(statement_id, None) is None:
+                    continue
+                try:
+                    connection.cancel()
+                except psycopg2.Error:
+                    ...
+            update_statistics(reason)
+
+
+def update_statistics(key):
+    """更新统计信息
+    """
+    with STATISTICS_LOCK:
+        STATISTICS[key] += 1
+
+
+def statistics():
+    """语句超时和取消的统计信息
+    返回值：
+       字典形式,包括截止时间已过的次数、客户端断开取消语句的次数等
+    """
+    with STATISTICS_LOCK:
+        result = dict(STATISTICS)
+    with ACTIVE_LOCK:
+        result['activeCount'] = len(ACTIVE_STATEMENTS)
+    return result
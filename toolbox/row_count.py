@@ -0,0 +1,246 @@
+"""表格记录总数的获取策略模块,用于分页表格(ag-grid服务端行模型)的记录总数,避免每次分页都执行count(*)扫描整个表:
+   1.没有检索条件时,使用触发器维护的记录数(gy_row_count表,精确值),未安装计数触发器时使用统计信息的估计值(pg_class.reltuples);
+   2.有检索条件时,先查询缓存的精确值(按照检索条件和参数缓存PG_COUNT_CACHE_TTL秒);
+     没有缓存时使用执行计划的估计行数,估计值不超过PG_EXACT_COUNT_THRESHOLD时执行count(*)获取精确值并缓存,否则返回估计值;
+   计数触发器在应用启动时的后台线程中安装,安装时统计一次精确的记录数;
+   触发器为语句级触发器,使用过渡表(transition table)统计每条语句插入、删除的记录数,批量写入时每批只更新一次计数
+"""
+import collections
+import logging
+import threading
+import time
+
+import psycopg2
+from psycopg2 import sql
+
+from .connection_pool import PoolTimeoutError
+
+# 默认的缓存时间(秒)、缓存的检索条件数和执行精确计数的估计行数上限,可通过配置修改
+DEFAULT_COUNT_CACHE_TTL = 30
+DEFAULT_COUNT_CACHE_SIZE = 256
+DEFAULT_EXACT_COUNT_THRESHOLD = 100000
+
+# 维护记录数的表和触发器函数,触发器的参数为表名
+COUNTER_SQL = '''create table if not exists gy_row_count(table_name text primary key, row_count bigint not null);
+                 create or replace function gy_row_count_insert() returns trigger language plpgsql as $$
+                 begin
+                     update gy_row_count set row_count = row_count + (select count(*) from pg_new_rows) where table_name = TG_ARGV[0];
+                     return null;
+                 end $$;
+                 create or replace function gy_row_count_delete() returns trigger language plpgsql as $$
+                 begin
+                     update gy_row_count set row_count = row_count - (select count(*) from pg_old_rows) where table_name = TG_ARGV[0];
+                     return null;
+                 end $$;
+                 create or replace function gy_row_count_truncate() returns trigger language plpgsql as $$
+                 begin
+                     update gy_row_count set row_count = 0 where table_name = TG_ARGV[0];
+                     return null;
+                 end $$'''
+
+TRIGGER_SQL = '''drop trigger if exists {insert_trigger} on {table};
+                 create trigger {insert_trigger} after insert on {table} referencing new table as pg_new_rows
+                     for each statement execute function gy_row_count_insert({table_name});
+                 drop trigger if exists {delete_trigger} on {table};
+                 create trigger {delete_trigger} after delete on {table} referencing old table as pg_old_rows
+                     for each statement execute function gy_row_count_delete({table_name});
+                 drop trigger if exists {truncate_trigger} on {table};
+                 create trigger {truncate_trigger} after truncate on {table}
+                     for each statement execute function gy_row_count_truncate({table_name})'''
+
+# 计数触发器是否已经安装
+INSTALLED_SQL = '''select exists(select 1 from pg_trigger where tgrelid = to_regclass(%s) and tgname = %s)
+                          and exists(select 1 from gy_row_count where table_name = %s)'''
+
+# 统计信息中的估计记录数,分区表为所有分区的估计记录数之和,从未分析过的表reltuples为-1
+ESTIMATE_SQL = '''select coalesce(sum(greatest(reltuples, 0)), 0)::bigint from pg_class
+                  where oid = to_regclass(%s) or oid in (select inhrelid from pg_inherits where inhparent = to_regclass(%s))'''
+
+# 多个进程同时启动时依次执行,之后的进程检查到已经安装时跳过
+LOCK_SQL = "select pg_advisory_xact_lock(hashtext('gy_row_count'))"
+
+LOGGER = logging.getLogger(__name__)
+
+# 精确记录数的缓存,键为(表名, 检索条件, 参数),值为(记录数, 过期时间)
+COUNT_CACHE = collections.OrderedDict()
+CACHE_LOCK = threading.Lock()
+
+# 安装计数触发器的结果和各种策略的使用次数
+COUNTER_REGISTRY = {}
+STATISTICS = collections.Counter()
+
+
+def install_triggers(cursor, table_name='gy_log'):
+    """在调用者的事务中安装计数触发器并统计一次精确的记录数,调用者需要锁定表的写入(例如日志表迁移为分区表时)
+    参数：
+       cursor：数据库游标
+       table_name：表名
+    返回值：
+    """
+    cursor.execute(COUNTER_SQL)
+    cursor.execute(
+        sql.SQL(TRIGGER_SQL).format(table=sql.Identifier(table_name),
+                                    table_name=sql.Literal(table_name),
+                                    insert_trigger=sql.Identifier(f'{table_name}_row_count_insert'),
+                                    delete_trigger=sql.Identifier(f'{table_name}_row_count_delete'),
+                                    truncate_trigger=sql.Identifier(f'{table_name}_row_count_truncate')))
+    cursor.execute(
+        sql.SQL('''insert into gy_row_count(table_name, row_count) select %s, count(*) from {}
+                   on conflict (table_name) do update set row_count = excluded.row_count''').format(sql.Identifier(table_name)), (table_name,))
+
+
+def install_counter(pool, table_name='gy_log'):
+    """安装计数触发器并统计一次精确的记录数,已经安装时跳过;
+       统计期间锁定表的写入(日志由后台线程批量写入,请求不受影响)
+    参数：
+       pool：数据库连接池
+       table_name：表名
+    返回值：
+       是否执行了安装,已经安装时返回False
+    """
+    connection = pool.getconn()
+    # 连接可能处于自动提交模式,咨询锁和语句需要在同一个事务中
+    connection.autocommit = False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(LOCK_SQL)
+            cursor.execute("select set_config('statement_timeout', '0', true)")
+            cursor.execute(COUNTER_SQL)
+            cursor.execute(INSTALLED_SQL, (table_name, f'{table_name}_row_count_insert', table_name))
+            if cursor.fetchone()[0]:
+                connection.rollback()
+                return False
+
+            cursor.execute(sql.SQL('lock table {} in share row exclusive mode').format(sql.Identifier(table_name)))
+            install_triggers(cursor, table_name)
+        connection.commit()
+        return True
+    except psycopg2.Error:
+        connection.rollback()
+        raise
+    finally:
+        pool.putconn(connection)
+
+
+def subtract_rows(cursor, table_name, partition_name):
+    """分区分离或者删除前,从计数中减去分区的记录数(分离、删除分区不触发触发器)
+    参数：
+       cursor：执行分离、删除的事务中的游标
+       table_name：分区表名
+       partition_name：分区名
+    返回值：
+    """
+    cursor.execute("select to_regclass('gy_row_count') is not null")
+    if not cursor.fetchone()[0]:
+        return
+    cursor.execute(
+        sql.SQL('update gy_row_count set row_count = row_count - (select count(*) from {}) where table_name = %s').format(
+            sql.Identifier(partition_name)), (table_name,))
+
+
+def init_app(app):
+    """读取缓存配置,在后台线程中安装gy_log的计数触发器;需要在connection_pool.init_app之后调用
+    参数：
+       app：Flask应用
+    返回值：
+    """
+    COUNTER_REGISTRY['pool'] = app.extensions['pg_pool']
+    COUNTER_REGISTRY['ttl'] = app.config.get('PG_COUNT_CACHE_TTL', DEFAULT_COUNT_CACHE_TTL)
+    COUNTER_REGISTRY['size'] = app.config.get('PG_COUNT_CACHE_SIZE', DEFAULT_COUNT_CACHE_SIZE)
+    COUNTER_REGISTRY['threshold'] = app.config.get('PG_EXACT_COUNT_THRESHOLD', DEFAULT_EXACT_COUNT_THRESHOLD)
+    threading.Thread(target=run_install_counter, name='pg-row-count', daemon=True).start()
+
+
+def run_install_counter():
+    """安装gy_log的计数触发器,失败时记录到应用日志,记录总数改用估计值
+    """
+    try:
+        installed = install_counter(COUNTER_REGISTRY['pool'])
+        error = None
+    except (psycopg2.Error, PoolTimeoutError) as exception:
+        installed = False
+        error = repr(exception)
+        LOGGER.exception('failed to install gy_log row counter')
+    with CACHE_LOCK:
+        COUNTER_REGISTRY['ready'] = error is None
+        COUNTER_REGISTRY['last'] = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'installed': installed, 'error': error}
+
+
+def cached_count(key):
+    """查询缓存的精确记录数,没有缓存或者已过期时返回None
+    """
+    with CACHE_LOCK:
+        count_item = COUNT_CACHE.get(key, None)
+        if count_item is None or count_item[1] < time.monotonic():
+            COUNT_CACHE.pop(key, None)
+            return None
+        COUNT_CACHE.move_to_end(key)
+        return count_item[0]
+
+
+def cache_count(key, row_count):
+    """缓存精确记录数,超过缓存数量时删除最久未使用的
+    """
+    with CACHE_LOCK:
+        COUNT_CACHE[key] = (row_count, time.monotonic() + COUNTER_REGISTRY.get('ttl', DEFAULT_COUNT_CACHE_TTL))
+        COUNT_CACHE.move_to_end(key)
+        while len(COUNT_CACHE) > COUNTER_REGISTRY.get('size', DEFAULT_COUNT_CACHE_SIZE):
+            COUNT_CACHE.popitem(last=False)
+
+
+async def count_rows(pg_helper, table_name, where_cause='', where_params=()):
+    """按照策略获取记录总数
+    参数：
+       pg_helper：AsyncPgHelper对象
+       table_name：表名
+       where_cause：检索条件,包括where,没有检索条件时为空字符串
+       where_params：检索条件的参数
+    返回值：
+       (记录总数, 是否为精确值)
+    """
+    if not where_cause:
+        # 计数触发器安装完成之前(或者安装失败时)使用统计信息的估计值
+        row_count = None
+        if COUNTER_REGISTRY.get('ready', False):
+            row_count = await pg_helper.query_single_value('select row_count from gy_row_count where table_name = %s', (table_name,))
+        if row_count is not None:
+            update_statistics('counterCount')
+            return row_count, True
+        update_statistics('statisticsEstimateCount')
+        return await pg_helper.query_single_value(ESTIMATE_SQL, (table_name, table_name)), False
+
+    key = (table_name, where_cause, tuple(where_params))
+    row_count = cached_count(key)
+    if row_count is not None:
+        update_statistics('cacheHitCount')
+        return row_count, True
+
+    plan = await pg_helper.query_single_value(f'explain (format json) select 1 from {table_name}{where_cause}', tuple(where_params))
+    estimate_count = int(plan[0]['Plan']['Plan Rows'])
+    if estimate_count > COUNTER_REGISTRY.get('threshold', DEFAULT_EXACT_COUNT_THRESHOLD):
+        update_statistics('planEstimateCount')
+        return estimate_count, False
+
+    row_count = await pg_helper.query_single_value(f'select count(*) from {table_name}{where_cause}', tuple(where_params))
+    cache_count(key, row_count)
+    update_statistics('exactCount')
+    return row_count, True
+
+
+def update_statistics(key):
+    """更新各种策略的使用次数
+    """
+    with CACHE_LOCK:
+        STATISTICS[key] += 1
+
+
+def statistics():
+    """记录总数策略的统计信息
+    返回值：
+       字典形式,包括各种策略的使用次数、缓存的检索条件数和计数触发器的安装结果
+    """
+    with CACHE_LOCK:
+        result = {key: STATISTICS[key] for key in ('counterCount', 'statisticsEstimateCount', 'cacheHitCount', 'planEstimateCount', 'exactCount')}
+        result['cacheSize'] = len(COUNT_CACHE)
+        result['counter'] = dict(COUNTER_REGISTRY.get('last', {}))
+    return result
@@ -0,0 +1,310 @@
+"""预备语句(PREPARE/EXECUTE)缓存模块,每个连接池中的连接维护一个LRU缓存;
+   同一SQL语句在一个连接上执行次数达到阈值后,在该连接上PREPARE一次,之后使用EXECUTE执行,
+   省去PostgreSQL每次解析和生成执行计划的开销(例如各树形列表的递归查询、登录验证查询);
+   缓存保存在连接对象上,连接被连接池丢弃重建时缓存随之失效;
+   服务端预备语句丢失时(例如执行了DISCARD ALL)清空该连接的缓存
+"""
+import collections
+import hashlib
+import re
+import threading
+
+import psycopg2
+import psycopg2.errorcodes
+import psycopg2.extensions
+from flask import (current_app, has_app_context)
+
+# 缓存的默认容量和预备阈值,可通过配置PG_STATEMENT_CACHE_SIZE、PG_STATEMENT_PREPARE_THRESHOLD修改
+DEFAULT_CACHE_SIZE = 64
+DEFAULT_PREPARE_THRESHOLD = 2
+
+# 可以预备的语句类型
+PREPARABLE_KEYWORDS = ('select', 'with', 'insert', 'update', 'delete', 'values')
+
+# 所有连接的缓存统计信息
+STATISTICS_LOCK = threading.Lock()
+STATISTICS = {
+    'hitCount': 0,    #命中缓存,直接EXECUTE的次数
+    'missCount': 0,    #新PREPARE语句的次数
+    'evictCount': 0,    #超过缓存容量,DEALLOCATE最久未使用语句的次数
+    'invalidateCount': 0,    #服务端预备语句丢失,清空连接缓存的次数
+    'prepareFailCount': 0,    #PREPARE失败(例如参数类型无法推断),之后不再预备该语句的次数
+}
+
+
+# pylint: disable=too-few-public-methods
+class CachedConnection(psycopg2.extensions.connection):
+    """ 带预备语句缓存的连接类,连接池创建连接时作为connection_factory使用,
+    同时记录连接上设置的语句超时时间(toolbox.query_timeout)
+    """
+    __statement_cache__ = None
+    __timeouts__ = None
+
+
+class StatementCache:
+    """ 单个连接上的预备语句LRU缓存类
+    缓存SQL语句到预备语句名称的映射,超过容量时淘汰最久未使用的语句;
+    未达到预备阈值的语句只记录执行次数,记录数同样有上限
+    """
+    __statements__ = None
+    __candidates__ = None
+    __unpreparable__ = None
+
+    def __init__(self, capacity, threshold):
+        """ 类的构造函数
+        参数：
+           capacity：缓存的最大预备语句数
+           threshold：语句执行多少次后进行预备
+        返回值：
+        """
+        self.__capacity__ = capacity
+        self.__threshold__ = threshold
+        self.__statements__ = collections.OrderedDict()
+        self.__candidates__ = collections.OrderedDict()
+        self.__unpreparable__ = collections.OrderedDict()
+
+    def lookup(self, sql_string):
+        """查找已预备的语句,命中时更新为最近使用
+        参数：
+           sql_string：SQL语句
+        返回值：
+           预备语句名称,未命中时返回None
+        """
+        statement_name = self.__statements__.get(sql_string, None)
+        if statement_name is not None:
+            self.__statements__.move_to_end(sql_string)
+        return statement_name
+
+    def should_prepare(self, sql_string):
+        """记录语句的一次执行,判断是否达到预备阈值
+        参数：
+           sql_string：SQL语句
+        返回值：
+           是否需要预备
+        """
+        if sql_string in self.__unpreparable__:
+            return False
+        count = self.__candidates__.pop(sql_string, 0) + 1
+        if count >= self.__threshold__:
+            return True
+        self.__candidates__[sql_string] = count
+        if len(self.__candidates__) > self.__capacity__ * 4:
+            self.__candidates__.popitem(last=False)
+        return False
+
+    def add(self, sql_string, statement_name):
+        """预备成功后加入缓存
+        参数：
+           sql_string：SQL语句
+           statement_name：预备语句名称
+        返回值：
+        """
+        self.__statements__[sql_string] = statement_name
+
+    def evict(self):
+        """缓存已满时淘汰最久未使用的语句,需要在预备新语句之前调用
+        返回值：
+           被淘汰的预备语句名称,缓存未满时返回None
+        """
+        if len(self.__statements__) < self.__capacity__:
+            return None
+        _, statement_name = self.__statements__.popitem(last=False)
+        return statement_name
+
+    def mark_unpreparable(self, sql_string):
+        """标记语句不能预备,之后直接执行;拼接生成的语句可能很多,记录数同样有上限
+        """
+        self.__unpreparable__[sql_string] = True
+        if len(self.__unpreparable__) > self.__capacity__ * 4:
+            self.__unpreparable__.popitem(last=False)
+
+    def clear(self):
+        """清空缓存,服务端的预备语句已经不存在时调用
+        """
+        self.__statements__.clear()
+        self.__candidates__.clear()
+
+
+def statement_cache(connection):
+    """获取连接的预备语句缓存,首次使用时创建
+    参数：
+       connection：数据库连接
+    返回值：
+       预备语句缓存,连接不是CachedConnection时返回None
+    """
+    if not isinstance(connection, CachedConnection):
+        return None
+    if connection.__statement_cache__ is None:
+        if has_app_context():
+            capacity = current_app.config.get('PG_STATEMENT_CACHE_SIZE', DEFAULT_CACHE_SIZE)
+            threshold = current_app.config.get('PG_STATEMENT_PREPARE_THRESHOLD', DEFAULT_PREPARE_THRESHOLD)
+        else:
+            capacity, threshold = DEFAULT_CACHE_SIZE, DEFAULT_PREPARE_THRESHOLD
+        connection.__statement_cache__ = StatementCache(capacity, threshold)
+    return connection.__statement_cache__
+
+
+def to_prepared_sql(sql_string, param_tuple):
+    """将psycopg2格式的SQL语句转换为PREPARE使用的格式,%s转换为$1、$2...,%%转换为%;
+       psycopg2不区分引号,引号内的%%同样需要转换
+    参数：
+       sql_string：SQL语句
+       param_tuple：参数元组
+    返回值：
+       (转换后的SQL语句, 参数个数),多条语句、命名参数等不能预备的情况返回None
+    """
+    stripped_sql = sql_string.strip().rstrip(';').rstrip()
+    if ((param_tuple is not None and not isinstance(param_tuple, (tuple, list))) or not stripped_sql
+            or stripped_sql.split(None, 1)[0].lower() not in PREPARABLE_KEYWORDS):
+        return None
+
+    # 引号之外出现美元符号(美元符号引用、位置参数)或分号(多条语句)时不做预备
+    segments = split_quoted(stripped_sql)
+    if any(not quoted and ('$' in text or ';' in text) for quoted, text in segments):
+        return None
+    if param_tuple is None:
+        return stripped_sql, 0
+
+    result = []
+    param_count = 0
+    for quoted, text in segments:
+        parts = text.split('%%')
+        # 引号内的%s参数、命名参数等其它格式不做预备
+        if any('%' in (part if quoted else part.replace('%s', '')) for part in parts):
+            return None
+        converted_parts = []
+        for part in parts:
+            pieces = part.split('%s')
+            converted_parts.append(pieces[0] + ''.join(f'${param_count + index + 1}' + piece for index, piece in enumerate(pieces[1:])))
+            param_count += len(pieces) - 1
+        result.append('%'.join(converted_parts))
+
+    if param_count != len(param_tuple):
+        return None
+    return ''.join(result), param_count
+
+
+def split_quoted(sql_string):
+    """将SQL语句拆分为引号内、引号外的片段,两个连续的引号表示引号本身
+    参数：
+       sql_string：SQL语句
+    返回值：
+       列表形式,[(是否为引号内的片段, 片段文本)]
+    """
+    segments = []
+    for match in re.finditer(r"""'(?:[^']|'')*'?|"(?:[^"]|"")*"?|[^'"]+""", sql_string):
+        segments.append((match.group(0)[0] in ('\'', '"'), match.group(0)))
+    return segments
+
+
+def execute_cached(cursor, sql_string, param_tuple=None):
+    """通过连接的预备语句缓存执行SQL语句,不能预备的语句直接执行
+    参数：
+       cursor：数据库游标
+       sql_string：SQL语句
+       param_tuple：参数元组
+    返回值：
+    """
+    connection = cursor.connection
+    cache = statement_cache(connection)
+    if cache is None:
+        cursor.execute(sql_string, param_tuple)
+        return
+
+    statement_name = cache.lookup(sql_string)
+    if statement_name is not None:
+        param_count = len(param_tuple or ())
+        try:
+            cursor.execute(execute_statement(statement_name, param_count), param_tuple if param_count else None)
+        except psycopg2.Error as exception:
+            if exception.pgcode != psycopg2.errorcodes.INVALID_SQL_STATEMENT_NAME:
+                raise
+            # 服务端预备语句已不存在,清空缓存;自动提交模式下直接重新执行
+            cache.clear()
+            update_statistics('invalidateCount')
+            if not connection.autocommit:
+                raise
+            cursor.execute(sql_string, param_tuple)
+        else:
+            update_statistics('hitCount')
+        return
+
+    prepared = None
+    if (cache.should_prepare(sql_string)
+            and connection.get_transaction_status() in (psycopg2.extensions.TRANSACTION_STATUS_IDLE, psycopg2.extensions.TRANSACTION_STATUS_INTRANS)):
+        prepared = to_prepared_sql(sql_string, param_tuple)
+        if prepared is None:
+            cache.mark_unpreparable(sql_string)
+    if prepared is None or not prepare_statement(cursor, cache, sql_string, prepared[0]):
+        cursor.execute(sql_string, param_tuple)
+        return
+
+    update_statistics('missCount')
+    cursor.execute(execute_statement(cache.lookup(sql_string), prepared[1]), param_tuple if prepared[1] else None)
+
+
+def prepare_statement(cursor, cache, sql_string, prepared_sql):
+    """在连接上PREPARE语句并加入缓存,事务中使用保存点,PREPARE失败时不影响当前事务
+    参数：
+       cursor：数据库游标
+       cache：连接的预备语句缓存
+       sql_string：原始SQL语句
+       prepared_sql：转换后的SQL语句
+    返回值：
+       是否预备成功
+    """
+    statement_name = 'pg_helper_' + hashlib.md5(sql_string.encode(encoding='UTF-8')).hexdigest()
+    evicted_name = cache.evict()
+    if evicted_name is not None:
+        update_statistics('evictCount')
+
+    prepare_sql = f'PREPARE {statement_name} AS {prepared_sql}'
+    if evicted_name is not None:
+        prepare_sql = f'DEALLOCATE {evicted_name};' + prepare_sql
+    # 不传参数执行,psycopg2不对语句中的%进行转义处理
+    in_transaction = cursor.connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+    try:
+        if in_transaction:
+            cursor.execute('SAVEPOINT pg_helper_prepare;' + prepare_sql + ';RELEASE SAVEPOINT pg_helper_prepare')
+        else:
+            cursor.execute(prepare_sql)
+    except psycopg2.Error as exception:
+        if in_transaction:
+            cursor.execute('ROLLBACK TO SAVEPOINT pg_helper_prepare')
+        # 名称由SQL语句的摘要生成,同名的预备语句即为同一语句,可以直接使用
+        if exception.pgcode == psycopg2.errorcodes.DUPLICATE_PREPARED_STATEMENT:
+            cache.add(sql_string, statement_name)
+            return True
+        cache.mark_unpreparable(sql_string)
+        update_statistics('prepareFailCount')
+        return False
+
+    cache.add(sql_string, statement_name)
+    return True
+
+
+def execute_statement(statement_name, param_count):
+    """构造EXECUTE语句
+    """
+    if param_count == 0:
+        return f'EXECUTE {statement_name}'
+    return f'EXECUTE {statement_name}(' + ','.join(['%s'] * param_count) + ')'
+
+
+def update_statistics(key):
+    """更新缓存统计信息
+    """
+    with STATISTICS_LOCK:
+        STATISTICS[key] += 1
+
+
+def statistics():
+    """所有连接的预备语句缓存统计信息
+    返回值：
+       字典形式,包括命中次数、未命中次数、命中率等
+    """
+    with STATISTICS_LOCK:
+        result = dict(STATISTICS)
+    lookup_count = result['hitCount'] + result['missCount']
+    result['hitRate'] = result['hitCount'] / lookup_count if lookup_count else 0.0
+    return result
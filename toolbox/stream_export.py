@@ -0,0 +1,112 @@
+"""流式导出模块,将PgHelper.query_iterator逐条返回的记录编码为CSV或者NDJSON(每行一个JSON对象),
+   按块(PG_EXPORT_CHUNK_SIZE字节)写入生成器响应,可选gzip压缩;
+   记录在响应返回过程中从服务端游标分批读取,内存占用与导出的记录数无关
+"""
+import csv
+import datetime
+import io
+import json
+import zlib
+
+from flask import (current_app, stream_with_context)
+
+# 导出格式对应的文件扩展名和响应类型
+EXPORT_FORMATS = {'csv': ('csv', 'text/csv; charset=utf-8'), 'ndjson': ('ndjson', 'application/x-ndjson; charset=utf-8')}
+
+# 写入响应的块大小(字节),可通过配置PG_EXPORT_CHUNK_SIZE修改
+DEFAULT_CHUNK_SIZE = 65536
+
+
+def json_default(value):
+    """JSON编码时日期时间等类型的转换,与表格中显示的格式一致
+    """
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return str(value)
+
+
+def csv_chunks(records, columns, chunk_size=DEFAULT_CHUNK_SIZE):
+    """将记录编码为CSV,第一行为字段名;以UTF-8 BOM开头,Excel打开时中文不乱码
+    参数：
+       records：记录的迭代器,每条记录为字典形式
+       columns：导出的字段名列表
+       chunk_size：每块的字节数
+    返回值：
+       生成器,每次返回一块编码后的字节
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(columns)
+    for record in records:
+        writer.writerow([json_default(record[x]) if isinstance(record[x], datetime.datetime) else record[x] for x in columns])
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue().encode('UTF-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('UTF-8')
+
+
+def ndjson_chunks(records, columns, chunk_size=DEFAULT_CHUNK_SIZE):
+    """将记录编码为NDJSON,每行一个JSON对象
+    参数：
+       records：记录的迭代器,每条记录为字典形式
+       columns：导出的字段名列表
+       chunk_size：每块的字节数
+    返回值：
+       生成器,每次返回一块编码后的字节
+    """
+    lines = []
+    line_size = 0
+    for record in records:
+        line = json.dumps({x: record[x] for x in columns}, ensure_ascii=False, default=json_default).encode('UTF-8') + b'\n'
+        lines.append(line)
+        line_size += len(line)
+        if line_size >= chunk_size:
+            yield b''.join(lines)
+            lines = []
+            line_size = 0
+    yield b''.join(lines)
+
+
+def gzip_chunks(chunks):
+    """对编码后的块进行gzip压缩,压缩后为空的块不返回
+    参数：
+       chunks：编码后的块的迭代器
+    返回值：
+       生成器,每次返回一块压缩后的字节
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_response(records, columns, export_format='csv', compress=False, file_name='export'):
+    """构造流式导出的响应,作为附件下载
+    参数：
+       records：记录的迭代器,每条记录为字典形式,在响应返回过程中读取
+       columns：导出的字段名列表
+       export_format：导出格式,csv或者ndjson
+       compress：是否gzip压缩,压缩后文件名增加.gz扩展名
+       file_name：下载的文件名(不包括扩展名)
+    返回值：
+       响应对象
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f'unsupported export format: {export_format}')
+    extension, mimetype = EXPORT_FORMATS[export_format]
+    chunk_size = current_app.config.get('PG_EXPORT_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+    chunks = (csv_chunks if export_format == 'csv' else ndjson_chunks)(records, columns, chunk_size)
+    file_name = f'{file_name}.{extension}'
+    if compress:
+        chunks = gzip_chunks(chunks)
+        file_name += '.gz'
+        mimetype = 'application/gzip'
+    response = current_app.response_class(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{file_name}"'
+    # 禁止反向代理(例如nginx)缓冲整个响应
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
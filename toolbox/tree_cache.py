@@ -0,0 +1,158 @@
+"""树形列表的进程内缓存模块,缓存流程、表单、工作流、地理处理模型和词汇表等树形列表接口序列化后的JSON,
+   重复读取不再执行递归查询;
+   每个表有一个版本号,添加、编辑、删除接口调用invalidate增加表的版本号,缓存项记录生成时依赖的各表的版本号,
+   版本号不一致时缓存项失效,重新查询;
+   invalidate在写操作时和请求的事务提交之后各增加一次版本号,
+   避免事务提交之前其它请求读取到旧数据、以新版本号缓存;
+   缓存项数不超过PG_TREE_CACHE_SIZE,超过时删除最久未使用的缓存项,超过PG_TREE_CACHE_MAX_BYTES的结果不缓存;
+   表的版本号也用于生成HTTP条件请求的ETag(toolbox.conditional_request),权限、角色、用户等表的修改接口同样调用invalidate;
+   多个进程时,invalidate在请求的事务中发送通知(NOTIFY),事务提交后其它进程的监听线程(toolbox.cache_listener)增加表的版本号;
+   监听连接断开期间可能遗漏通知,断开和重新连接时增加全局版本号,使全部缓存项和ETag失效
+"""
+import collections
+import threading
+import uuid
+
+from flask import (current_app, has_app_context)
+
+from .connection_pool import after_commit
+from .postgresql_helper import PgHelper
+
+# 默认的缓存项数和每项的最大字节数,可通过配置修改
+DEFAULT_CACHE_SIZE = 32
+DEFAULT_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# 各表的版本号,ALL_TABLES为全局版本号,所有缓存项和ETag都依赖全局版本号
+TABLE_VERSIONS = collections.Counter()
+ALL_TABLES = '*'
+
+# 进程标识,用于ETag和识别本进程发送的通知
+PROCESS_TAG = uuid.uuid4().hex[:12]
+
+# 表被修改的通知频道,内容为"进程标识 表名"
+NOTIFY_CHANNEL = 'gy_cache_invalidate'
+
+# 缓存项,键为缓存名称,值为(依赖的各表的版本号, 序列化后的JSON)
+CACHE_ENTRIES = collections.OrderedDict()
+CACHE_LOCK = threading.Lock()
+STATISTICS = collections.Counter()
+
+
+def versions(tables):
+    """依赖的各表当前的版本号,最后为全局版本号
+    """
+    with CACHE_LOCK:
+        return current_versions(tables)
+
+
+def current_versions(tables):
+    """依赖的各表当前的版本号,需要在CACHE_LOCK中调用
+    """
+    return tuple(TABLE_VERSIONS[x] for x in tables) + (TABLE_VERSIONS[ALL_TABLES],)
+
+
+def lookup(key, tables):
+    """查询缓存项,版本号与依赖的各表一致时返回缓存的JSON,否则返回None
+    参数：
+       key：缓存名称
+       tables：依赖的表名元组
+    返回值：
+       缓存的JSON
+    """
+    with CACHE_LOCK:
+        entry = CACHE_ENTRIES.get(key, None)
+        if entry is not None and entry[0] == current_versions(tables):
+            CACHE_ENTRIES.move_to_end(key)
+            STATISTICS['hitCount'] += 1
+            return entry[1]
+        STATISTICS['missCount'] += 1
+        return None
+
+
+def store(key, table_versions, data):
+    """保存缓存项,table_versions为查询之前获取的版本号,查询期间表已被修改时缓存项在下一次读取时失效
+    参数：
+       key：缓存名称
+       table_versions：依赖的各表的版本号
+       data：序列化后的JSON
+    返回值：
+    """
+    cache_size = current_app.config.get('PG_TREE_CACHE_SIZE', DEFAULT_CACHE_SIZE) if has_app_context() else DEFAULT_CACHE_SIZE
+    max_bytes = current_app.config.get('PG_TREE_CACHE_MAX_BYTES', DEFAULT_CACHE_MAX_BYTES) if has_app_context() else DEFAULT_CACHE_MAX_BYTES
+    if len(data) > max_bytes:
+        return
+    with CACHE_LOCK:
+        CACHE_ENTRIES[key] = (table_versions, data)
+        CACHE_ENTRIES.move_to_end(key)
+        while len(CACHE_ENTRIES) > cache_size:
+            CACHE_ENTRIES.popitem(last=False)
+            STATISTICS['evictedCount'] += 1
+
+
+def load(key, tables, loader):
+    """获取缓存的JSON,没有缓存或者已失效时调用loader查询并缓存
+    参数：
+       key：缓存名称
+       tables：依赖的表名元组
+       loader：查询函数,返回序列化后的JSON(bytes)
+    返回值：
+       序列化后的JSON
+    """
+    data = lookup(key, tables)
+    if data is None:
+        table_versions = versions(tables)
+        data = loader()
+        store(key, table_versions, data)
+    return data
+
+
+async def load_async(key, tables, loader):
+    """与load相同,loader为协程函数,用于异步视图函数
+    """
+    data = lookup(key, tables)
+    if data is None:
+        table_versions = versions(tables)
+        data = await loader()
+        store(key, table_versions, data)
+    return data
+
+
+def bump(table):
+    """增加表的版本号
+    """
+    with CACHE_LOCK:
+        TABLE_VERSIONS[table] += 1
+        STATISTICS['invalidateCount'] += 1
+
+
+def bump_all():
+    """增加全局版本号,清空缓存项,用于可能遗漏了其它进程的通知时
+    """
+    with CACHE_LOCK:
+        TABLE_VERSIONS[ALL_TABLES] += 1
+        CACHE_ENTRIES.clear()
+        STATISTICS['invalidateCount'] += 1
+
+
+def invalidate(table):
+    """表被修改时调用,使依赖该表的缓存项失效,在事务提交之后再次失效;
+       在请求的事务中发送通知,事务提交时送达其它进程,回滚时不发送
+    参数：
+       table：表名
+    返回值：
+    """
+    bump(table)
+    PgHelper().execute_sql('select pg_notify(%s, %s)', (NOTIFY_CHANNEL, f'{PROCESS_TAG} {table}'))
+    after_commit(lambda: bump(table))
+
+
+def statistics():
+    """树形列表缓存的统计信息
+    返回值：
+       字典形式,包括命中、未命中、失效、淘汰的次数,缓存项数和缓存的字节数
+    """
+    with CACHE_LOCK:
+        result = {key: STATISTICS[key] for key in ('hitCount', 'missCount', 'invalidateCount', 'evictedCount')}
+        result['entryCount'] = len(CACHE_ENTRIES)
+        result['entryBytes'] = sum(len(x[1]) for x in CACHE_ENTRIES.values())
+    return result
@@ -0,0 +1,464 @@
+"""树形表的物化路径模块,流程、表单、工作流、地理处理模型、词汇表、权限、角色和用户机构等树形表只记录parent_guid,
+   读取时需要从根节点开始递归查询才能得到节点的层级名称(treeName);
+   本模块为每个树形表增加两个路径字段,由触发器在添加、编辑(修改名称)、移动(修改parent_guid)和删除节点时维护:
+       tree_path：从第一级节点到当前节点的唯一标识数组
+       tree_names：从第一级节点到当前节点的名称数组,treeName为array_to_string(tree_names, '~')
+   tree_path使用GIN索引,子树查询(tree_path @> array[节点标识])和祖先查询(guid = any(tree_path))都是一次索引扫描;
+   parent_guid使用B-tree索引,用于树形控件展开节点时分页查询直接子节点(query_children);
+   删除、移动子树时,delete_subtree在一条语句中删除整个子树和关联表(SUBTREE_DEPENDENTS)中的记录,
+   move_subtree修改子树根节点的parent_guid,由触发器在一条语句中更新全部子孙节点的路径;
+   有固定根节点的表,parent_guid为根节点的是第一级节点,从根节点不可达的节点路径为NULL(与递归查询的结果一致);
+   没有固定根节点的表(权限、角色、用户机构),没有上级或者上级不存在的是第一级节点;
+   移动节点时上级是节点自身或者其子孙节点时触发器抛出异常,同一个表的结构修改按照咨询锁依次执行;
+   应用启动时为还没有路径字段的表增加字段、索引和触发器,并由已有的数据生成一次路径,树形列表的查询依赖路径字段,安装失败时应用启动失败;
+   也可以在项目根目录执行:
+       python -m toolbox.tree_path rebuild
+"""
+import argparse
+import asyncio
+import logging
+import threading
+import time
+
+import psycopg2
+import psycopg2.errorcodes
+from flask import Flask
+from psycopg2 import sql
+
+from . import connection_pool
+from .connection_pool import PoolTimeoutError
+
+# 树形表的名称字段和固定根节点,没有固定根节点的为None
+TREE_TABLES = {
+    'gy_flow': ('name', 'bc7dc16e-184f-4743-a9c5-e7d1507be350'),
+    'gy_form': ('name', 'e6e9ce2a-e960-4349-b5c0-866cb41d3037'),
+    'gy_workflow': ('name', '03bb1ba4-0aeb-46d7-a99c-f03bcc6ea0d5'),
+    'gy_geoprocessing_model': ('name', '99fb71e8-a794-47c2-a9c6-dc0a6e36248f'),
+    'gy_word_chinese_english': ('chinese_name', '4dba9686-8412-4a14-8ddf-a7c48c8e446d'),
+    'gy_authorize': ('name', None),
+    'gy_role': ('name', None),
+    'gy_user_institution': ('name', None)
+}
+
+# 路径维护的触发器函数,参数为名称字段和固定根节点(没有时为空字符串)
+# 插入、移动、改名之前由上级节点的路径生成当前节点的路径;之后将子孙节点的路径前缀替换为新的路径,
+# 从根节点不可达(路径为NULL)的节点移动回树中时,子孙节点的路径也为NULL,沿parent_guid递归查询子孙节点重新生成路径;
+# 删除节点时,有固定根节点的表子孙节点不可达,路径设置为NULL,否则去掉已删除的前缀,子孙节点成为第一级节点
+FUNCTION_SQL = '''create or replace function gy_tree_path() returns trigger language plpgsql as $$
+                  declare
+                      parent_path text[];
+                      parent_names text[];
+                      parent_count integer;
+                  begin
+                      perform pg_advisory_xact_lock(hashtext('gy_tree_path'), hashtext(TG_TABLE_NAME));
+                      if TG_OP = 'DELETE' then
+                          if TG_ARGV[1] = '' then
+                              execute format('update %I set tree_path = tree_path[array_position(tree_path, $1) + 1:],
+                                              tree_names = tree_names[array_position(tree_path, $1) + 1:]
+                                              where tree_path @> array[$1] and guid::text <> $1', TG_TABLE_NAME) using OLD.guid::text;
+                          else
+                              execute format('update %I set tree_path = null, tree_names = null where tree_path @> array[$1] and guid::text <> $1',
+                                             TG_TABLE_NAME) using OLD.guid::text;
+                          end if;
+                          return OLD;
+                      end if;
+
+                      if TG_WHEN = 'AFTER' then
+                          if NEW.tree_path is null then
+                              execute format('update %I set tree_path = null, tree_names = null where tree_path @> array[$1] and guid::text <> $1',
+                                             TG_TABLE_NAME) using NEW.guid::text;
+                          elsif OLD.tree_path is null then
+                              execute format('with recursive cte as
+                                              (
+                                              select guid, $2::text[] as tree_path, $3::text[] as tree_names from %1$I where guid = $1
+                                              union all
+                                              select origin.guid, cte.tree_path || origin.guid::text, cte.tree_names || origin.%2$I::text
+                                              from cte, %1$I origin
+                                              where origin.parent_guid = cte.guid and not origin.guid::text = any(cte.tree_path)
+                                              )
+                                              update %1$I set tree_path = cte.tree_path, tree_names = cte.tree_names
+                                              from cte where %1$I.guid = cte.guid and cte.guid <> $1', TG_TABLE_NAME, TG_ARGV[0])
+                                  using NEW.guid, NEW.tree_path, NEW.tree_names;
+                          else
+                              execute format('update %I set tree_path = $2 || tree_path[array_position(tree_path, $1) + 1:],
+                                              tree_names = $3 || tree_names[array_position(tree_path, $1) + 1:]
+                                              where tree_path @> array[$1] and guid::text <> $1', TG_TABLE_NAME)
+                                  using NEW.guid::text, NEW.tree_path, NEW.tree_names;
+                          end if;
+                          return null;
+                      end if;
+
+                      NEW.tree_path := null;
+                      NEW.tree_names := null;
+                      if NEW.parent_guid::text is not distinct from nullif(TG_ARGV[1], '') then
+                          NEW.tree_path := array[NEW.guid::text];
+                          NEW.tree_names := array[to_jsonb(NEW) ->> TG_ARGV[0]];
+                          return NEW;
+                      end if;
+                      execute format('select tree_path, tree_names from %I where guid = $1', TG_TABLE_NAME)
+                          into parent_path, parent_names using NEW.parent_guid;
+                      get diagnostics parent_count = row_count;
+                      if parent_count = 0 then
+                          if TG_ARGV[1] = '' then
+                              NEW.tree_path := array[NEW.guid::text];
+                              NEW.tree_names := array[to_jsonb(NEW) ->> TG_ARGV[0]];
+                          end if;
+                      elsif NEW.guid::text = any(parent_path) then
+                          raise exception 'cannot move % under its own subtree in %', NEW.guid, TG_TABLE_NAME using errcode = 'check_violation';
+                      elsif parent_path is not null then
+                          NEW.tree_path := parent_path || NEW.guid::text;
+                          NEW.tree_names := parent_names || (to_jsonb(NEW) ->> TG_ARGV[0]);
+                      end if;
+                      return NEW;
+                  end $$'''
+
+# 增加路径字段和索引,触发器只在上级或者名称修改时执行,维护子孙节点路径的语句只修改路径字段,不会再次触发
+INSTALL_SQL = '''alter table {table} add column if not exists tree_path text[], add column if not exists tree_names text[];
+                 create index if not exists {path_index} on {table} using gin (tree_path);
+                 create index if not exists {parent_index} on {table} (parent_guid);
+                 drop trigger if exists {before_trigger} on {table};
+                 create trigger {before_trigger} before insert or update of parent_guid, {name} on {table} for each row
+                     execute function gy_tree_path({name_literal}, {root_literal});
+                 drop trigger if exists {after_trigger} on {table};
+                 create trigger {after_trigger} after update of parent_guid, {name} on {table} for each row
+                     when (OLD.tree_path is distinct from NEW.tree_path or OLD.tree_names is distinct from NEW.tree_names)
+                     execute function gy_tree_path({name_literal}, {root_literal});
+                 drop trigger if exists {delete_trigger} on {table};
+                 create trigger {delete_trigger} after delete on {table} for each row
+                     execute function gy_tree_path({name_literal}, {root_literal})'''
+
+# 由parent_guid重新生成全部节点的路径,只修改路径字段,不触发触发器;已有的环上的节点不可达,路径为NULL
+REBUILD_SQL = '''update {table} set tree_path = null, tree_names = null where tree_path is not null;
+                 with recursive cte as
+                 (
+                 select guid, array[guid::text] as tree_path, array[{name}::text] as tree_names from {table} origin where {first_level}
+                 union all
+                 select origin.guid, cte.tree_path || origin.guid::text, cte.tree_names || origin.{name}::text
+                 from cte, {table} origin
+                 where origin.parent_guid = cte.guid and not origin.guid::text = any(cte.tree_path)
+                 )
+                 update {table} set tree_path = cte.tree_path, tree_names = cte.tree_names from cte where {table}.guid = cte.guid'''
+
+# 删除子树时一起删除的关联表,(关联表, 关联字段);关联表也有关联表时继续删除
+SUBTREE_DEPENDENTS = {
+    'gy_flow': (('gy_flow_node', 'flow_guid'),),
+    'gy_form': (('gy_form_field', 'form_guid'),),
+    'gy_geoprocessing_model': (('gy_geoprocessing_model_node', 'geoprocessing_model_guid'),),
+    'gy_authorize': (('gy_role_authorize', 'authorize_guid'),),
+    'gy_role': (('gy_role_authorize', 'role_guid'), ('gy_user_role', 'role_guid'))
+}
+
+# 子树中的节点还被引用时不能删除的表,(引用表, 引用字段);例如机构下的用户不一起删除,机构子树中还有用户时不删除;
+# 向节点添加、移动引用记录之前调用lock_node,与删除子树互斥
+SUBTREE_REFERENCES = {'gy_user_institution': ('gy_user', 'institution_guid')}
+
+# 子节点分页查询的默认行数和最大行数
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# 路径字段是否已经存在
+INSTALLED_SQL = "select exists(select 1 from pg_attribute where attrelid = to_regclass(%s) and attname = 'tree_path' and not attisdropped)"
+
+# 多个进程同时启动时依次执行,之后的进程检查到已经安装时跳过
+LOCK_SQL = "select pg_advisory_xact_lock(hashtext('gy_tree_path'))"
+
+LOGGER = logging.getLogger(__name__)
+
+# 各表路径字段的安装结果
+PATH_REGISTRY = {}
+PATH_LOCK = threading.Lock()
+
+
+def subtree_sql(table, columns):
+    """查询节点及其全部子孙节点的语句,参数为节点的唯一标识,按照层级排序
+    参数：
+       table：树形表名
+       columns：查询的字段
+    返回值：
+       SQL语句
+    """
+    check_table(table)
+    return f'select {columns} from {table} where tree_path @> array[%s::text] order by cardinality(tree_path)'
+
+
+def ancestors_sql(table, columns):
+    """查询节点的全部祖先节点(包括节点自身)的语句,参数为节点的唯一标识,从第一级节点开始排序
+    参数：
+       table：树形表名
+       columns：查询的字段
+    返回值：
+       SQL语句
+    """
+    check_table(table)
+    return f'''select {columns} from {table} where guid = any((select tree_path from {table} where guid = %s)::text[])
+               order by cardinality(tree_path)'''
+
+
+def children_sql(table, columns, joins=''):
+    """分页查询节点的直接子节点的语句,参数为上级节点的唯一标识、行数和起始行;
+       每个子节点的子节点数(childCount)和是否有子节点(hasChildren)使用parent_guid的索引统计
+    参数：
+       table：树形表名,别名为A
+       columns：查询的字段
+       joins：关联其它表的语句
+    返回值：
+       SQL语句
+    """
+    check_table(table)
+    return f'''select {columns},child_node.child_count as "childCount",child_node.child_count > 0 as "hasChildren"
+               from {table} A {joins}
+               cross join lateral (select count(*) as child_count from {table} where parent_guid = A.guid) child_node
+               where A.parent_guid = %s order by A.id limit %s offset %s'''
+
+
+async def query_children(pg_helper, table, columns, request_json, joins=''):
+    """分页查询节点的直接子节点,用于树形控件展开节点时按需加载
+    参数：
+       pg_helper：AsyncPgHelper对象
+       table：树形表名,别名为A
+       columns：查询的字段
+       request_json：请求参数,包括上级节点的唯一标识parentGuid(默认为根节点)、起始行startRow和结束行endRow
+       joins：关联其它表的语句
+    返回值：
+       (子节点的列表, 子节点总数)
+    """
+    parent_guid = request_json.get('parentGuid', None) or TREE_TABLES[table][1]
+    start_row = max(int(request_json.get('startRow', 0)), 0)
+    limit_count = min(max(int(request_json.get('endRow', start_row + DEFAULT_PAGE_SIZE)) - start_row, 0), MAX_PAGE_SIZE)
+    records, total_count = await asyncio.gather(pg_helper.query_datatable(children_sql(table, columns, joins), (parent_guid, limit_count, start_row)),
+                                                pg_helper.query_single_value(f'select count(*) from {table} where parent_guid = %s', (parent_guid,)))
+    return [dict(x.items()) for x in records], total_count
+
+
+def delete_subtree_sql(table):
+    """删除节点及其全部子孙节点和关联记录的语句,使用数据修改的公用表表达式(CTE)在一条语句中执行,参数为两次节点的唯一标识
+    参数：
+       table：树形表名
+    返回值：
+       SQL语句
+    """
+    check_table(table)
+    # 从根节点不可达(路径为NULL)的节点也可以按照唯一标识删除
+    cte_list = [f'subtree as (delete from {table} where tree_path @> array[%s::text] or guid = %s returning guid)']
+
+    def add_dependents(source, source_table):
+        for dependent_table, column in SUBTREE_DEPENDENTS.get(source_table, ()):
+            name = f'dependent_{len(cte_list)}'
+            returning = ' returning guid' if dependent_table in SUBTREE_DEPENDENTS else ''
+            cte_list.append(f'{name} as (delete from {dependent_table} where {column} in (select guid from {source}){returning})')
+            if returning:
+                add_dependents(name, dependent_table)
+
+    add_dependents('subtree', table)
+    return 'with ' + ',\n'.join(cte_list) + '\nselect count(*) from subtree'
+
+
+def delete_subtree(pg_helper, table, guid):
+    """在请求的事务中删除节点及其全部子孙节点和关联记录;
+       表在SUBTREE_REFERENCES中时,先锁定子树的全部节点再检查引用,子树中的节点还被引用时抛出ValueError,不删除;
+       锁定之后,向子树中添加、移动引用记录的请求(lock_node)等待本事务结束,之后发现节点已删除
+    参数：
+       pg_helper：PgHelper对象
+       table：树形表名
+       guid：子树根节点的唯一标识
+    返回值：
+    """
+    check_table(table)
+    if table in SUBTREE_REFERENCES:
+        reference_table, reference_column = SUBTREE_REFERENCES[table]
+        subtree = f'select guid from {table} where tree_path @> array[%s::text] or guid = %s'
+        # 锁定之后的查询在同一个事务中执行,读取锁定时已提交的引用记录
+        pg_helper.execute_sql(subtree + ' for update', (guid, guid))
+        if pg_helper.query_single_value(f'select exists(select 1 from {reference_table} where {reference_column} in ({subtree}))', (guid, guid)):
+            raise ValueError(f'cannot delete {guid}, the subtree is still referenced by {reference_table}')
+    pg_helper.execute_sql(delete_subtree_sql(table), (guid, guid))
+
+
+def lock_node(pg_helper, table, guid):
+    """在请求的事务中锁定节点(FOR SHARE),向节点添加、移动引用记录(例如机构下的用户)之前调用,与删除子树互斥;
+       节点不存在或者已被并发的请求删除时抛出ValueError
+    参数：
+       pg_helper：PgHelper对象
+       table：树形表名
+       guid：节点的唯一标识
+    返回值：
+    """
+    check_table(table)
+    pg_helper.execute_sql(f'select guid from {table} where guid = %s for share', (guid,))
+    if not pg_helper.query_single_value(f'select exists(select 1 from {table} where guid = %s)', (guid,)):
+        raise ValueError(f'{guid} does not exist in {table}')
+
+
+def move_subtree(pg_helper, table, guid, parent_guid):
+    """在请求的事务中将节点及其全部子孙节点移动到新的上级节点下,子孙节点的路径由触发器在一条语句中更新;
+       新的上级节点是节点自身或者其子孙节点时抛出ValueError,检查从主库读取(只读库可能还没有同步之前的移动),
+       并发移动形成的环由触发器检查,同样抛出ValueError
+    参数：
+       pg_helper：PgHelper对象
+       table：树形表名
+       guid：子树根节点的唯一标识
+       parent_guid：新的上级节点的唯一标识,为None时移动到根节点(没有固定根节点的表为第一级节点)
+    返回值：
+    """
+    check_table(table)
+    parent_guid = parent_guid or TREE_TABLES[table][1]
+    connection_pool.pin_primary()
+    if parent_guid is not None and (parent_guid == guid or pg_helper.query_single_value(
+            f'select exists(select 1 from {table} where guid = %s and tree_path @> array[%s::text])', (parent_guid, guid))):
+        raise ValueError(f'cannot move {guid} under its own subtree')
+    try:
+        pg_helper.execute_sql(f'update {table} set parent_guid = %s where guid = %s', (parent_guid, guid))
+    except psycopg2.Error as exception:
+        if exception.pgcode != psycopg2.errorcodes.CHECK_VIOLATION:
+            raise
+        raise ValueError(f'cannot move {guid} under its own subtree') from exception
+
+
+def check_table(table):
+    """检查是否是维护路径的树形表,表名会拼接到SQL语句中
+    """
+    if table not in TREE_TABLES:
+        raise ValueError(f'{table} is not a tree table')
+
+
+def rebuild_table(cursor, table):
+    """由parent_guid重新生成一个表全部节点的路径
+    参数：
+       cursor：游标
+       table：树形表名
+    返回值：
+       有路径(从根节点可达)的节点数
+    """
+    name, root_guid = TREE_TABLES[table]
+    if root_guid is None:
+        first_level = sql.SQL(
+            'origin.parent_guid is null or not exists(select 1 from {} parent_node where parent_node.guid = origin.parent_guid)').format(
+                sql.Identifier(table))
+    else:
+        first_level = sql.SQL('origin.parent_guid = {}').format(sql.Literal(root_guid))
+    cursor.execute(sql.SQL(REBUILD_SQL).format(table=sql.Identifier(table), name=sql.Identifier(name), first_level=first_level))
+    return cursor.rowcount
+
+
+def install(pool, tables=None):
+    """为还没有路径字段的树形表增加字段、索引和触发器,并生成一次路径;安装期间锁定表的写入
+    参数：
+       pool：数据库连接池
+       tables：树形表名的列表,默认为全部树形表
+    返回值：
+       字典形式,键为表名,值为新安装时有路径的节点数,已经安装时为None;不存在的表不包括在内
+    """
+    result = {}
+    connection = pool.getconn()
+    # 连接可能处于自动提交模式,咨询锁和语句需要在同一个事务中
+    connection.autocommit = False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(LOCK_SQL)
+            cursor.execute("select set_config('statement_timeout', '0', true)")
+            cursor.execute(FUNCTION_SQL)
+            for table in tables or TREE_TABLES:
+                cursor.execute('select to_regclass(%s) is not null', (table,))
+                if not cursor.fetchone()[0]:
+                    continue
+                cursor.execute(INSTALLED_SQL, (table,))
+                if cursor.fetchone()[0]:
+                    result[table] = None
+                    continue
+                name, root_guid = TREE_TABLES[table]
+                cursor.execute(sql.SQL('lock table {} in share row exclusive mode').format(sql.Identifier(table)))
+                cursor.execute(
+                    sql.SQL(INSTALL_SQL).format(table=sql.Identifier(table),
+                                                name=sql.Identifier(name),
+                                                name_literal=sql.Literal(name),
+                                                root_literal=sql.Literal(root_guid or ''),
+                                                path_index=sql.Identifier(f'{table}_tree_path_idx'),
+                                                parent_index=sql.Identifier(f'{table}_parent_guid_idx'),
+                                                before_trigger=sql.Identifier(f'{table}_tree_path_before'),
+                                                after_trigger=sql.Identifier(f'{table}_tree_path_after'),
+                                                delete_trigger=sql.Identifier(f'{table}_tree_path_delete')))
+                result[table] = rebuild_table(cursor, table)
+        connection.commit()
+        return result
+    except psycopg2.Error:
+        connection.rollback()
+        raise
+    finally:
+        pool.putconn(connection)
+
+
+def rebuild(pool, tables=None):
+    """重新生成已安装的树形表全部节点的路径,用于修复直接修改数据库(禁用触发器)之后的路径
+    参数：
+       pool：数据库连接池
+       tables：树形表名的列表,默认为全部树形表
+    返回值：
+       字典形式,键为表名,值为有路径的节点数
+    """
+    result = {}
+    connection = pool.getconn()
+    connection.autocommit = False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(LOCK_SQL)
+            cursor.execute("select set_config('statement_timeout', '0', true)")
+            for table in tables or TREE_TABLES:
+                cursor.execute(INSTALLED_SQL, (table,))
+                if not cursor.fetchone()[0]:
+                    continue
+                cursor.execute(sql.SQL('lock table {} in share row exclusive mode').format(sql.Identifier(table)))
+                result[table] = rebuild_table(cursor, table)
+        connection.commit()
+        return result
+    except psycopg2.Error:
+        connection.rollback()
+        raise
+    finally:
+        pool.putconn(connection)
+
+
+def init_app(app):
+    """为树形表安装路径字段和触发器,需要在connection_pool.init_app之后、处理请求之前调用;
+       树形列表的查询使用路径字段,安装失败时抛出异常,应用启动失败,不会启动之后全部树形列表接口都返回500的应用
+    参数：
+       app：Flask应用
+    返回值：
+    """
+    try:
+        installed = install(app.extensions['pg_pool'])
+    except (psycopg2.Error, PoolTimeoutError):
+        LOGGER.critical('failed to install tree path columns, tree queries require them', exc_info=True)
+        raise
+    with PATH_LOCK:
+        PATH_REGISTRY['last'] = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'installed': installed}
+
+
+def statistics():
+    """路径字段的安装结果
+    返回值：
+       字典形式,包括安装的时间、各表新安装时有路径的节点数(已经安装的为None)
+    """
+    with PATH_LOCK:
+        return dict(PATH_REGISTRY.get('last', {}))
+
+
+def main():
+    """命令行入口,rebuild重新生成全部树形表的路径
+    """
+    parser = argparse.ArgumentParser(description='树形表的物化路径(tree_path、tree_names)')
+    parser.add_argument('command', choices=('rebuild',), help='rebuild重新生成全部树形表的路径')
+    parser.parse_args()
+
+    # 只创建连接池,不加载蓝图等其它模块
+    app = Flask(__name__)
+    app.config.from_object('toolbox.flask_config.DevelopmentConfig')
+    pool = connection_pool.init_app(app)
+    install(pool)
+    start_time = time.perf_counter()
+    for table, node_count in rebuild(pool).items():
+        print(f'{table}: {node_count} nodes')
+    print(f'rebuilt in {time.perf_counter() - start_time:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
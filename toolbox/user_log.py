@@ -1,13 +1,16 @@
 """ 用户日志记录装饰器
 """
 import datetime
+import inspect
 import json
 
 from functools import wraps
 from flask_jwt_extended import get_jwt_identity
-from flask import request
+from flask import (after_this_request, request)
 
-from .postgresql_helper import PgHelper
+from . import log_payload
+from .audit_log_writer import get_writer
+from .connection_pool import after_commit
 
 
 def logit():
@@ -17,21 +20,40 @@ def logit():
         event_description (str, optional): 事件描述. Defaults to ''.
     """
 
+    def write_log(func):
+        # 相关信息在调用被装饰的函数前记录(事件时间为请求的时间),请求的事务提交之后放入日志队列,由后台线程批量写入数据库日志表,
+        # 不占用请求的连接和事务;业务操作失败(返回错误状态码)或者事务提交失败时不记录,与原来随事务回滚的行为一致
+        current_user = get_jwt_identity()
+        param_json = request.json.copy()
+        param_json["moduleName"] = func.__module__
+        param_json["functionName"] = func.__name__
+        # 大字段按照摘要存储到gy_log_payload,param_json中只记录引用
+        payloads = log_payload.extract_payloads(param_json, request.endpoint)
+        event_description = func.__doc__.splitlines()[0]
+        log_record = (current_user['userGuid'], current_user['userName'], event_description, json.dumps(param_json), datetime.datetime.now())
+
+        @after_this_request
+        def submit_log(response):
+            # 在提交请求的事务(connection_pool.commit_transaction)之前执行,只注册提交之后执行的函数
+            if response.status_code < 400:
+                after_commit(lambda: get_writer().submit(log_record, payloads))
+            return response
+
     def logging_decorator(func):
 
+        # 异步视图函数需要返回协程函数,由Flask在事件循环中执行
+        if inspect.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def async_wrapped_function(*args, **kwargs):
+                write_log(func)
+                return await func(*args, **kwargs)
+
+            return async_wrapped_function
+
         @wraps(func)
         def wrapped_function(*args, **kwargs):
-            # 相关信息写入数据库日志表中
-            pg_helper = PgHelper()
-            current_user = get_jwt_identity()
-            param_json = request.json.copy()
-            param_json["moduleName"] = func.__module__
-            param_json["functionName"] = func.__name__
-            event_description = func.__doc__.splitlines()[0]
-            pg_helper.execute_sql(
-                '''INSERT INTO gy_log(user_guid, user_name, event_description,param_json,event_time) VALUES(%s, %s, %s, %s, %s);''',
-                (current_user['userGuid'], current_user['userName'], event_description, json.dumps(param_json), datetime.datetime.now()))
-
+            write_log(func)
             return func(*args, **kwargs)
 
         return wrapped_function
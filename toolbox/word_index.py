@@ -0,0 +1,179 @@
+"""词汇表的进程内前缀索引模块,用于输入时自动补全词汇的中文名称和英文名称;
+   索引为按键排序的(键, 词汇标识)数组,键是中文名称和英文名称的casefold,每个词汇两个键,
+   查询时二分查找第一个不小于前缀的键,顺序扫描到键不再以前缀开头或者已有limit个词汇为止,不查询数据库;
+   只索引从根节点可达的词汇项(is_leaf),不包括词汇类别;
+   本进程的添加、编辑、删除、移动接口调用refresh,事务提交之后从主库重新读取该节点的子树并更新索引,不重建整个索引;
+   其它进程修改词汇表时,监听线程(toolbox.cache_listener)记录收到的通知数,与建立索引时的通知数不一致时在下一次查询时重建索引;
+   第一次查询时建立索引,读取或者更新索引失败时标记为失效,下一次查询时重建
+"""
+import bisect
+import collections
+import threading
+import time
+
+import psycopg2
+
+from . import cache_listener
+from .connection_pool import (PoolTimeoutError, after_commit, get_pool)
+
+TABLE = 'gy_word_chinese_english'
+
+# 默认和最多返回的词汇数
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 100
+
+WORD_SQL = '''select guid, chinese_name, english_name, array_to_string(tree_names, '~'), tree_path
+              from gy_word_chinese_english where is_leaf is true and tree_path is not null'''
+
+SUBTREE_SQL = WORD_SQL + ' and tree_path @> array[%s::text]'
+
+# 排序的(键, 词汇标识)数组,词汇标识对应的词汇信息,建立索引时其它进程的通知数
+INDEX_REGISTRY = {'keys': [], 'words': {}, 'version': None}
+# INDEX_LOCK保护索引的读写,BUILD_LOCK使重建和更新依次执行,读取数据库时不阻塞查询
+INDEX_LOCK = threading.Lock()
+BUILD_LOCK = threading.Lock()
+STATISTICS = collections.Counter()
+
+
+def word_keys(word):
+    """词汇的索引键,中文名称和英文名称的casefold,空的名称不索引
+    """
+    return {x.strip().casefold() for x in (word['chineseName'], word['englishName']) if x and x.strip()}
+
+
+def read_words(sql_text, params=None):
+    """从主库读取词汇,刚提交的修改在只读库上可能还不可见
+    参数：
+       sql_text：查询语句
+       params：查询参数
+    返回值：
+       词汇信息的列表
+    """
+    pool = get_pool()
+    connection = pool.getconn()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql_text, params)
+            return [{
+                'guid': guid,
+                'chineseName': chinese_name,
+                'englishName': english_name,
+                'treeChineseName': tree_chinese_name,
+                'path': frozenset(path)
+            } for guid, chinese_name, english_name, tree_chinese_name, path in cursor.fetchall()]
+    finally:
+        # 未结束的只读事务在归还连接池时回滚
+        pool.putconn(connection)
+
+
+def rebuild():
+    """从数据库读取全部词汇,重新建立索引
+    """
+    with BUILD_LOCK:
+        version = cache_listener.remote_version(TABLE)
+        with INDEX_LOCK:
+            if INDEX_REGISTRY['version'] == version:
+                return
+        start_time = time.perf_counter()
+        words = {x['guid']: x for x in read_words(WORD_SQL)}
+        keys = sorted((key, guid) for guid, word in words.items() for key in word_keys(word))
+        with INDEX_LOCK:
+            INDEX_REGISTRY.update(keys=keys, words=words, version=version)
+            STATISTICS['rebuildCount'] += 1
+            STATISTICS['lastRebuildMilliseconds'] = round((time.perf_counter() - start_time) * 1000)
+
+
+def remove_word(guid):
+    """从索引中删除词汇,需要在INDEX_LOCK中调用
+    """
+    word = INDEX_REGISTRY['words'].pop(guid)
+    keys = INDEX_REGISTRY['keys']
+    for key in word_keys(word):
+        position = bisect.bisect_left(keys, (key, guid))
+        if position < len(keys) and keys[position] == (key, guid):
+            del keys[position]
+
+
+def insert_word(word):
+    """向索引中添加词汇,需要在INDEX_LOCK中调用
+    """
+    INDEX_REGISTRY['words'][word['guid']] = word
+    for key in word_keys(word):
+        bisect.insort(INDEX_REGISTRY['keys'], (key, word['guid']))
+
+
+def apply(guid):
+    """重新读取节点及其子树中的词汇并更新索引,节点被删除或者从根节点不可达时子树中的词汇从索引中删除
+    参数：
+       guid：添加、编辑、删除或移动的节点的唯一标识
+    返回值：
+    """
+    with BUILD_LOCK:
+        with INDEX_LOCK:
+            if INDEX_REGISTRY['version'] is None:
+                return
+        try:
+            words = read_words(SUBTREE_SQL, (guid,))
+        except (psycopg2.Error, PoolTimeoutError):
+            # 无法读取时使索引失效,下一次查询时重建
+            with INDEX_LOCK:
+                INDEX_REGISTRY['version'] = None
+                STATISTICS['failedCount'] += 1
+            return
+        with INDEX_LOCK:
+            for word_guid in [x for x, word in INDEX_REGISTRY['words'].items() if guid in word['path']]:
+                remove_word(word_guid)
+            for word in words:
+                if word['guid'] in INDEX_REGISTRY['words']:
+                    remove_word(word['guid'])
+                insert_word(word)
+            STATISTICS['applyCount'] += 1
+
+
+def refresh(guid):
+    """添加、编辑、删除或移动词汇表的节点时调用,请求的事务提交之后更新索引,回滚时不更新
+    参数：
+       guid：节点的唯一标识
+    返回值：
+    """
+    after_commit(lambda: apply(guid))
+
+
+def search(prefix, limit=DEFAULT_LIMIT):
+    """查询中文名称或英文名称以prefix开头(不区分大小写)的词汇,按照匹配的名称排序
+    参数：
+       prefix：输入的前缀
+       limit：最多返回的词汇数
+    返回值：
+       词汇信息的列表,包括guid、chineseName、englishName、treeChineseName
+    """
+    prefix = (prefix or '').strip().casefold()
+    limit = max(1, min(int(limit or DEFAULT_LIMIT), MAX_LIMIT))
+    if not prefix:
+        return []
+    if INDEX_REGISTRY['version'] != cache_listener.remote_version(TABLE):
+        rebuild()
+    result = {}
+    with INDEX_LOCK:
+        keys = INDEX_REGISTRY['keys']
+        words = INDEX_REGISTRY['words']
+        for position in range(bisect.bisect_left(keys, (prefix,)), len(keys)):
+            key, guid = keys[position]
+            if not key.startswith(prefix) or len(result) >= limit:
+                break
+            # 中文名称和英文名称都匹配时只返回一次
+            result.setdefault(guid, words[guid])
+        STATISTICS['queryCount'] += 1
+    return [{x: word[x] for x in ('guid', 'chineseName', 'englishName', 'treeChineseName')} for word in result.values()]
+
+
+def statistics():
+    """词汇前缀索引的统计信息
+    返回值：
+       字典形式,包括查询、重建、增量更新和更新失败的次数,最近一次重建的耗时,索引的词汇数和键数
+    """
+    with INDEX_LOCK:
+        result = {key: STATISTICS[key] for key in ('queryCount', 'rebuildCount', 'applyCount', 'failedCount', 'lastRebuildMilliseconds')}
+        result['wordCount'] = len(INDEX_REGISTRY['words'])
+        result['keyCount'] = len(INDEX_REGISTRY['keys'])
+    return result